@@ -18,6 +18,7 @@ from resources.search import blp as SearchBlueprint
 from resources.timeline import blp as TimelineBlueprint
 from resources.chat import blp as ChatBlueprint
 from resources.base import blp as BaseBlueprint
+from resources.metrics import blp as MetricsBlueprint
 
 from dotenv import load_dotenv
 
@@ -116,5 +117,6 @@ def create_app(db_url=None):
     api.register_blueprint(TimelineBlueprint)
     api.register_blueprint(ChatBlueprint)
     api.register_blueprint(BaseBlueprint)
+    api.register_blueprint(MetricsBlueprint)
 
     return app
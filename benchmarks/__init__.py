@@ -0,0 +1 @@
+"""Benchmarks for the performance critical paths of the API"""
@@ -0,0 +1,264 @@
+"""Microbenchmarks for the post-processing of /search_theme responses
+
+Measures the three stages that run after OpenSearch answers a timeline search:
+
+- parse: `ChunkSearchingClass.parse_search_response` on the aggregation response
+- collect_ids: `ChunkSearchingClass.collect_document_ids` on the parsed timeline
+- serialize: dumping the results with `SearchResultsSchema`
+
+Every stage runs on synthetic aggregation responses of a small, a typical and
+a very large size. Time and peak memory are measured separately, because
+tracemalloc slows the code down. Results are written to a JSON file, which can
+be compared with the results of a previous release.
+
+Usage::
+
+    python -m benchmarks.bench_search_postprocessing --output bench_results.json
+    python -m benchmarks.bench_search_postprocessing --compare previous_results.json
+"""
+
+import argparse
+import copy
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+from datetime import date, datetime, timedelta, timezone
+
+os.environ.setdefault("MISTRAL_API_KEY", "benchmark")
+
+from schemas import SearchResultsSchema
+from resources.resource_classes.cl_search import ChunkSearchingClass
+
+# (days, documents per day, characters per chunk)
+SCENARIOS = {
+    "small": (5, 5, 500),
+    "typical": (60, 20, 1500),
+    "large": (365, 200, 1500),
+}
+
+CHUNKS_PER_DOCUMENT = 3
+FACET_VALUES = 25
+
+
+def build_chunk_source(day, document_number, chunk_number, characters):
+    """Builds the `_source` of a single chunk as returned by top_hits"""
+
+    document_id = f"{day.isoformat()}-{document_number}"
+
+    return {
+        "chunk_id": f"{document_id}-{chunk_number}",
+        "document_id": document_id,
+        "document_title": f"Document {document_number} van {day.isoformat()}",
+        "content_text": ("Lorem ipsum dolor sit amet " * (characters // 27 + 1))[:characters],
+        "extension": "pdf",
+        "position": chunk_number,
+        "lastmodified": day.isoformat(),
+        "published": day.isoformat(),
+        "publisher": f"Publisher {document_number % FACET_VALUES}",
+        "source": "benchmark",
+        "type_primary": f"Type {document_number % 7}",
+        "type_secondary": f"Subtype {document_number % 11}",
+        "url": f"https://example.org/{document_id}",
+        "document_url": f"https://example.org/{document_id}.pdf",
+    }
+
+
+def build_response(days, documents_per_day, characters):
+    """Builds a synthetic aggregation response of the timeline search"""
+
+    first_day = date(2024, 12, 31)
+    date_buckets = []
+    for day_number in range(days):
+        day = first_day - timedelta(days=day_number)
+        document_buckets = []
+        for document_number in range(documents_per_day):
+            hits = [
+                {
+                    "_index": "es_hackethon",
+                    "_id": f"{day.isoformat()}-{document_number}-{chunk_number}",
+                    "_score": 1.0 - chunk_number / 10,
+                    "_source": build_chunk_source(day, document_number, chunk_number, characters),
+                }
+                for chunk_number in range(CHUNKS_PER_DOCUMENT)
+            ]
+            document_buckets.append(
+                {
+                    "key": hits[0]["_source"]["document_id"],
+                    "doc_count": CHUNKS_PER_DOCUMENT,
+                    "Document_Chunks": {"hits": {"hits": hits}},
+                    "max_score": {"value": 1.0},
+                }
+            )
+        moment = datetime(day.year, day.month, day.day, tzinfo=timezone.utc)
+        date_buckets.append(
+            {
+                "key_as_string": day.isoformat(),
+                "key": int(moment.timestamp() * 1000),
+                "doc_count": documents_per_day * CHUNKS_PER_DOCUMENT,
+                "Documents": {"buckets": document_buckets},
+            }
+        )
+
+    def facet(prefix):
+        return {
+            "buckets": [
+                {"key": f"{prefix} {value}", "doc_count": days * documents_per_day // FACET_VALUES}
+                for value in range(FACET_VALUES)
+            ]
+        }
+
+    return {
+        "aggregations": {
+            "Publicatiedatum": {"buckets": date_buckets},
+            "type_primary": facet("Type"),
+            "publisher": facet("Publisher"),
+            "type_secondary": facet("Subtype"),
+        }
+    }
+
+
+def measure(stage, prepare, repeats):
+    """Measures the duration and the peak memory of a stage
+
+    :param stage: A callable that takes the prepared input
+    :param prepare: A callable that returns a fresh input, excluded from the measurement
+    :param repeats: The number of timed runs
+
+    :returns: The timing statistics and the peak memory in bytes
+    :rtype: dict
+    """
+
+    durations = []
+    for _ in range(repeats):
+        stage_input = prepare()
+        started = time.perf_counter()
+        stage(stage_input)
+        durations.append(time.perf_counter() - started)
+
+    stage_input = prepare()
+    tracemalloc.start()
+    stage(stage_input)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "repeats": repeats,
+        "min_s": min(durations),
+        "median_s": statistics.median(durations),
+        "mean_s": statistics.fmean(durations),
+        "peak_memory_bytes": peak,
+    }
+
+
+def run(scenarios, repeats):
+    """Runs every stage for every scenario and returns the results"""
+
+    results = []
+    schema = SearchResultsSchema()
+
+    for name in scenarios:
+        days, documents_per_day, characters = SCENARIOS[name]
+        response = build_response(days, documents_per_day, characters)
+        objects, filters = ChunkSearchingClass.parse_search_response(copy.deepcopy(response))
+        objects[0]["document_ids"] = ChunkSearchingClass.collect_document_ids(objects)
+
+        stages = {
+            # Parsing updates the chunk sources in place, so every run gets its own copy
+            "parse": (
+                ChunkSearchingClass.parse_search_response,
+                lambda: copy.deepcopy(response),
+            ),
+            "collect_ids": (ChunkSearchingClass.collect_document_ids, lambda: objects),
+            "serialize": (
+                schema.dump,
+                lambda: {"timeline": objects, "filters": filters},
+            ),
+        }
+
+        for stage_name, (stage, prepare) in stages.items():
+            result = measure(stage, prepare, repeats)
+            result.update(
+                {
+                    "scenario": name,
+                    "stage": stage_name,
+                    "days": days,
+                    "documents": days * documents_per_day,
+                }
+            )
+            results.append(result)
+            print(
+                f"{name:>8} {stage_name:>12}: median {result['median_s'] * 1000:9.2f} ms, "
+                f"peak {result['peak_memory_bytes'] / 1024 / 1024:8.2f} MiB"
+            )
+
+    return results
+
+
+def compare(results, baseline_path, tolerance):
+    """Compares results with a previous run
+
+    :returns: The descriptions of the stages that regressed beyond the tolerance
+    :rtype: list
+    """
+
+    with open(baseline_path, encoding="utf-8") as baseline_file:
+        baseline = {
+            (result["scenario"], result["stage"]): result
+            for result in json.load(baseline_file)["results"]
+        }
+
+    regressions = []
+    for result in results:
+        previous = baseline.get((result["scenario"], result["stage"]))
+        if previous is None:
+            continue
+        for metric in ["median_s", "peak_memory_bytes"]:
+            if previous[metric] and result[metric] > previous[metric] * (1 + tolerance):
+                regressions.append(
+                    f"{result['scenario']}/{result['stage']} {metric}: "
+                    f"{previous[metric]:.6g} -> {result[metric]:.6g}"
+                )
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--output", default="bench_results.json", help="File to write the results to")
+    parser.add_argument("--scenarios", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument("--repeats", type=int, default=5, help="Number of timed runs per stage")
+    parser.add_argument("--compare", help="Results of a previous run to compare with")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.2, help="Allowed relative slowdown before a regression is reported"
+    )
+    arguments = parser.parse_args()
+
+    results = run(arguments.scenarios, arguments.repeats)
+
+    with open(arguments.output, "w", encoding="utf-8") as output_file:
+        json.dump(
+            {
+                "created_at": datetime.now(timezone.utc).isoformat(),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "results": results,
+            },
+            output_file,
+            indent=2,
+        )
+    print(f"Results written to {arguments.output}")
+
+    if arguments.compare:
+        regressions = compare(results, arguments.compare, arguments.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,425 @@
+"""Local stand-in for the Mistral API, for load testing the API offline
+
+Serves the two endpoints the API uses:
+
+- POST /v1/embeddings: deterministic 1024 dimensional embeddings. Every word
+  gets a fixed random vector seeded by its hash and a text embeds as the
+  normalized sum of its words, so texts that share words stay similar and the
+  semantic caches behave like they do against the real API.
+- POST /v1/chat/completions: canned completions, also streamed as server-sent
+  events when the request sets ``stream``. Label prompts get one of the known
+  categories, so the enrichment keeps working.
+
+The latency of every response is drawn from a log-normal distribution with the
+configured median and 99th percentile. A share of the requests can fail with a
+500 or with a 429 that carries a Retry-After header, and a requests per minute
+limit can be set to test the rate limiter. GET /stats returns the counters.
+
+Point the API at the server with::
+
+    python -m benchmarks.mock_mistral_server --port 8089 --latency-median-ms 300 --rate-limit-rate 0.02
+    MISTRAL_SERVER_URL=http://127.0.0.1:8089 MISTRAL_API_KEY=mock flask run
+"""
+
+import argparse
+import hashlib
+import json
+import math
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+
+EMBEDDING_DIMENSIONS = 1024
+CHARS_PER_TOKEN = 4
+# z-score of the 99th percentile of a normal distribution
+P99_Z_SCORE = 2.326
+
+LABELS = [
+    "Motie",
+    "Amendement",
+    "Brief van derden",
+    "Brief van Gedeputeerde Staten (GS)",
+    "Verslag",
+    "Statenvoorstel",
+    "Nota",
+    "Overig",
+]
+
+CANNED_COMPLETION = (
+    "Dit is een gesimuleerd antwoord van de lokale Mistral server. Het document beschrijft een besluit "
+    "van de provincie over de uitvoering van het beleid, de financiële gevolgen daarvan en de planning "
+    "voor de komende jaren. Gedeputeerde Staten informeren Provinciale Staten over de voortgang en "
+    "vragen om instemming met de voorgestelde aanpak."
+)
+
+
+def estimate_tokens(text):
+    """Estimates the number of tokens of a text the way the usage of the real API roughly does"""
+
+    return max(1, len(text) // CHARS_PER_TOKEN)
+
+
+def stable_seed(text):
+    """Returns a seed that only depends on the text, unlike the salted built-in `hash`"""
+
+    return int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+
+
+@lru_cache(maxsize=50000)
+def word_vector(word):
+    """Returns the fixed random vector of a single word"""
+
+    return np.random.default_rng(stable_seed(word)).standard_normal(EMBEDDING_DIMENSIONS)
+
+
+def embed_text(text):
+    """Embeds a text as the normalized sum of the vectors of its words
+
+    :returns: A list of `EMBEDDING_DIMENSIONS` floats with unit length
+    :rtype: list
+    """
+
+    words = re.findall(r"\w+", text.lower()) or [text]
+    vector = np.sum([word_vector(word) for word in words], axis=0)
+    vector /= np.linalg.norm(vector) or 1.0
+
+    return np.round(vector, 6).tolist()
+
+
+def completion_text(prompt, words=None):
+    """Returns the canned completion for a prompt
+
+    :param prompt: The content of the last user message
+    :param words: Cuts the completion to this many words
+    """
+
+    if "categorie" in prompt.lower():
+        return LABELS[stable_seed(prompt) % len(LABELS)]
+
+    text = CANNED_COMPLETION
+    if words:
+        text = " ".join(text.split()[:words])
+
+    return text
+
+
+class MockMistralServer(ThreadingHTTPServer):
+    """HTTP server with the behaviour settings and counters shared by its request handlers"""
+
+    daemon_threads = True
+    # Load tests open many connections at once, more than the default backlog of 5
+    request_queue_size = 1024
+
+    def __init__(
+        self,
+        address,
+        latency_median_ms=200.0,
+        latency_p99_ms=1000.0,
+        token_interval_ms=10.0,
+        error_rate=0.0,
+        rate_limit_rate=0.0,
+        retry_after=1.0,
+        requests_per_minute=None,
+        api_key=None,
+        completion_words=None,
+        verbose=False,
+    ):
+        """Initializes a `MockMistralServer` object
+
+        :param address: The ``(host, port)`` to listen on
+        :param latency_median_ms: The median latency of a response
+        :param latency_p99_ms: The 99th percentile of the latency of a response
+        :param token_interval_ms: Milliseconds between two chunks of a streamed completion
+        :param error_rate: Share of the requests that fail with a 500
+        :param rate_limit_rate: Share of the requests that fail with a 429
+        :param retry_after: The Retry-After in seconds of a 429
+        :param requests_per_minute: Answers with a 429 above this rate, when set
+        :param api_key: Only accepts this bearer token, when set
+        :param completion_words: Cuts the canned completions to this many words
+        :param verbose: Logs every request
+        """
+
+        super().__init__(address, MockMistralHandler)
+        self.latency_median = latency_median_ms / 1000
+        self.latency_sigma = (
+            math.log(latency_p99_ms / latency_median_ms) / P99_Z_SCORE
+            if latency_median_ms > 0 and latency_p99_ms > latency_median_ms
+            else 0.0
+        )
+        self.token_interval = token_interval_ms / 1000
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.requests_per_minute = requests_per_minute
+        self.api_key = api_key
+        self.completion_words = completion_words
+        self.verbose = verbose
+
+        self.lock = threading.Lock()
+        self.bucket = float(requests_per_minute or 0)
+        self.bucket_updated_at = time.monotonic()
+        self.stats = {"requests": 0, "embeddings": 0, "completions": 0, "streams": 0, "errors": 0, "rate_limited": 0}
+
+    def handle_error(self, request, client_address):
+        # Clients hang up on purpose, e.g. on the losing request of a hedged call
+        if not isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+            super().handle_error(request, client_address)
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.stats[name] += amount
+
+    def latency(self):
+        """Draws the latency of a response in seconds"""
+
+        if self.latency_median <= 0:
+            return 0.0
+
+        return random.lognormvariate(math.log(self.latency_median), self.latency_sigma)
+
+    def over_rate_limit(self):
+        """Takes a request from the requests per minute bucket, telling if it was empty"""
+
+        if not self.requests_per_minute:
+            return False
+
+        with self.lock:
+            now = time.monotonic()
+            self.bucket = min(
+                self.requests_per_minute,
+                self.bucket + (now - self.bucket_updated_at) * self.requests_per_minute / 60,
+            )
+            self.bucket_updated_at = now
+            if self.bucket < 1:
+                return True
+            self.bucket -= 1
+
+        return False
+
+
+class MockMistralHandler(BaseHTTPRequestHandler):
+    """Answers the requests of the Mistral SDK with mocked responses"""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def send_json(self, status, body, headers=None):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def send_error_json(self, status, message, error_type, headers=None):
+        self.send_json(
+            status,
+            {"object": "error", "message": message, "type": error_type, "param": None, "code": str(status)},
+            headers,
+        )
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/stats":
+            with self.server.lock:
+                stats = dict(self.server.stats)
+            self.send_json(200, stats)
+        else:
+            self.send_error_json(404, f"No route for GET {self.path}", "not_found")
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            self.send_error_json(400, "Request body is not valid JSON", "invalid_request_error")
+            return
+
+        server = self.server
+        server.count("requests")
+
+        if server.api_key and self.headers.get("Authorization") != f"Bearer {server.api_key}":
+            self.send_error_json(401, "Unauthorized", "authentication_error")
+            return
+
+        path = self.path.rstrip("/")
+        if path not in ("/v1/embeddings", "/v1/chat/completions"):
+            self.send_error_json(404, f"No route for POST {self.path}", "not_found")
+            return
+
+        time.sleep(server.latency())
+
+        draw = random.random()
+        if server.over_rate_limit() or draw < server.rate_limit_rate:
+            server.count("rate_limited")
+            self.send_error_json(
+                429,
+                "Requests rate limit exceeded",
+                "rate_limited",
+                {"Retry-After": f"{server.retry_after:g}"},
+            )
+            return
+        if draw < server.rate_limit_rate + server.error_rate:
+            server.count("errors")
+            self.send_error_json(500, "Simulated internal server error", "internal_server_error")
+            return
+
+        if path == "/v1/embeddings":
+            self.handle_embeddings(body)
+        else:
+            self.handle_chat_completions(body)
+
+    def handle_embeddings(self, body):
+        texts = body.get("input") or []
+        if isinstance(texts, str):
+            texts = [texts]
+
+        self.server.count("embeddings", len(texts))
+        tokens = sum(estimate_tokens(text) for text in texts)
+        self.send_json(
+            200,
+            {
+                "id": uuid.uuid4().hex,
+                "object": "list",
+                "data": [
+                    {"object": "embedding", "embedding": embed_text(text), "index": index}
+                    for index, text in enumerate(texts)
+                ],
+                "model": body.get("model", "mistral-embed"),
+                "usage": {"prompt_tokens": tokens, "completion_tokens": 0, "total_tokens": tokens},
+            },
+        )
+
+    def handle_chat_completions(self, body):
+        messages = body.get("messages") or []
+        prompt = "\n".join(str(message.get("content") or "") for message in messages)
+        last_message = str(messages[-1].get("content") or "") if messages else ""
+        content = completion_text(last_message, self.server.completion_words)
+
+        completion_id = uuid.uuid4().hex
+        created = int(time.time())
+        model = body.get("model", "mistral-small-latest")
+        prompt_tokens = estimate_tokens(prompt)
+        completion_tokens = estimate_tokens(content)
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+
+        if not body.get("stream"):
+            self.server.count("completions")
+            self.send_json(
+                200,
+                {
+                    "id": completion_id,
+                    "object": "chat.completion",
+                    "created": created,
+                    "model": model,
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {"role": "assistant", "content": content},
+                            "finish_reason": "stop",
+                        }
+                    ],
+                    "usage": usage,
+                },
+            )
+            return
+
+        self.server.count("streams")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        # Without a length the end of the stream is marked by closing the connection
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        pieces = re.findall(r"\S+\s*", content)
+        for index, piece in enumerate(pieces):
+            last = index == len(pieces) - 1
+            chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [
+                    {
+                        "index": 0,
+                        "delta": {"role": "assistant", "content": piece} if index == 0 else {"content": piece},
+                        "finish_reason": "stop" if last else None,
+                    }
+                ],
+            }
+            if last:
+                chunk["usage"] = usage
+            try:
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+                self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                return
+            if not last:
+                time.sleep(self.server.token_interval)
+
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency-median-ms", type=float, default=200.0, help="Median latency of a response")
+    parser.add_argument("--latency-p99-ms", type=float, default=1000.0, help="99th percentile of the latency")
+    parser.add_argument(
+        "--token-interval-ms", type=float, default=10.0, help="Milliseconds between two chunks of a stream"
+    )
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of the requests that fail with a 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Share of the requests that get a 429")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After in seconds of a 429")
+    parser.add_argument("--requests-per-minute", type=float, help="Answers with a 429 above this rate")
+    parser.add_argument("--api-key", help="Only accepts this API key")
+    parser.add_argument("--completion-words", type=int, help="Cuts the canned completions to this many words")
+    parser.add_argument("--seed", type=int, help="Seed of the latencies and failures, for repeatable runs")
+    parser.add_argument("--verbose", action="store_true", help="Logs every request")
+    arguments = parser.parse_args()
+
+    if arguments.seed is not None:
+        random.seed(arguments.seed)
+
+    server = MockMistralServer(
+        (arguments.host, arguments.port),
+        latency_median_ms=arguments.latency_median_ms,
+        latency_p99_ms=arguments.latency_p99_ms,
+        token_interval_ms=arguments.token_interval_ms,
+        error_rate=arguments.error_rate,
+        rate_limit_rate=arguments.rate_limit_rate,
+        retry_after=arguments.retry_after,
+        requests_per_minute=arguments.requests_per_minute,
+        api_key=arguments.api_key,
+        completion_words=arguments.completion_words,
+        verbose=arguments.verbose,
+    )
+    print(f"Mock Mistral API listening on http://{arguments.host}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -4,7 +4,7 @@ from flask import send_file, redirect
 from flask.views import MethodView
 from flask_smorest import Blueprint, abort
 
-from opensearchpy import OpenSearch
+from resources.resource_classes.cl_search_backend import get_search_backend
 
 import os
 import requests
@@ -13,16 +13,6 @@ import mimetypes
 
 blp = Blueprint("Base", "base", description="Operations on the base endpoint")
 
-OPENSEARCH_URL = os.getenv("OPENSEARCH_URL")
-OPENSEARCH_USERNAME = os.getenv("OPENSEARCH_USERNAME")
-OPENSEARCH_PASSWORD = os.getenv("OPENSEARCH_PASSWORD")
-
-OPENSEARCH_CONNECTION = OpenSearch(
-    OPENSEARCH_URL,
-    http_auth=(OPENSEARCH_USERNAME, OPENSEARCH_PASSWORD),
-    request_timeout=900,
-    verify_certs=False,
-)
 DOCUMENT_INDEX = "es_hackethon"
 
 
@@ -112,8 +102,8 @@ class HackathonDocument:
             }
         }
 
-        elastic_response = OPENSEARCH_CONNECTION.search(
-            size=1, index=DOCUMENT_INDEX, body=document_body
+        elastic_response = get_search_backend().search(
+            DOCUMENT_INDEX, {"size": 1, **document_body}
         )
 
         if elastic_response["hits"]["total"]["value"] == 0:
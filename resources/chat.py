@@ -1,11 +1,18 @@
+import json
+import threading
 from schemas import ChatInputSchema
 from flask import abort, Response, Blueprint, stream_with_context
 from flask_jwt_extended import jwt_required, get_jwt
 from flask_smorest import Blueprint, abort, error_handler
 from flask.views import MethodView
 from models import UserModel
-from resources.resource_classes import ChunkSearchingClass
-from resources.resource_classes.cl_mistral_connection import CL_Mistral_Completions
+from resources.resource_classes import ChunkSearchingClass, ANSWER_CACHE
+from resources.resource_classes.cl_context_packing import pack_context_text
+from resources.resource_classes.cl_chat_sessions import CHAT_SESSIONS, format_history
+from resources.resource_classes.cl_mistral_connection import (
+    CL_Mistral_Completions,
+    CL_Mistral_Embeddings,
+)
 
 blp = Blueprint(
     "Chat", "chat", description="Chatoperations on timelines"
@@ -43,11 +50,118 @@ class OpportunityChatEndpoint(MethodView):
         user: UserModel = UserModel.query.get_or_404(get_jwt()["sub"])
         document_ids = chat_data["document_ids"]
 
-        chat_history = []
+        # The conversation is kept per user and set of documents
+        session_key = None
+        chat_history = ""
+        if CHAT_SESSIONS is not None:
+            session_key = CHAT_SESSIONS.build_key(user.id, document_ids)
+            if chat_data.get("new_conversation"):
+                CHAT_SESSIONS.clear(session_key)
+            chat_history = format_history(CHAT_SESSIONS.get_history(session_key))
+
+        completions = CL_Mistral_Completions(priority="interactive")
+        question_embedding = CL_Mistral_Embeddings(priority="interactive").generate_embedding(chat_data["question"])
+
+        def remember(answer, cache=True):
+            # Answers to follow-up questions depend on the conversation, so only first questions are cached
+            if ANSWER_CACHE is not None and cache and not chat_history:
+                ANSWER_CACHE.set(question_embedding, document_ids, completions.model, answer)
+            if session_key is not None:
+                self.add_turn(session_key, user.id, chat_data["question"], answer)
+
+        # A similar question about the same documents skips both retrieval and completion
+        if ANSWER_CACHE is not None and not chat_history:
+            cached_answer = ANSWER_CACHE.get(question_embedding, document_ids, completions.model)
+            if cached_answer is not None:
+                if chat_data.get("stream"):
+                    return self.stream_response(iter([cached_answer]), lambda answer: remember(answer, False))
+                remember(cached_answer, False)
+                return {"output": cached_answer}
+
+        chunks = ChunkSearchingClass.get_chunks_for_chat(
+            chat_data["question"], document_ids, question_embedding
+        )
+
+        # The chunks come back in order of relevance
+        context = pack_context_text(chunks, "chat")
 
-        chunks = ChunkSearchingClass.get_chunks_for_chat(chat_data["question"], document_ids)
+        prompt = f"Geef antwoord op de gestelde vraag: {chat_data["question"]} op basis van de volgende context: {context}. Je bent een chat-assistent die statenleden helpt bij het beantwoorden van vragen over documenten. Houd je antwoord kort en bondig, tenzij er anders wordt aangegeven."
+        if chat_history:
+            prompt += f" Dit is het gesprek tot nu toe:\n{chat_history}"
 
-        prompt = f"Geef antwoord op de gestelde vraag: {chat_data["question"]} op basis van de volgende context: {chunks}. Je bent een chat-assistent die statenleden helpt bij het beantwoorden van vragen over documenten. Houd je antwoord kort en bondig, tenzij er anders wordt aangegeven."
-        completion = CL_Mistral_Completions().generate_completion(prompt)
+        if chat_data.get("stream"):
+            return self.stream_response(completions.stream_chat(prompt), remember)
+
+        completion = completions.generate_completion(prompt)
+        remember(completion)
 
         return {"output": completion}
+
+    @classmethod
+    def add_turn(cls, session_key, user_id, question, answer):
+        """Stores a turn of a conversation and compacts the history in the background when it grew too long"""
+
+        try:
+            history = CHAT_SESSIONS.add_turn(session_key, user_id, question, answer)
+        except Exception as e:
+            print(f"Failed to store chat turn: {str(e)}")
+            return
+
+        if CHAT_SESSIONS.needs_compaction(history):
+            threading.Thread(
+                target=cls.compact_history, args=(session_key,), daemon=True
+            ).start()
+
+    @staticmethod
+    def compact_history(session_key):
+        """Folds the older turns of a conversation into its rolling summary"""
+
+        def summarize(previous_summary, turns):
+            conversation = "\n\n".join(
+                f"Vraag: {question}\nAntwoord: {answer}" for question, answer in turns
+            )
+            prompt = f"Vat het volgende gesprek tussen een statenlid en een chat-assistent samen in hooguit 150 woorden. Behoud de onderwerpen, feiten en afspraken die nodig zijn om vervolgvragen te beantwoorden. Eerdere samenvatting: {previous_summary or 'geen'}. Gesprek: {conversation}"
+
+            return CL_Mistral_Completions(priority="background").generate_summary(prompt)
+
+        try:
+            CHAT_SESSIONS.compact(session_key, summarize)
+        except Exception as e:
+            print(f"Failed to compact chat history: {str(e)}")
+
+    def stream_response(self, deltas, on_complete=None):
+        """Wraps a generator of answer deltas in a server-sent events response"""
+
+        return Response(
+            stream_with_context(self.stream_answer(deltas, on_complete)),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
+    @staticmethod
+    def stream_answer(deltas, on_complete=None):
+        """Streams the answer to a chat question as server-sent events
+
+        Every model delta is sent as a ``data`` event as soon as it arrives. An
+        error halfway through the answer is sent as an ``error`` event, and the
+        stream always ends with a ``done`` event.
+
+        :param deltas: A generator of the text deltas of the answer
+        :param on_complete: Called with the full answer when the stream finished without errors
+
+        :returns: A generator of server-sent events
+        :rtype: generator
+        """
+
+        answer = []
+        try:
+            for delta in deltas:
+                answer.append(delta)
+                yield f"data: {json.dumps({'delta': delta})}\n\n"
+            if on_complete is not None:
+                on_complete("".join(answer))
+        except Exception as e:
+            print(f"Failed to stream chat answer: {str(e)}")
+            yield f"event: error\ndata: {json.dumps({'message': 'The answer could not be completed.'})}\n\n"
+
+        yield "event: done\ndata: {}\n\n"
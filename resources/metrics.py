@@ -0,0 +1,48 @@
+"""This module exposes the operational metrics of the API"""
+
+from flask.views import MethodView
+from flask_smorest import Blueprint, abort
+from flask_jwt_extended import jwt_required
+from schemas import LLMMetricsSchema
+from .resource_classes import global_administrator_required
+from .resource_classes.cl_llm_metrics import LLM_METRICS
+from .resource_classes.cl_mistral_resilience import MISTRAL_CIRCUIT_BREAKERS, MISTRAL_HEDGE_POLICY
+
+blp = Blueprint("Metrics", "metrics", description="Operational metrics of the API")
+
+
+@blp.route("/metrics/llm")
+class LLMMetricsClass(MethodView):
+    """Latency, token and cost metrics of the Mistral calls, the breakers, the hedging and the search branches"""
+
+    @jwt_required()
+    @blp.response(200, LLMMetricsSchema)
+    def get(self):
+        """Returns the Mistral call metrics of the worker that handles the request
+
+        Every gunicorn worker aggregates its own calls, so the totals of the
+        deployment are the sum over the workers, identified by `pid`.
+
+        :raises 404 Not found:
+            The metrics are disabled with LLM_METRICS_ENABLED
+        """
+
+        if LLM_METRICS is None:
+            abort(404, message="The LLM metrics are disabled.")
+
+        return {
+            **LLM_METRICS.snapshot(),
+            "circuit_breakers": MISTRAL_CIRCUIT_BREAKERS.snapshot() if MISTRAL_CIRCUIT_BREAKERS is not None else [],
+            "hedging": MISTRAL_HEDGE_POLICY.snapshot() if MISTRAL_HEDGE_POLICY is not None else {},
+        }
+
+    @global_administrator_required()
+    def delete(self):
+        """Resets the Mistral call metrics of the worker that handles the request"""
+
+        if LLM_METRICS is None:
+            abort(404, message="The LLM metrics are disabled.")
+
+        LLM_METRICS.reset()
+
+        return {"message": "The LLM metrics have been reset."}, 200
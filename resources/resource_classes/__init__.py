@@ -6,4 +6,43 @@ from .cl_permissions import (
     is_global_admin,
 )
 from .cl_search import ChunkSearchingClass
-from .cl_mistral_connection import CL_Mistral_Embeddings, CL_Mistral_Completions
\ No newline at end of file
+from .cl_mistral_client import MistralClientManager, get_mistral_client, run_async
+from .cl_rate_limiter import MistralRateLimiter, RateLimitTimeout, MISTRAL_RATE_LIMITER, call_mistral
+from .cl_llm_metrics import LLMMetrics, LLM_METRICS, current_endpoint
+from .cl_mistral_resilience import (
+    CircuitBreaker,
+    CircuitOpenError,
+    HedgePolicy,
+    MISTRAL_CIRCUIT_BREAKERS,
+    MISTRAL_HEDGE_POLICY,
+)
+from .cl_mistral_connection import (
+    CL_Mistral_Embeddings,
+    CL_Mistral_Completions,
+    CL_Mistral_Async_Embeddings,
+    CL_Mistral_Async_Completions,
+)
+from .cl_embedding_cache import EmbeddingCache, EMBEDDING_CACHE
+from .cl_single_flight import SingleFlight, SINGLE_FLIGHT
+from .cl_embedding_batcher import EmbeddingMicroBatcher, EMBEDDING_MICROBATCHER
+from .cl_answer_cache import SemanticAnswerCache, ANSWER_CACHE
+from .cl_search_backend import (
+    SearchBackend,
+    OpenSearchBackend,
+    InMemorySearchBackend,
+    get_search_backend,
+    register_search_backend,
+)
+from .cl_search_cache import SearchResultCache, SEARCH_CACHE
+from .cl_facet_index import FacetIndex, get_facet_index, update_facet_index
+from .cl_vector_index import LocalVectorIndex, get_local_vector_index
+from .cl_enrichment_cache import EnrichmentCache, ENRICHMENT_CACHE
+from .cl_context_packing import estimate_tokens, pack_context
+from .cl_chat_sessions import ChatSessionStore, CHAT_SESSIONS
+from .cl_enrichment import DocumentEnrichmentClass
+from .cl_enrichment_jobs import (
+    EnrichmentJobQueue,
+    EnrichmentWorkerPool,
+    ENRICHMENT_JOB_QUEUE,
+    ENRICHMENT_WORKER_POOL,
+)
\ No newline at end of file
@@ -0,0 +1,250 @@
+"""Semantic cache for the answers to chat questions about a set of documents"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+from dotenv import load_dotenv
+from resources.resource_classes.cl_local_storage import LocalSQLiteStore, cache_key, local_storage_path
+
+load_dotenv()
+
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "true").lower() == "true"
+# Minimum cosine similarity between two questions to reuse an answer
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "1000"))
+ANSWER_CACHE_TTL_SECONDS = int(os.getenv("ANSWER_CACHE_TTL_SECONDS", "86400"))
+ANSWER_CACHE_INVALIDATIONS_FILE = os.getenv("ANSWER_CACHE_INVALIDATIONS_FILE", "answer_cache.db")
+
+
+class AnswerCacheInvalidations(LocalSQLiteStore):
+    """Records when documents were updated, so every gunicorn worker drops the answers about them"""
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS invalidated_documents (
+            document_id TEXT PRIMARY KEY,
+            invalidated_at REAL NOT NULL
+        );
+    """
+
+    def __init__(self, path=None):
+        super().__init__(path or local_storage_path(ANSWER_CACHE_INVALIDATIONS_FILE))
+
+    def invalidate(self, document_ids, ttl):
+        """Marks documents as updated now
+
+        :param document_ids: The identifiers of the updated documents
+        :param ttl: The TTL of the answers, older records are removed
+        """
+
+        now = time.time()
+        with self.lock:
+            connection = self.connection()
+            connection.executemany(
+                "INSERT OR REPLACE INTO invalidated_documents (document_id, invalidated_at) VALUES (?, ?)",
+                [(str(document_id), now) for document_id in document_ids],
+            )
+            # The answers stored before these records have expired anyway
+            connection.execute("DELETE FROM invalidated_documents WHERE invalidated_at < ?", (now - ttl,))
+
+    def invalidated_since(self, document_ids, since):
+        """Tells if one of the documents was updated at or after a moment"""
+
+        document_ids = [str(document_id) for document_id in document_ids]
+        with self.lock:
+            row = self.connection().execute(
+                "SELECT 1 FROM invalidated_documents WHERE invalidated_at >= ? "
+                f"AND document_id IN ({', '.join('?' * len(document_ids))}) LIMIT 1",
+                (since, *document_ids),
+            ).fetchone()
+
+        return row is not None
+
+
+class SemanticAnswerCache:
+    """Reuses the answer to a question when a similar question was asked about the same documents
+
+    Entries are grouped by the sorted set of document identifiers. Every group
+    keeps the normalized question embeddings in one matrix, so a lookup is a
+    single matrix-vector product. The cache holds at most `max_entries`
+    answers over all groups and evicts the least recently used one first.
+
+    Updating a document drops the groups that contain it, in this process
+    right away and in the other processes through `invalidations`, which is
+    checked before a cached answer is returned.
+    """
+
+    def __init__(self, threshold=None, max_entries=None, ttl=None, invalidations=None):
+        """Initializes a `SemanticAnswerCache` object
+
+        :param threshold: Minimum cosine similarity for a hit
+        :param max_entries: Maximum number of answers kept in the cache
+        :param ttl: Number of seconds after which an answer expires
+        :param invalidations: The `AnswerCacheInvalidations` shared with the other processes, if any
+        """
+
+        self.threshold = ANSWER_CACHE_THRESHOLD if threshold is None else threshold
+        self.max_entries = max_entries or ANSWER_CACHE_MAX_ENTRIES
+        self.ttl = ANSWER_CACHE_TTL_SECONDS if ttl is None else ttl
+        self.invalidations = invalidations
+        self.lock = threading.Lock()
+        # {group key: {"entry_ids": [...], "vectors": ndarray or None, "document_ids": frozenset}}
+        self.groups = {}
+        # {entry id: (group key, vector, answer, stored at)}, in least recently used order
+        self.entries = OrderedDict()
+        self._next_entry_id = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def build_key(document_ids, model):
+        """Builds the group key for a set of documents and a completion model"""
+
+        return cache_key(model, *sorted(set(document_ids)))
+
+    @staticmethod
+    def _normalize(embedding):
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+
+        return vector / norm if norm else vector
+
+    def _matrix(self, group):
+        """Returns the stacked question vectors of a group, restacking them after a change"""
+
+        if group["vectors"] is None:
+            group["vectors"] = np.stack([self.entries[entry_id][1] for entry_id in group["entry_ids"]])
+
+        return group["vectors"]
+
+    def _remove(self, entry_id):
+        key = self.entries.pop(entry_id)[0]
+        group = self.groups[key]
+        group["entry_ids"].remove(entry_id)
+        group["vectors"] = None
+        if not group["entry_ids"]:
+            del self.groups[key]
+
+    def _remove_groups(self, keys):
+        for key in keys:
+            group = self.groups.get(key)
+            if group is not None:
+                for entry_id in list(group["entry_ids"]):
+                    self._remove(entry_id)
+
+    def _invalidated_since(self, document_ids, since):
+        try:
+            return self.invalidations.invalidated_since(document_ids, since)
+        except Exception as e:
+            # Without the shared records the answer may be stale, so it is not reused
+            print(f"Failed to check the answer cache invalidations: {str(e)}")
+            return True
+
+    def get(self, embedding, document_ids, model):
+        """Retrieves the answer to the most similar cached question about the same documents
+
+        :param embedding: The embedding of the question
+        :param document_ids: The identifiers of the documents the question is about
+        :param model: The completion model that generates the answers
+
+        :returns: The cached answer, or None when no question is similar enough
+        :rtype: str
+        """
+
+        key = self.build_key(document_ids, model)
+        vector = self._normalize(embedding)
+
+        with self.lock:
+            group = self.groups.get(key)
+            if group is None:
+                self.misses += 1
+                return None
+
+            similarities = self._matrix(group) @ vector
+            best = int(np.argmax(similarities))
+            entry_id = group["entry_ids"][best]
+
+            if similarities[best] < self.threshold:
+                self.misses += 1
+                return None
+
+            _, _, answer, stored_at = self.entries[entry_id]
+            if time.time() - stored_at > self.ttl:
+                self._remove(entry_id)
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(entry_id)
+            document_set = group["document_ids"]
+
+        if self.invalidations is not None and self._invalidated_since(document_set, stored_at):
+            # A document was updated in another process after this answer was stored
+            with self.lock:
+                self._remove_groups([key])
+                self.misses += 1
+            return None
+
+        with self.lock:
+            self.hits += 1
+
+        return answer
+
+    def set(self, embedding, document_ids, model, answer):
+        """Stores the answer to a question about a set of documents"""
+
+        key = self.build_key(document_ids, model)
+        vector = self._normalize(embedding)
+
+        with self.lock:
+            entry_id = self._next_entry_id
+            self._next_entry_id += 1
+
+            self.entries[entry_id] = (key, vector, answer, time.time())
+            group = self.groups.setdefault(
+                key, {"entry_ids": [], "vectors": None, "document_ids": frozenset(str(document_id) for document_id in document_ids)}
+            )
+            group["entry_ids"].append(entry_id)
+            group["vectors"] = None
+
+            while len(self.entries) > self.max_entries:
+                self._remove(next(iter(self.entries)))
+
+    def invalidate_documents(self, document_ids):
+        """Removes the answers about any of the documents, in every process
+
+        :param document_ids: The identifiers of the updated documents
+        """
+
+        document_ids = {str(document_id) for document_id in document_ids}
+        with self.lock:
+            self._remove_groups(
+                [key for key, group in self.groups.items() if group["document_ids"] & document_ids]
+            )
+
+        if self.invalidations is not None:
+            try:
+                self.invalidations.invalidate(document_ids, self.ttl)
+            except Exception as e:
+                print(f"Failed to invalidate the answer cache: {str(e)}")
+
+    def clear(self):
+        """Removes all answers, e.g. after the documents were updated"""
+
+        with self.lock:
+            self.groups.clear()
+            self.entries.clear()
+
+    def stats(self):
+        """Returns the hit/miss counters and the size of the cache"""
+
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self.entries),
+                "document_sets": len(self.groups),
+            }
+
+
+ANSWER_CACHE = SemanticAnswerCache(invalidations=AnswerCacheInvalidations()) if ANSWER_CACHE_ENABLED else None
@@ -0,0 +1,263 @@
+"""Server-side chat sessions with a bounded history per user and document set"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from dotenv import load_dotenv
+from resources.resource_classes.cl_local_storage import LocalSQLiteStore, cache_key, local_storage_path
+from resources.resource_classes.cl_context_packing import estimate_tokens
+
+load_dotenv()
+
+CHAT_SESSIONS_ENABLED = os.getenv("CHAT_SESSIONS_ENABLED", "true").lower() == "true"
+CHAT_SESSIONS_FILE = os.getenv("CHAT_SESSIONS_FILE", "chat_sessions.db")
+# Number of sessions whose history is kept in memory per process
+CHAT_SESSIONS_HOT_ENTRIES = int(os.getenv("CHAT_SESSIONS_HOT_ENTRIES", "256"))
+# The history is compacted into a summary once its turns take more tokens than this
+CHAT_HISTORY_COMPACT_TOKENS = int(os.getenv("CHAT_HISTORY_COMPACT_TOKENS", "1500"))
+# Number of most recent turns that stay verbatim after a compaction
+CHAT_HISTORY_KEEP_TURNS = int(os.getenv("CHAT_HISTORY_KEEP_TURNS", "2"))
+# Hard limit on the history in a prompt, in case a compaction has not run (yet)
+CHAT_HISTORY_MAX_TOKENS = int(os.getenv("CHAT_HISTORY_MAX_TOKENS", "2000"))
+CHAT_SESSION_TTL_SECONDS = int(os.getenv("CHAT_SESSION_TTL_SECONDS", str(7 * 24 * 3600)))
+
+# Expired sessions are purged once every this many turns
+CHAT_SESSIONS_PURGE_INTERVAL = 500
+
+
+class ChatSessionStore(LocalSQLiteStore):
+    """Stores the turns of chat conversations in a local SQLite database
+
+    A session holds the rolling summary of the compacted turns and the turns
+    after it. The history of recently used sessions is kept in memory, and is
+    reloaded when another process added a turn in the meantime.
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS chat_sessions (
+            session_key TEXT PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            summary TEXT NOT NULL DEFAULT '',
+            last_seq INTEGER NOT NULL DEFAULT 0,
+            updated_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS chat_turns (
+            session_key TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            question TEXT NOT NULL,
+            answer TEXT NOT NULL,
+            tokens INTEGER NOT NULL,
+            PRIMARY KEY (session_key, seq)
+        );
+        CREATE INDEX IF NOT EXISTS ix_chat_sessions_updated_at
+            ON chat_sessions (updated_at);
+    """
+
+    def __init__(self, path=None, hot_entries=None):
+        """Initializes a `ChatSessionStore` object
+
+        :param path: The path of the SQLite database file
+        :param hot_entries: Maximum number of session histories kept in memory
+        """
+
+        super().__init__(path or local_storage_path(CHAT_SESSIONS_FILE))
+        self.hot_entries = hot_entries or CHAT_SESSIONS_HOT_ENTRIES
+        self.hot = OrderedDict()
+        self.hot_lock = threading.Lock()
+        self.compacting = set()
+        self._writes = 0
+
+    @staticmethod
+    def build_key(user_id, document_ids):
+        """Builds the session key for a user chatting about a set of documents"""
+
+        return cache_key("chat", user_id, *sorted(set(document_ids)))
+
+    def _remember(self, session_key, history):
+        with self.hot_lock:
+            self.hot[session_key] = history
+            self.hot.move_to_end(session_key)
+            while len(self.hot) > self.hot_entries:
+                self.hot.popitem(last=False)
+
+    def get_history(self, session_key):
+        """Retrieves the summary and the uncompacted turns of a session
+
+        :returns: A ``{"summary": ..., "turns": [(seq, question, answer, tokens)], "last_seq": ...}`` dictionary
+        :rtype: dict
+        """
+
+        with self.lock:
+            connection = self.connection()
+            row = connection.execute(
+                "SELECT summary, last_seq FROM chat_sessions WHERE session_key = ?",
+                (session_key,),
+            ).fetchone()
+            if row is None:
+                return {"summary": "", "turns": [], "last_seq": 0}
+
+            with self.hot_lock:
+                history = self.hot.get(session_key)
+            if history is not None and history["last_seq"] == row[1] and history["summary"] == row[0]:
+                self._remember(session_key, history)
+                return history
+
+            turns = connection.execute(
+                "SELECT seq, question, answer, tokens FROM chat_turns "
+                "WHERE session_key = ? ORDER BY seq",
+                (session_key,),
+            ).fetchall()
+
+        history = {"summary": row[0], "turns": [tuple(turn) for turn in turns], "last_seq": row[1]}
+        self._remember(session_key, history)
+
+        return history
+
+    def add_turn(self, session_key, user_id, question, answer):
+        """Appends a question and its answer to a session
+
+        :returns: The history of the session including the new turn
+        :rtype: dict
+        """
+
+        tokens = estimate_tokens(question) + estimate_tokens(answer)
+
+        with self.lock:
+            connection = self.connection()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                connection.execute(
+                    "INSERT OR IGNORE INTO chat_sessions (session_key, user_id, updated_at) VALUES (?, ?, ?)",
+                    (session_key, str(user_id), time.time()),
+                )
+                seq = connection.execute(
+                    "UPDATE chat_sessions SET last_seq = last_seq + 1, updated_at = ? "
+                    "WHERE session_key = ? RETURNING last_seq",
+                    (time.time(), session_key),
+                ).fetchone()[0]
+                connection.execute(
+                    "INSERT INTO chat_turns (session_key, seq, question, answer, tokens) VALUES (?, ?, ?, ?, ?)",
+                    (session_key, seq, question, answer, tokens),
+                )
+                connection.execute("COMMIT")
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+
+            self._writes += 1
+            if self._writes % CHAT_SESSIONS_PURGE_INTERVAL == 0:
+                self.purge()
+
+        return self.get_history(session_key)
+
+    def needs_compaction(self, history):
+        """Tells if the turns of a history take more tokens than the compaction threshold"""
+
+        return (
+            len(history["turns"]) > CHAT_HISTORY_KEEP_TURNS
+            and sum(turn[3] for turn in history["turns"]) > CHAT_HISTORY_COMPACT_TOKENS
+        )
+
+    def compact(self, session_key, summarize):
+        """Folds all but the most recent turns of a session into its rolling summary
+
+        :param session_key: The key of the session
+        :param summarize: A callable that turns the previous summary and the older turns into a new summary
+
+        :returns: True when the session was compacted
+        :rtype: bool
+        """
+
+        with self.hot_lock:
+            if session_key in self.compacting:
+                return False
+            self.compacting.add(session_key)
+
+        try:
+            history = self.get_history(session_key)
+            if not self.needs_compaction(history):
+                return False
+
+            older_turns = history["turns"][: len(history["turns"]) - CHAT_HISTORY_KEEP_TURNS]
+            summary = summarize(history["summary"], [(turn[1], turn[2]) for turn in older_turns])
+            through_seq = older_turns[-1][0]
+
+            with self.lock:
+                connection = self.connection()
+                connection.execute("BEGIN IMMEDIATE")
+                try:
+                    # Another process may have compacted the same turns in the meantime
+                    updated = connection.execute(
+                        "UPDATE chat_sessions SET summary = ? WHERE session_key = ? "
+                        "AND EXISTS (SELECT 1 FROM chat_turns WHERE session_key = ? AND seq = ?)",
+                        (summary, session_key, session_key, through_seq),
+                    ).rowcount
+                    connection.execute(
+                        "DELETE FROM chat_turns WHERE session_key = ? AND seq <= ?",
+                        (session_key, through_seq),
+                    )
+                    connection.execute("COMMIT")
+                except Exception:
+                    connection.execute("ROLLBACK")
+                    raise
+
+            return bool(updated)
+        finally:
+            with self.hot_lock:
+                self.compacting.discard(session_key)
+
+    def clear(self, session_key):
+        """Removes a session, so the next question starts a new conversation"""
+
+        with self.lock:
+            connection = self.connection()
+            connection.execute("DELETE FROM chat_turns WHERE session_key = ?", (session_key,))
+            connection.execute("DELETE FROM chat_sessions WHERE session_key = ?", (session_key,))
+
+        with self.hot_lock:
+            self.hot.pop(session_key, None)
+
+    def purge(self):
+        """Removes sessions that were not used within the session TTL"""
+
+        expired = time.time() - CHAT_SESSION_TTL_SECONDS
+        with self.lock:
+            connection = self.connection()
+            connection.execute(
+                "DELETE FROM chat_turns WHERE session_key IN "
+                "(SELECT session_key FROM chat_sessions WHERE updated_at < ?)",
+                (expired,),
+            )
+            connection.execute("DELETE FROM chat_sessions WHERE updated_at < ?", (expired,))
+
+
+def format_history(history, max_tokens=None):
+    """Formats a session history for a prompt, newest turns first within a token limit
+
+    :param history: The history as returned by `ChatSessionStore.get_history`
+    :param max_tokens: The token limit of the formatted history
+
+    :returns: The summary and the turns as text, or an empty string for a new conversation
+    :rtype: str
+    """
+
+    max_tokens = CHAT_HISTORY_MAX_TOKENS if max_tokens is None else max_tokens
+
+    parts = []
+    used_tokens = 0
+    if history["summary"]:
+        parts.append(f"Samenvatting van het eerdere gesprek: {history['summary']}")
+        used_tokens += estimate_tokens(parts[0])
+
+    turns = []
+    for _, question, answer, tokens in reversed(history["turns"]):
+        if used_tokens + tokens > max_tokens:
+            break
+        turns.append(f"Vraag: {question}\nAntwoord: {answer}")
+        used_tokens += tokens
+
+    return "\n\n".join(parts + list(reversed(turns)))
+
+
+CHAT_SESSIONS = ChatSessionStore() if CHAT_SESSIONS_ENABLED else None
@@ -0,0 +1,139 @@
+"""Packs retrieved text into the context of a prompt within a token budget"""
+
+import os
+import re
+from dotenv import load_dotenv
+from resources.resource_classes.cl_llm_metrics import LLM_METRICS
+
+load_dotenv()
+
+# Rough number of characters per token of the Mistral tokenizer for Dutch text
+CONTEXT_CHARS_PER_TOKEN = float(os.getenv("CONTEXT_CHARS_PER_TOKEN", "3.5"))
+
+# Token budget of the context per prompt
+CONTEXT_BUDGETS = {
+    "chat": int(os.getenv("CONTEXT_BUDGET_CHAT", "3000")),
+    "summary": int(os.getenv("CONTEXT_BUDGET_SUMMARY", "1500")),
+    "label": int(os.getenv("CONTEXT_BUDGET_LABEL", "400")),
+}
+
+CONTEXT_SEPARATOR = "\n\n"
+
+_SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?])\s+|\n+")
+
+
+def estimate_tokens(text):
+    """Estimates the number of tokens of a text without running a tokenizer"""
+
+    if not text:
+        return 0
+
+    return int(len(text) / CONTEXT_CHARS_PER_TOKEN) + 1
+
+
+def split_sentences(text):
+    """Splits a text into sentences, dropping empty parts"""
+
+    return [sentence.strip() for sentence in _SENTENCE_BOUNDARY.split(text) if sentence.strip()]
+
+
+def _fingerprint(sentence):
+    return " ".join(sentence.lower().split())
+
+
+def truncate_to_tokens(text, tokens):
+    """Cuts a text to an estimated number of tokens, at a word boundary where possible
+
+    :returns: The leading part of the text, at least one character of a non-empty text
+    :rtype: str
+    """
+
+    characters = max(int((tokens - 1) * CONTEXT_CHARS_PER_TOKEN), 1)
+    if len(text) <= characters:
+        return text
+
+    truncated = text[:characters]
+    boundary = truncated.rfind(" ")
+    if boundary > characters // 2:
+        truncated = truncated[:boundary]
+
+    return truncated.rstrip()
+
+
+def pack_context(texts, purpose, scores=None, budget=None):
+    """Selects the text that fits in the token budget of a prompt
+
+    Chunks are taken from the highest score down. Sentences that were already
+    taken from an earlier chunk are left out, which removes the overlap between
+    neighbouring chunks. A chunk that does not fit entirely contributes its
+    leading sentences as far as the budget allows; the sentence that crosses
+    the budget is truncated, so a non-empty input never packs to an empty
+    context, also when it has no punctuation at all.
+
+    :param texts: The retrieved texts, e.g. the `content_text` of chunks
+    :param purpose: The prompt the context is for, a key of `CONTEXT_BUDGETS`
+    :param scores: The relevance score per text, the order of `texts` when omitted
+    :param budget: The token budget, overrides the budget of the purpose
+
+    :returns: The packed context and the number of tokens before and after packing
+    :rtype: dict
+    """
+
+    budget = CONTEXT_BUDGETS[purpose] if budget is None else budget
+    if scores is None:
+        scores = [-rank for rank in range(len(texts))]
+
+    order = sorted(range(len(texts)), key=lambda index: scores[index], reverse=True)
+
+    seen = set()
+    packed = []
+    used_tokens = 0
+    full = False
+    for index in order:
+        sentences = []
+        for sentence in split_sentences(texts[index] or ""):
+            fingerprint = _fingerprint(sentence)
+            if fingerprint in seen:
+                continue
+
+            tokens = estimate_tokens(sentence)
+            if used_tokens + tokens > budget:
+                remaining = budget - used_tokens
+                # A truncated sentence is only worth adding when a few words fit, or when nothing fitted yet
+                if remaining > 1 or not (packed or sentences):
+                    sentence = truncate_to_tokens(sentence, remaining)
+                    sentences.append(sentence)
+                    used_tokens += estimate_tokens(sentence)
+                full = True
+                break
+
+            seen.add(fingerprint)
+            sentences.append(sentence)
+            used_tokens += tokens
+
+        if sentences:
+            packed.append(" ".join(sentences))
+        if full or used_tokens >= budget:
+            break
+
+    context = CONTEXT_SEPARATOR.join(packed)
+    original_tokens = sum(estimate_tokens(text) for text in texts if text)
+    packed_tokens = estimate_tokens(context)
+
+    return {
+        "context": context,
+        "chunks": len(packed),
+        "original_tokens": original_tokens,
+        "packed_tokens": packed_tokens,
+        "saved_tokens": max(original_tokens - packed_tokens, 0),
+    }
+
+
+def pack_context_text(texts, purpose, scores=None, budget=None):
+    """Packs the context like `pack_context` and returns only the text, recording the tokens saved in `LLM_METRICS`"""
+
+    packed = pack_context(texts, purpose, scores, budget)
+    if LLM_METRICS is not None:
+        LLM_METRICS.record_context_packing(purpose, packed["original_tokens"], packed["packed_tokens"])
+
+    return packed["context"]
@@ -0,0 +1,117 @@
+"""Combines concurrent single-text embedding requests into batched API calls"""
+
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from dotenv import load_dotenv
+
+load_dotenv()
+
+EMBEDDING_MICROBATCH_ENABLED = os.getenv("EMBEDDING_MICROBATCH_ENABLED", "true").lower() == "true"
+# Milliseconds the first request of a batch waits for others to join
+EMBEDDING_MICROBATCH_WAIT_MS = float(os.getenv("EMBEDDING_MICROBATCH_WAIT_MS", "5"))
+EMBEDDING_MICROBATCH_MAX_SIZE = int(os.getenv("EMBEDDING_MICROBATCH_MAX_SIZE", "32"))
+# Number of batched calls that may be in flight at the same time
+EMBEDDING_MICROBATCH_CONCURRENCY = int(os.getenv("EMBEDDING_MICROBATCH_CONCURRENCY", "4"))
+
+
+class EmbeddingMicroBatcher:
+    """Collects embedding requests from different threads for a few milliseconds
+
+    A dispatcher thread takes the first waiting request, waits up to
+    `EMBEDDING_MICROBATCH_WAIT_MS` for more to arrive, and sends the texts per
+    model, priority and endpoint as one call to `CL_Mistral_Embeddings.generate_embeddings`.
+    Every caller waits on its own future and gets its own vector back.
+    """
+
+    def __init__(self, wait_ms=None, max_size=None, concurrency=None):
+        """Initializes an `EmbeddingMicroBatcher` object
+
+        :param wait_ms: Milliseconds a batch stays open for more requests
+        :param max_size: Maximum number of texts in a batch
+        :param concurrency: Maximum number of batched calls in flight
+        """
+
+        self.wait = (EMBEDDING_MICROBATCH_WAIT_MS if wait_ms is None else wait_ms) / 1000
+        self.max_size = max_size or EMBEDDING_MICROBATCH_MAX_SIZE
+        self.concurrency = concurrency or EMBEDDING_MICROBATCH_CONCURRENCY
+        self.lock = threading.Lock()
+        self._pid = None
+
+    def _ensure_started(self):
+        """Starts the dispatcher of the current process, also after a gunicorn fork"""
+
+        if self._pid == os.getpid():
+            return
+
+        with self.lock:
+            if self._pid == os.getpid():
+                return
+
+            self.requests = queue.Queue()
+            self.executor = ThreadPoolExecutor(
+                max_workers=self.concurrency, thread_name_prefix="embedding-batch"
+            )
+            threading.Thread(target=self._dispatch, name="embedding-batcher", daemon=True).start()
+            self._pid = os.getpid()
+
+    def submit(self, text, model, priority="default", endpoint=None):
+        """Queues a text for the next batch
+
+        :param endpoint: The route the call is attributed to in the metrics
+
+        :returns: A future that resolves to the embedding of the text
+        :rtype: `concurrent.futures.Future`
+        """
+
+        self._ensure_started()
+        future = Future()
+        self.requests.put((text, model, priority, endpoint, future))
+
+        return future
+
+    def embed(self, text, model, priority="default", endpoint=None):
+        """Embeds a single text as part of a batch and waits for the result"""
+
+        return self.submit(text, model, priority, endpoint).result()
+
+    def _dispatch(self):
+        while True:
+            batch = [self.requests.get()]
+            deadline = time.monotonic() + self.wait
+            while len(batch) < self.max_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.requests.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            groups = {}
+            for text, model, priority, endpoint, future in batch:
+                groups.setdefault((model, priority, endpoint), []).append((text, future))
+            for (model, priority, endpoint), requests in groups.items():
+                self.executor.submit(self._run, model, priority, endpoint, requests)
+
+    @staticmethod
+    def _run(model, priority, endpoint, requests):
+        # Imported here, the embeddings class uses this module
+        from resources.resource_classes.cl_mistral_connection import CL_Mistral_Embeddings
+
+        try:
+            embeddings = CL_Mistral_Embeddings(model, priority, endpoint).generate_embeddings(
+                [text for text, _ in requests]
+            )
+        except Exception as e:
+            for _, future in requests:
+                future.set_exception(e)
+            return
+
+        for (_, future), embedding in zip(requests, embeddings):
+            future.set_result(embedding)
+
+
+EMBEDDING_MICROBATCHER = EmbeddingMicroBatcher() if EMBEDDING_MICROBATCH_ENABLED else None
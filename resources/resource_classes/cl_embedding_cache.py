@@ -0,0 +1,188 @@
+"""Two tier cache for the embeddings generated by the Mistral API"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+from dotenv import load_dotenv
+from resources.resource_classes.cl_local_storage import (
+    LocalSQLiteStore,
+    cache_key,
+    local_storage_path,
+    normalize_cache_text,
+)
+
+load_dotenv()
+
+EMBEDDING_CACHE_ENABLED = os.getenv("EMBEDDING_CACHE_ENABLED", "true").lower() == "true"
+EMBEDDING_CACHE_FILE = os.getenv("EMBEDDING_CACHE_FILE", "embedding_cache.db")
+EMBEDDING_CACHE_MEMORY_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MEMORY_ENTRIES", "2048"))
+EMBEDDING_CACHE_DISK_ENTRIES = int(os.getenv("EMBEDDING_CACHE_DISK_ENTRIES", "200000"))
+# Either "float32" or "float16"
+EMBEDDING_CACHE_DTYPE = os.getenv("EMBEDDING_CACHE_DTYPE", "float32")
+
+# Eviction of surplus disk entries runs once every this many writes
+EMBEDDING_CACHE_EVICTION_INTERVAL = 500
+
+
+class EmbeddingCache(LocalSQLiteStore):
+    """Caches embeddings in an in-process LRU backed by a shared SQLite file
+
+    The disk tier stores every vector as a raw float32 or float16 array, so a
+    1024 dimension embedding takes 4KB or 2KB instead of a JSON list.
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS embedding_cache (
+            cache_key TEXT PRIMARY KEY,
+            model TEXT NOT NULL,
+            dtype TEXT NOT NULL,
+            vector BLOB NOT NULL,
+            last_accessed REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS ix_embedding_cache_last_accessed
+            ON embedding_cache (last_accessed);
+    """
+
+    def __init__(self, path=None, memory_entries=None, disk_entries=None, dtype=None):
+        """Initializes an `EmbeddingCache` object
+
+        :param path: The path of the SQLite database file
+        :param memory_entries: Maximum number of embeddings kept in memory
+        :param disk_entries: Maximum number of embeddings kept on disk
+        :param dtype: The numpy dtype used to store vectors on disk
+        """
+
+        super().__init__(path or local_storage_path(EMBEDDING_CACHE_FILE))
+        self.memory_entries = memory_entries or EMBEDDING_CACHE_MEMORY_ENTRIES
+        self.disk_entries = disk_entries or EMBEDDING_CACHE_DISK_ENTRIES
+        self.dtype = dtype or EMBEDDING_CACHE_DTYPE
+        self.memory = OrderedDict()
+        self.memory_lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._writes = 0
+
+    @staticmethod
+    def build_key(text, model):
+        """Builds the cache key for a text and an embedding model"""
+
+        return cache_key(model, normalize_cache_text(text))
+
+    def _remember(self, key, vector):
+        """Stores a vector in the in-memory LRU"""
+
+        with self.memory_lock:
+            self.memory[key] = vector
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.memory_entries:
+                self.memory.popitem(last=False)
+
+    def get(self, text, model):
+        """Retrieves a cached embedding
+
+        :returns: The embedding, or None when it is not cached
+        :rtype: list
+        """
+
+        key = self.build_key(text, model)
+
+        with self.memory_lock:
+            vector = self.memory.get(key)
+            if vector is not None:
+                self.memory.move_to_end(key)
+                self.memory_hits += 1
+                return list(vector)
+
+        try:
+            with self.lock:
+                connection = self.connection()
+                row = connection.execute(
+                    "SELECT dtype, vector FROM embedding_cache WHERE cache_key = ?",
+                    (key,),
+                ).fetchone()
+                if row is not None:
+                    connection.execute(
+                        "UPDATE embedding_cache SET last_accessed = ? WHERE cache_key = ?",
+                        (time.time(), key),
+                    )
+        except Exception as e:
+            print(f"Failed to read embedding cache: {str(e)}")
+            row = None
+
+        if row is None:
+            self.misses += 1
+            return None
+
+        vector = np.frombuffer(row[1], dtype=row[0]).astype(np.float64).tolist()
+        self._remember(key, tuple(vector))
+        self.disk_hits += 1
+
+        return vector
+
+    def set(self, text, model, embedding):
+        """Stores an embedding in both tiers"""
+
+        key = self.build_key(text, model)
+        self._remember(key, tuple(embedding))
+
+        try:
+            with self.lock:
+                connection = self.connection()
+                connection.execute(
+                    "INSERT OR REPLACE INTO embedding_cache "
+                    "(cache_key, model, dtype, vector, last_accessed) VALUES (?, ?, ?, ?, ?)",
+                    (
+                        key,
+                        model,
+                        self.dtype,
+                        np.asarray(embedding, dtype=self.dtype).tobytes(),
+                        time.time(),
+                    ),
+                )
+
+                self._writes += 1
+                if self._writes % EMBEDDING_CACHE_EVICTION_INTERVAL == 0:
+                    self.evict()
+        except Exception as e:
+            print(f"Failed to write embedding cache: {str(e)}")
+
+    def evict(self):
+        """Removes the least recently used surplus entries from the disk tier
+
+        :returns: The number of removed entries
+        :rtype: int
+        """
+
+        with self.lock:
+            connection = self.connection()
+            size = connection.execute("SELECT COUNT(*) FROM embedding_cache").fetchone()[0]
+            if size <= self.disk_entries:
+                return 0
+
+            return connection.execute(
+                "DELETE FROM embedding_cache WHERE cache_key IN ("
+                "SELECT cache_key FROM embedding_cache ORDER BY last_accessed ASC LIMIT ?)",
+                (size - self.disk_entries,),
+            ).rowcount
+
+    def stats(self):
+        """Returns the hit/miss counters of this process and the size of both tiers"""
+
+        with self.lock:
+            disk_size = self.connection().execute(
+                "SELECT COUNT(*) FROM embedding_cache"
+            ).fetchone()[0]
+
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "memory_size": len(self.memory),
+            "disk_size": disk_size,
+        }
+
+
+EMBEDDING_CACHE = EmbeddingCache() if EMBEDDING_CACHE_ENABLED else None
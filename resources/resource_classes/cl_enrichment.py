@@ -0,0 +1,271 @@
+"""Resource class for enriching search results with LLM generated summaries and labels"""
+
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from dotenv import load_dotenv
+from resources.resource_classes.cl_mistral_connection import (
+    MISTRAL_COMPLETION_MODEL,
+    CL_Mistral_Async_Completions,
+    CL_Mistral_Completions,
+)
+from resources.resource_classes.cl_mistral_resilience import MISTRAL_CIRCUIT_BREAKERS
+from resources.resource_classes.cl_mistral_client import MISTRAL_CLIENT_MANAGER
+from resources.resource_classes.cl_enrichment_cache import ENRICHMENT_CACHE
+from resources.resource_classes.cl_context_packing import pack_context_text
+from resources.resource_classes.cl_llm_metrics import current_endpoint
+
+load_dotenv()
+
+ENRICHMENT_MAX_WORKERS = int(os.getenv("ENRICHMENT_MAX_WORKERS", "6"))
+ENRICHMENT_DEADLINE_SECONDS = float(os.getenv("ENRICHMENT_DEADLINE_SECONDS", "30"))
+# Either "threads" (a thread per concurrent document) or "asyncio" (the shared event loop)
+ENRICHMENT_EXECUTOR = os.getenv("ENRICHMENT_EXECUTOR", "threads")
+
+# Only the first buckets and the first documents per bucket are enriched
+ENRICHMENT_MAX_BUCKETS = 3
+ENRICHMENT_MAX_DOCUMENTS_PER_BUCKET = 3
+
+
+class DocumentEnrichmentClass:
+    """Generates summaries and labels for the documents on a timeline"""
+
+    def __init__(self, max_workers=None, deadline=None, priority="default", executor=None, endpoint=None):
+        """Initializes a `DocumentEnrichmentClass` object
+
+        :param max_workers: Maximum number of concurrent LLM tasks for one request, with the "threads" executor
+        :param deadline: Maximum number of seconds the whole enrichment may take
+        :param priority: The rate limit priority class of the LLM calls
+        :param executor: Either "threads" or "asyncio"
+        :param endpoint: The route the LLM calls are attributed to in the metrics, by default the current one
+        """
+
+        self.max_workers = max_workers or ENRICHMENT_MAX_WORKERS
+        self.deadline = deadline if deadline is not None else ENRICHMENT_DEADLINE_SECONDS
+        self.priority = priority
+        self.executor = executor or ENRICHMENT_EXECUTOR
+        # Captured here, the documents are enriched outside the request thread
+        self.endpoint = endpoint or current_endpoint()
+
+    @staticmethod
+    def is_available():
+        """Tells if summaries and labels can be generated, which is not the case while the circuit breaker is open"""
+
+        return MISTRAL_CIRCUIT_BREAKERS is None or not MISTRAL_CIRCUIT_BREAKERS.is_open(MISTRAL_COMPLETION_MODEL)
+
+    @staticmethod
+    def build_summary_prompt(content_text, search_string):
+        """Builds the prompt used to summarize a document"""
+
+        content_text = pack_context_text([content_text], "summary")
+
+        return f"Geef een samenvatting van de volgende tekst: {content_text} over het thema {search_string}. Beschrijf kort wat de kern van de tekst is en wees concreet."
+
+    @staticmethod
+    def build_label_prompt(document_title, summary, content_text):
+        """Builds the prompt used to categorize a document"""
+
+        content_text = pack_context_text([content_text], "label")
+
+        return f"""Je bent een expert op het gebied van overheidsdocumentatie. Je taak is om het type document te bepalen aan de hand van een titel of korte beschrijving. '
+                    Geef ALLEEN de naam van het label terug, zonder onderbouwing.
+
+                    De titel van het document is {document_title}.
+                    De samenvatting is: {summary}.
+                    en de content van een chunk van dit document is: {content_text}.
+
+                    Het is VERPLICHT om enkel één van deze categorieën te kiezen. Een andere categorie is NIET toegestaan.Geef ALLEEN de naam van de categorie terug:
+
+
+                    Motie
+                    Amendement
+                    Brief van derden
+                    Brief van Gedeputeerde Staten (GS)
+                    Verslag
+                    Statenvoorstel
+                    Nota
+                    Overig
+                    """
+
+    @staticmethod
+    def select_documents(objects):
+        """Selects the documents on the timeline that should be enriched
+
+        :param objects: The timeline as returned by `ChunkSearchingClass.search_documents`
+
+        :returns: ``(bucket_index, document_index, document)`` tuples in timeline order
+        :rtype: list
+        """
+
+        selected = []
+        for bucket_index, entry in enumerate(objects[:ENRICHMENT_MAX_BUCKETS]):
+            documents = entry["documents"][:ENRICHMENT_MAX_DOCUMENTS_PER_BUCKET]
+            for document_index, doc in enumerate(documents):
+                selected.append((bucket_index, document_index, doc))
+
+        return selected
+
+    def enrich_document(self, doc, search_string):
+        """Generates the summary and the label for a single document
+
+        Previously generated results for the same chunk, content and theme are
+        served from the enrichment cache without calling the LLM.
+
+        :returns: A ``(summary, label)`` tuple
+        :rtype: tuple
+        """
+
+        completions = CL_Mistral_Completions(priority=self.priority, endpoint=self.endpoint)
+
+        if ENRICHMENT_CACHE is not None:
+            cached = ENRICHMENT_CACHE.get(
+                doc["chunk_id"], doc["content_text"], search_string, completions.model
+            )
+            if cached is not None:
+                return cached
+
+        summary_prompt = self.build_summary_prompt(doc["content_text"], search_string)
+        summary = completions.generate_summary(summary_prompt)
+
+        label_prompt = self.build_label_prompt(
+            doc["document_title"], summary, doc["content_text"]
+        )
+        label = completions.categorize_label(label_prompt)
+
+        if ENRICHMENT_CACHE is not None:
+            ENRICHMENT_CACHE.set(
+                doc["chunk_id"],
+                doc["content_text"],
+                search_string,
+                completions.model,
+                summary,
+                label,
+            )
+
+        return summary, label
+
+    async def enrich_document_async(self, doc, search_string):
+        """Generates the summary and the label for a single document on the shared event loop
+
+        :returns: A ``(summary, label)`` tuple
+        :rtype: tuple
+        """
+
+        completions = CL_Mistral_Async_Completions(priority=self.priority, endpoint=self.endpoint)
+
+        if ENRICHMENT_CACHE is not None:
+            cached = ENRICHMENT_CACHE.get(
+                doc["chunk_id"], doc["content_text"], search_string, completions.model
+            )
+            if cached is not None:
+                return cached
+
+        summary_prompt = self.build_summary_prompt(doc["content_text"], search_string)
+        summary = await completions.generate_summary(summary_prompt)
+
+        label_prompt = self.build_label_prompt(
+            doc["document_title"], summary, doc["content_text"]
+        )
+        label = await completions.categorize_label(label_prompt)
+
+        if ENRICHMENT_CACHE is not None:
+            ENRICHMENT_CACHE.set(
+                doc["chunk_id"],
+                doc["content_text"],
+                search_string,
+                completions.model,
+                summary,
+                label,
+            )
+
+        return summary, label
+
+    def iter_enrichments(self, objects, search_string):
+        """Enriches the selected documents concurrently and yields results as they complete
+
+        Documents that are not finished before the deadline are skipped and keep
+        their original fields. Nothing is enriched while the circuit breaker of
+        the completion model is open.
+
+        :param objects: The timeline as returned by `ChunkSearchingClass.search_documents`
+        :param search_string: The theme that was searched for
+
+        :returns: A generator of ``(bucket_index, document_index, summary, label)`` tuples
+        :rtype: generator
+        """
+
+        selected = self.select_documents(objects)
+        if not selected:
+            return
+
+        if not self.is_available():
+            print(f"Circuit breaker of {MISTRAL_COMPLETION_MODEL} is open, skipping enrichment")
+            return
+
+        if self.executor == "asyncio":
+            # All documents are in flight at once on the shared event loop
+            executor = None
+            futures = {
+                MISTRAL_CLIENT_MANAGER.submit(self.enrich_document_async(doc, search_string)): (
+                    bucket_index,
+                    document_index,
+                )
+                for bucket_index, document_index, doc in selected
+            }
+        else:
+            executor = ThreadPoolExecutor(
+                max_workers=min(self.max_workers, len(selected)),
+                thread_name_prefix="enrichment",
+            )
+            futures = {
+                executor.submit(self.enrich_document, doc, search_string): (
+                    bucket_index,
+                    document_index,
+                )
+                for bucket_index, document_index, doc in selected
+            }
+
+        deadline_at = time.monotonic() + self.deadline
+        pending = set(futures)
+        try:
+            while pending:
+                remaining = deadline_at - time.monotonic()
+                if remaining <= 0:
+                    print(f"Enrichment deadline exceeded, skipping {len(pending)} documents")
+                    break
+
+                done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+                for future in done:
+                    bucket_index, document_index = futures[future]
+                    try:
+                        summary, label = future.result()
+                    except Exception as e:
+                        print(f"Failed to enrich document {bucket_index}/{document_index}: {str(e)}")
+                        continue
+
+                    yield bucket_index, document_index, summary, label
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=False, cancel_futures=True)
+            else:
+                for future in pending:
+                    future.cancel()
+
+    def enrich(self, objects, search_string):
+        """Adds a `summary` and a `label` to the selected documents on the timeline
+
+        :param objects: The timeline as returned by `ChunkSearchingClass.search_documents`
+        :param search_string: The theme that was searched for
+
+        :returns: The same timeline, enriched in place
+        :rtype: list
+        """
+
+        for bucket_index, document_index, summary, label in self.iter_enrichments(
+            objects, search_string
+        ):
+            doc = objects[bucket_index]["documents"][document_index]
+            doc["summary"] = summary
+            doc["label"] = label
+
+        return objects
@@ -0,0 +1,164 @@
+"""Persistent cache for the summaries and labels generated for search results"""
+
+import hashlib
+import os
+import time
+from dotenv import load_dotenv
+from resources.resource_classes.cl_local_storage import (
+    LocalSQLiteStore,
+    cache_key,
+    local_storage_path,
+    normalize_cache_text,
+)
+
+load_dotenv()
+
+ENRICHMENT_CACHE_ENABLED = os.getenv("ENRICHMENT_CACHE_ENABLED", "true").lower() == "true"
+ENRICHMENT_CACHE_FILE = os.getenv("ENRICHMENT_CACHE_FILE", "enrichment_cache.db")
+ENRICHMENT_CACHE_TTL_SECONDS = int(os.getenv("ENRICHMENT_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+ENRICHMENT_CACHE_MAX_ENTRIES = int(os.getenv("ENRICHMENT_CACHE_MAX_ENTRIES", "50000"))
+
+# Eviction of surplus entries runs once every this many writes
+ENRICHMENT_CACHE_EVICTION_INTERVAL = 100
+
+
+class EnrichmentCache(LocalSQLiteStore):
+    """Stores generated summaries and labels per chunk, content and theme
+
+    Entries expire after a TTL, and when the cache grows beyond its maximum size
+    the least recently used entries are evicted.
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS enrichment_cache (
+            cache_key TEXT PRIMARY KEY,
+            chunk_id TEXT NOT NULL,
+            summary TEXT,
+            label TEXT,
+            created_at REAL NOT NULL,
+            last_accessed REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS ix_enrichment_cache_last_accessed
+            ON enrichment_cache (last_accessed);
+    """
+
+    def __init__(self, path=None, ttl=None, max_entries=None):
+        """Initializes an `EnrichmentCache` object
+
+        :param path: The path of the SQLite database file
+        :param ttl: Number of seconds after which an entry expires
+        :param max_entries: Maximum number of entries kept in the cache
+        """
+
+        super().__init__(path or local_storage_path(ENRICHMENT_CACHE_FILE))
+        self.ttl = ttl if ttl is not None else ENRICHMENT_CACHE_TTL_SECONDS
+        self.max_entries = max_entries or ENRICHMENT_CACHE_MAX_ENTRIES
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+
+    @staticmethod
+    def build_key(chunk_id, content_text, search_string, model):
+        """Builds the cache key for a chunk, its content, the theme and the model"""
+
+        content_hash = hashlib.sha256((content_text or "").encode("utf-8")).hexdigest()
+
+        return cache_key(chunk_id, content_hash, normalize_cache_text(search_string), model)
+
+    def get(self, chunk_id, content_text, search_string, model):
+        """Retrieves a cached summary and label
+
+        :returns: A ``(summary, label)`` tuple, or None when there is no valid entry
+        :rtype: tuple
+        """
+
+        key = self.build_key(chunk_id, content_text, search_string, model)
+        now = time.time()
+
+        try:
+            with self.lock:
+                connection = self.connection()
+                row = connection.execute(
+                    "SELECT summary, label, created_at FROM enrichment_cache WHERE cache_key = ?",
+                    (key,),
+                ).fetchone()
+
+                if row is not None and now - row[2] > self.ttl:
+                    connection.execute(
+                        "DELETE FROM enrichment_cache WHERE cache_key = ?", (key,)
+                    )
+                    row = None
+
+                if row is None:
+                    self.misses += 1
+                    return None
+
+                connection.execute(
+                    "UPDATE enrichment_cache SET last_accessed = ? WHERE cache_key = ?",
+                    (now, key),
+                )
+                self.hits += 1
+        except Exception as e:
+            print(f"Failed to read enrichment cache for {chunk_id}: {str(e)}")
+            return None
+
+        return row[0], row[1]
+
+    def set(self, chunk_id, content_text, search_string, model, summary, label):
+        """Stores a generated summary and label"""
+
+        key = self.build_key(chunk_id, content_text, search_string, model)
+        now = time.time()
+
+        try:
+            with self.lock:
+                connection = self.connection()
+                connection.execute(
+                    "INSERT OR REPLACE INTO enrichment_cache "
+                    "(cache_key, chunk_id, summary, label, created_at, last_accessed) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (key, chunk_id, summary, label, now, now),
+                )
+
+                self._writes += 1
+                if self._writes % ENRICHMENT_CACHE_EVICTION_INTERVAL == 0:
+                    self.evict()
+        except Exception as e:
+            print(f"Failed to write enrichment cache for {chunk_id}: {str(e)}")
+
+    def evict(self):
+        """Removes expired entries and the least recently used surplus entries
+
+        :returns: The number of removed entries
+        :rtype: int
+        """
+
+        with self.lock:
+            connection = self.connection()
+            removed = connection.execute(
+                "DELETE FROM enrichment_cache WHERE created_at < ?",
+                (time.time() - self.ttl,),
+            ).rowcount
+
+            size = connection.execute("SELECT COUNT(*) FROM enrichment_cache").fetchone()[0]
+            if size > self.max_entries:
+                removed += connection.execute(
+                    "DELETE FROM enrichment_cache WHERE cache_key IN ("
+                    "SELECT cache_key FROM enrichment_cache ORDER BY last_accessed ASC LIMIT ?)",
+                    (size - self.max_entries,),
+                ).rowcount
+
+        return removed
+
+    def stats(self):
+        """Returns the hit/miss counters of this process and the size of the cache"""
+
+        with self.lock:
+            size = self.connection().execute(
+                "SELECT COUNT(*) FROM enrichment_cache"
+            ).fetchone()[0]
+
+        return {"hits": self.hits, "misses": self.misses, "size": size}
+
+
+ENRICHMENT_CACHE = EnrichmentCache() if ENRICHMENT_CACHE_ENABLED else None
@@ -0,0 +1,327 @@
+"""Background jobs that enrich search results with summaries and labels"""
+
+import json
+import os
+import threading
+import time
+import uuid
+from dotenv import load_dotenv
+from resources.resource_classes.cl_local_storage import LocalSQLiteStore, local_storage_path
+from resources.resource_classes.cl_enrichment import DocumentEnrichmentClass
+
+load_dotenv()
+
+ENRICHMENT_JOBS_FILE = os.getenv("ENRICHMENT_JOBS_FILE", "enrichment_jobs.db")
+# Number of worker threads per process, 0 leaves the jobs to a standalone worker
+ENRICHMENT_JOB_WORKERS = int(os.getenv("ENRICHMENT_JOB_WORKERS", "4"))
+ENRICHMENT_JOB_TTL_SECONDS = int(os.getenv("ENRICHMENT_JOB_TTL_SECONDS", "3600"))
+# Tasks that are claimed longer than this are handed out again, e.g. after a worker crashed
+ENRICHMENT_TASK_TIMEOUT_SECONDS = int(os.getenv("ENRICHMENT_TASK_TIMEOUT_SECONDS", "120"))
+
+# Seconds an idle worker waits before it checks the queue again
+ENRICHMENT_WORKER_POLL_INTERVAL = 1.0
+
+
+class EnrichmentJobQueue(LocalSQLiteStore):
+    """Queue of enrichment jobs stored in a local SQLite database
+
+    A job holds one task per document to enrich. Tasks are claimed atomically,
+    so worker threads in several gunicorn workers can share the same queue.
+    Every claim gets its own token, and only the worker holding the latest
+    claim of a task can store its result.
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS enrichment_jobs (
+            job_id TEXT PRIMARY KEY,
+            search_string TEXT NOT NULL,
+            user_id TEXT,
+            total INTEGER NOT NULL,
+            created_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS enrichment_tasks (
+            job_id TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            bucket_index INTEGER NOT NULL,
+            document_index INTEGER NOT NULL,
+            chunk_id TEXT,
+            document TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            summary TEXT,
+            label TEXT,
+            error TEXT,
+            claimed_at REAL,
+            claim_token TEXT,
+            completed_seq INTEGER,
+            PRIMARY KEY (job_id, position)
+        );
+        CREATE INDEX IF NOT EXISTS ix_enrichment_tasks_status
+            ON enrichment_tasks (status, claimed_at);
+    """
+
+    def __init__(self, path=None):
+        super().__init__(path or local_storage_path(ENRICHMENT_JOBS_FILE))
+        self.task_available = threading.Event()
+
+    def create_job(self, objects, search_string, user_id=None):
+        """Creates a job for the documents on a timeline that should be enriched
+
+        :param objects: The timeline as returned by `ChunkSearchingClass.search_documents`
+        :param search_string: The theme that was searched for
+        :param user_id: The user that started the search, only this user can read the job
+
+        :returns: The identifier of the job
+        :rtype: str
+        """
+
+        job_id = uuid.uuid4().hex
+        selected = DocumentEnrichmentClass.select_documents(objects)
+
+        with self.lock:
+            connection = self.connection()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                connection.execute(
+                    "INSERT INTO enrichment_jobs (job_id, search_string, user_id, total, created_at) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (job_id, search_string, None if user_id is None else str(user_id), len(selected), time.time()),
+                )
+                connection.executemany(
+                    "INSERT INTO enrichment_tasks "
+                    "(job_id, position, bucket_index, document_index, chunk_id, document) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    [
+                        (
+                            job_id,
+                            position,
+                            bucket_index,
+                            document_index,
+                            doc.get("chunk_id"),
+                            json.dumps(
+                                {
+                                    "chunk_id": doc.get("chunk_id"),
+                                    "document_title": doc.get("document_title"),
+                                    "content_text": doc.get("content_text"),
+                                }
+                            ),
+                        )
+                        for position, (bucket_index, document_index, doc) in enumerate(selected)
+                    ],
+                )
+                connection.execute("COMMIT")
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+
+        self.task_available.set()
+
+        return job_id
+
+    def claim_task(self):
+        """Claims the oldest task that is pending or whose worker timed out
+
+        :returns: The claimed task with its `claim_token`, or None when the queue is empty
+        :rtype: dict
+        """
+
+        now = time.time()
+        claim_token = uuid.uuid4().hex
+
+        with self.lock:
+            connection = self.connection()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = connection.execute(
+                    "SELECT t.job_id, t.position, t.document, j.search_string "
+                    "FROM enrichment_tasks t JOIN enrichment_jobs j ON j.job_id = t.job_id "
+                    "WHERE t.status = 'pending' OR (t.status = 'running' AND t.claimed_at < ?) "
+                    "ORDER BY j.created_at, t.position LIMIT 1",
+                    (now - ENRICHMENT_TASK_TIMEOUT_SECONDS,),
+                ).fetchone()
+                if row is not None:
+                    connection.execute(
+                        "UPDATE enrichment_tasks SET status = 'running', claimed_at = ?, claim_token = ? "
+                        "WHERE job_id = ? AND position = ?",
+                        (now, claim_token, row[0], row[1]),
+                    )
+                connection.execute("COMMIT")
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+
+        if row is None:
+            return None
+
+        return {
+            "job_id": row[0],
+            "position": row[1],
+            "document": json.loads(row[2]),
+            "search_string": row[3],
+            "claim_token": claim_token,
+        }
+
+    def finish_task(self, job_id, position, claim_token, summary=None, label=None, error=None):
+        """Stores the result of a task and gives it the next completion number of its job
+
+        The result is only stored while the task is still claimed with
+        `claim_token`. A worker whose task timed out and was claimed again, or
+        was already finished by the new claim, does not add a second item.
+
+        :returns: Whether the result was stored
+        :rtype: bool
+        """
+
+        with self.lock:
+            cursor = self.connection().execute(
+                "UPDATE enrichment_tasks SET status = ?, summary = ?, label = ?, error = ?, "
+                "completed_seq = (SELECT COALESCE(MAX(completed_seq), 0) + 1 "
+                "FROM enrichment_tasks WHERE job_id = ?) "
+                "WHERE job_id = ? AND position = ? AND status = 'running' AND claim_token = ?",
+                ("failed" if error else "done", summary, label, error, job_id, job_id, position, claim_token),
+            )
+
+        return cursor.rowcount == 1
+
+    def get_job(self, job_id, since=0, user_id=None):
+        """Retrieves the progress of a job and the items finished after `since`
+
+        :param job_id: The identifier of the job
+        :param since: The `next_since` value of the previous poll, 0 for all finished items
+        :param user_id: The user that requests the job, None skips the ownership check
+
+        :returns: The job, or None when it does not exist or was created by another user
+        :rtype: dict
+        """
+
+        with self.lock:
+            connection = self.connection()
+            job = connection.execute(
+                "SELECT total, user_id FROM enrichment_jobs WHERE job_id = ?", (job_id,)
+            ).fetchone()
+            if job is None or (user_id is not None and job[1] != str(user_id)):
+                return None
+
+            finished = connection.execute(
+                "SELECT COUNT(*) FROM enrichment_tasks "
+                "WHERE job_id = ? AND status IN ('done', 'failed')",
+                (job_id,),
+            ).fetchone()[0]
+            rows = connection.execute(
+                "SELECT bucket_index, document_index, chunk_id, status, summary, label, completed_seq "
+                "FROM enrichment_tasks WHERE job_id = ? AND completed_seq > ? "
+                "ORDER BY completed_seq",
+                (job_id, since),
+            ).fetchall()
+
+        return {
+            "job_id": job_id,
+            "status": "done" if finished >= job[0] else "running",
+            "total": job[0],
+            "completed": finished,
+            "next_since": rows[-1][6] if rows else since,
+            "items": [
+                {
+                    "bucket_index": row[0],
+                    "document_index": row[1],
+                    "chunk_id": row[2],
+                    "status": row[3],
+                    "summary": row[4],
+                    "label": row[5],
+                }
+                for row in rows
+            ],
+        }
+
+    def purge(self):
+        """Removes jobs older than the job TTL, with their tasks"""
+
+        with self.lock:
+            connection = self.connection()
+            expired = time.time() - ENRICHMENT_JOB_TTL_SECONDS
+            connection.execute(
+                "DELETE FROM enrichment_tasks WHERE job_id IN "
+                "(SELECT job_id FROM enrichment_jobs WHERE created_at < ?)",
+                (expired,),
+            )
+            connection.execute("DELETE FROM enrichment_jobs WHERE created_at < ?", (expired,))
+
+
+class EnrichmentWorkerPool:
+    """Pool of background threads that process the tasks in an `EnrichmentJobQueue`"""
+
+    def __init__(self, queue, workers=None):
+        """Initializes an `EnrichmentWorkerPool` object
+
+        :param queue: The `EnrichmentJobQueue` to process
+        :param workers: The number of worker threads
+        """
+
+        self.queue = queue
+        self.workers = ENRICHMENT_JOB_WORKERS if workers is None else workers
+        self.lock = threading.Lock()
+        self._pid = None
+
+    def ensure_started(self):
+        """Starts the worker threads of the current process if they are not running yet"""
+
+        if self._pid == os.getpid() or self.workers <= 0:
+            return
+
+        with self.lock:
+            if self._pid == os.getpid():
+                return
+
+            for number in range(self.workers):
+                threading.Thread(
+                    target=self.run, name=f"enrichment-worker-{number}", daemon=True
+                ).start()
+            self._pid = os.getpid()
+
+    def run(self):
+        """Processes tasks until the process exits"""
+
+        enrichment = DocumentEnrichmentClass(priority="background", endpoint="enrichment_jobs")
+        last_purge = 0
+
+        while True:
+            try:
+                task = self.queue.claim_task()
+            except Exception as e:
+                print(f"Failed to claim an enrichment task: {str(e)}")
+                task = None
+
+            if task is None:
+                if time.time() - last_purge > ENRICHMENT_JOB_TTL_SECONDS:
+                    try:
+                        self.queue.purge()
+                    except Exception as e:
+                        print(f"Failed to purge the enrichment jobs: {str(e)}")
+                    last_purge = time.time()
+                self.queue.task_available.wait(ENRICHMENT_WORKER_POLL_INTERVAL)
+                self.queue.task_available.clear()
+                continue
+
+            try:
+                summary, label = enrichment.enrich_document(task["document"], task["search_string"])
+                self.queue.finish_task(task["job_id"], task["position"], task["claim_token"], summary, label)
+            except Exception as e:
+                print(f"Failed to enrich chunk {task['document'].get('chunk_id')}: {str(e)}")
+                try:
+                    self.queue.finish_task(task["job_id"], task["position"], task["claim_token"], error=str(e))
+                except Exception as e:
+                    print(f"Failed to store the failed enrichment task: {str(e)}")
+
+
+ENRICHMENT_JOB_QUEUE = EnrichmentJobQueue()
+ENRICHMENT_WORKER_POOL = EnrichmentWorkerPool(ENRICHMENT_JOB_QUEUE)
+
+
+if __name__ == "__main__":
+    # Runs a standalone worker: python -m resources.resource_classes.cl_enrichment_jobs [workers]
+    import sys
+
+    EnrichmentWorkerPool(
+        ENRICHMENT_JOB_QUEUE, int(sys.argv[1]) if len(sys.argv) > 1 else max(ENRICHMENT_JOB_WORKERS, 1)
+    ).ensure_started()
+    while True:
+        time.sleep(3600)
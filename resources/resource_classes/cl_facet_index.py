@@ -0,0 +1,243 @@
+"""Facet counts for the publisher and type filters, served from an in-process index"""
+
+import os
+import threading
+import time
+from dotenv import load_dotenv
+
+load_dotenv()
+
+FACET_INDEX_ENABLED = os.getenv("FACET_INDEX_ENABLED", "false").lower() == "true"
+# Seconds after which the index is rebuilt from the search index, to pick up writes from elsewhere
+FACET_INDEX_REFRESH_SECONDS = int(os.getenv("FACET_INDEX_REFRESH_SECONDS", "3600"))
+
+# Seconds after a failed build before the next one is started
+FACET_INDEX_RETRY_SECONDS = 60
+
+FACET_FIELDS = ["type_primary", "type_secondary", "publisher"]
+
+
+class FacetIndex:
+    """Counts the documents per facet value within a set of documents
+
+    Every document gets an ordinal, and every facet value a bitmap (a Python
+    integer) with a bit set for each document that has the value. The counts
+    for a result set are the population counts of the value bitmaps intersected
+    with the bitmap of the result documents. The index is maintained per chunk,
+    so updating a single chunk changes the bitmaps without a rebuild.
+
+    A rebuild reads the chunks into a fresh index while this one keeps serving
+    the counts. Chunk updates that arrive in the meantime are replayed on the
+    fresh index before it replaces the current bitmaps.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.document_ordinals = {}
+        # {facet: {value: bitmap}}
+        self.bitmaps = {facet: {} for facet in FACET_FIELDS}
+        # {(facet, value, ordinal): number of chunks of the document with the value}
+        self.chunk_counts = {}
+        # {chunk_id: (ordinal, {facet: value})}
+        self.chunks = {}
+        self.built_at = None
+        self.failed_at = None
+        # The chunk updates made while a rebuild runs, None when no rebuild runs
+        self.pending_updates = None
+
+    def __len__(self):
+        return len(self.document_ordinals)
+
+    def _ordinal(self, document_id):
+        ordinal = self.document_ordinals.get(document_id)
+        if ordinal is None:
+            ordinal = len(self.document_ordinals)
+            self.document_ordinals[document_id] = ordinal
+
+        return ordinal
+
+    def _add(self, facet, value, ordinal):
+        key = (facet, value, ordinal)
+        self.chunk_counts[key] = self.chunk_counts.get(key, 0) + 1
+        if self.chunk_counts[key] == 1:
+            self.bitmaps[facet][value] = self.bitmaps[facet].get(value, 0) | (1 << ordinal)
+
+    def _remove(self, facet, value, ordinal):
+        key = (facet, value, ordinal)
+        self.chunk_counts[key] -= 1
+        if self.chunk_counts[key] == 0:
+            del self.chunk_counts[key]
+            bitmap = self.bitmaps[facet][value] & ~(1 << ordinal)
+            if bitmap:
+                self.bitmaps[facet][value] = bitmap
+            else:
+                del self.bitmaps[facet][value]
+
+    def update_chunk(self, chunk_id, source):
+        """Adds a chunk to the index, or applies the changed fields of an indexed chunk
+
+        :param chunk_id: The identifier of the chunk
+        :param source: The (partial) source of the chunk
+        """
+
+        with self.lock:
+            if self.pending_updates is not None:
+                self.pending_updates.append((chunk_id, source))
+
+            previous_ordinal, previous_values = self.chunks.get(chunk_id, (None, {}))
+
+            document_id = source.get("document_id")
+            if document_id is None and previous_ordinal is None:
+                return
+            ordinal = self._ordinal(document_id) if document_id is not None else previous_ordinal
+
+            values = dict(previous_values)
+            for facet in FACET_FIELDS:
+                if facet in source:
+                    values[facet] = source[facet]
+
+            for facet, value in previous_values.items():
+                if value:
+                    self._remove(facet, value, previous_ordinal)
+            for facet, value in values.items():
+                if value:
+                    self._add(facet, value, ordinal)
+
+            self.chunks[chunk_id] = (ordinal, values)
+
+    def build(self, backend, index="es_hackethon"):
+        """Rebuilds the index from all chunks in a search index
+
+        :param backend: The `SearchBackend` to read the chunks from
+        :param index: The index to read the chunks from
+        """
+
+        with self.lock:
+            self.pending_updates = []
+
+        fresh = FacetIndex()
+        try:
+            for hit in backend.scan(
+                index,
+                {
+                    "query": {"match_all": {}},
+                    "_source": ["chunk_id", "document_id"] + FACET_FIELDS,
+                },
+            ):
+                source = hit["_source"]
+                fresh.update_chunk(source.get("chunk_id", hit["_id"]), source)
+        except Exception:
+            with self.lock:
+                self.pending_updates = None
+                self.failed_at = time.monotonic()
+            raise
+
+        with self.lock:
+            # The scan may have read a chunk before it was updated
+            for chunk_id, source in self.pending_updates:
+                fresh.update_chunk(chunk_id, source)
+            self.pending_updates = None
+            self.document_ordinals = fresh.document_ordinals
+            self.bitmaps = fresh.bitmaps
+            self.chunk_counts = fresh.chunk_counts
+            self.chunks = fresh.chunks
+            self.built_at = time.monotonic()
+
+    def is_stale(self):
+        """Tells if the index was never built or is due for a refresh"""
+
+        return self.built_at is None or time.monotonic() - self.built_at > FACET_INDEX_REFRESH_SECONDS
+
+    def may_build(self):
+        """Tells if a stale index may be rebuilt, which waits a while after a failed build"""
+
+        return self.failed_at is None or time.monotonic() - self.failed_at > FACET_INDEX_RETRY_SECONDS
+
+    def counts(self, document_ids):
+        """Counts the documents per facet value within a set of documents
+
+        :param document_ids: The identifiers of the documents in the result set
+
+        :returns: The filters in the format of `ChunkSearchingClass.parse_facets`
+        :rtype: dict
+        """
+
+        with self.lock:
+            result = 0
+            for document_id in set(document_ids):
+                ordinal = self.document_ordinals.get(document_id)
+                if ordinal is not None:
+                    result |= 1 << ordinal
+
+            filters = {}
+            for facet in FACET_FIELDS:
+                counts = []
+                for value, bitmap in self.bitmaps[facet].items():
+                    count = (bitmap & result).bit_count()
+                    if count:
+                        counts.append((value, count))
+                # Same order as a terms aggregation: most documents first, then by value
+                counts.sort(key=lambda item: (-item[1], item[0]))
+                filters[facet] = [
+                    {facet: value, "amount_of_docs": count} for value, count in counts
+                ]
+
+        return filters
+
+
+_FACET_INDEX = FacetIndex() if FACET_INDEX_ENABLED else None
+_FACET_INDEX_BUILD_LOCK = threading.Lock()
+
+
+def _build_facet_index(backend):
+    try:
+        _FACET_INDEX.build(backend)
+    except Exception as e:
+        print(f"Failed to build the facet index: {str(e)}")
+    finally:
+        _FACET_INDEX_BUILD_LOCK.release()
+
+
+def _reset_facet_index_build():
+    """Forgets a build that was running in the parent when this process was forked"""
+
+    global _FACET_INDEX_BUILD_LOCK
+
+    _FACET_INDEX_BUILD_LOCK = threading.Lock()
+    _FACET_INDEX.lock = threading.RLock()
+    _FACET_INDEX.pending_updates = None
+
+
+if _FACET_INDEX is not None and hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_facet_index_build)
+
+
+def get_facet_index(backend):
+    """Returns the process-wide facet index, rebuilding it in the background when it is stale
+
+    The previous index keeps serving the counts during a rebuild. Before the
+    first build has finished there is no index, and the facets are aggregated
+    by the search backend instead.
+
+    :param backend: The `SearchBackend` to build the index from
+
+    :returns: The `FacetIndex`, or None when the facet index is disabled or not built yet
+    :rtype: `FacetIndex`
+    """
+
+    if _FACET_INDEX is None:
+        return None
+
+    if _FACET_INDEX.is_stale() and _FACET_INDEX.may_build() and _FACET_INDEX_BUILD_LOCK.acquire(blocking=False):
+        threading.Thread(
+            target=_build_facet_index, args=(backend,), name="facet-index-build", daemon=True
+        ).start()
+
+    return _FACET_INDEX if _FACET_INDEX.built_at is not None else None
+
+
+def update_facet_index(chunk_id, source):
+    """Applies a chunk update to the facet index, if it is enabled and built or being built"""
+
+    if _FACET_INDEX is not None and (_FACET_INDEX.built_at is not None or _FACET_INDEX.pending_updates is not None):
+        _FACET_INDEX.update_chunk(chunk_id, source)
@@ -0,0 +1,304 @@
+"""In-process latency, token and cost metrics of the Mistral calls"""
+
+import bisect
+import json
+import os
+import random
+import threading
+import time
+from collections import deque
+from dotenv import load_dotenv
+from flask import has_request_context, request
+
+load_dotenv()
+
+LLM_METRICS_ENABLED = os.getenv("LLM_METRICS_ENABLED", "true").lower() == "true"
+# Share of the calls that is recorded, e.g. 0.1 on a busy deployment
+LLM_METRICS_SAMPLE_RATE = float(os.getenv("LLM_METRICS_SAMPLE_RATE", "1.0"))
+# Sample rates per purpose that override LLM_METRICS_SAMPLE_RATE, e.g. "embedding=0.1,label=0.5"
+LLM_METRICS_SAMPLE_RATES = {
+    purpose.strip(): float(rate)
+    for purpose, _, rate in (
+        item.partition("=") for item in os.getenv("LLM_METRICS_SAMPLE_RATES", "").split(",") if "=" in item
+    )
+}
+# Number of recent latencies per series that the percentiles are computed from
+LLM_METRICS_WINDOW = int(os.getenv("LLM_METRICS_WINDOW", "512"))
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, float("inf")]
+
+# USD per million (prompt, completion) tokens, overridable with MISTRAL_PRICES as JSON
+MISTRAL_PRICES = {
+    "mistral-embed": (0.1, 0.0),
+    "ministral-3b-latest": (0.04, 0.04),
+    "ministral-8b-latest": (0.1, 0.1),
+    "mistral-small-latest": (0.2, 0.6),
+    "mistral-medium-latest": (0.4, 2.0),
+    "mistral-large-latest": (2.0, 6.0),
+}
+MISTRAL_PRICES.update({model: tuple(price) for model, price in json.loads(os.getenv("MISTRAL_PRICES", "{}")).items()})
+
+
+def current_endpoint():
+    """Returns the route of the current request, which the calls made for it are attributed to
+
+    :returns: The URL rule, e.g. "/search_theme", or "background" outside a request
+    :rtype: str
+    """
+
+    if has_request_context():
+        return request.url_rule.rule if request.url_rule is not None else request.path
+
+    return "background"
+
+
+def _quantile(values, quantile):
+    """Returns a quantile of a sorted list, interpolating between the nearest values"""
+
+    if not values:
+        return None
+
+    position = (len(values) - 1) * quantile
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+class LLMMetrics:
+    """Aggregates the Mistral calls of this process per endpoint, purpose and model
+
+    Every series keeps counters, a latency histogram with fixed buckets and a
+    window of recent latencies for the percentiles. Sampled calls are recorded
+    with the inverse of their sample rate as weight, so the counters and token
+    totals remain estimates of the full traffic.
+    """
+
+    def __init__(self, sample_rate=None, sample_rates=None, window=None):
+        """Initializes an `LLMMetrics` object
+
+        :param sample_rate: The share of the calls that is recorded
+        :param sample_rates: Sample rates per purpose that override `sample_rate`
+        :param window: The number of recent latencies kept per series
+        """
+
+        self.sample_rate = LLM_METRICS_SAMPLE_RATE if sample_rate is None else sample_rate
+        self.sample_rates = LLM_METRICS_SAMPLE_RATES if sample_rates is None else sample_rates
+        self.window = window or LLM_METRICS_WINDOW
+        self.lock = threading.Lock()
+        self.series = {}
+        self.context_packing = {}
+        self.search_branches = {}
+        self.started_at = time.time()
+
+    def sample_weight(self, purpose):
+        """Decides if a call is recorded
+
+        :returns: 0 when the call is skipped, otherwise the weight of its record
+        :rtype: float
+        """
+
+        rate = self.sample_rates.get(purpose, self.sample_rate)
+        if rate >= 1:
+            return 1.0
+        if rate <= 0 or random.random() >= rate:
+            return 0.0
+
+        return 1 / rate
+
+    def _series(self, endpoint, purpose, model):
+        key = (endpoint or "background", purpose or "completion", model or "unknown")
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = {
+                "calls": 0.0,
+                "errors": 0.0,
+                "retries": 0.0,
+                "prompt_tokens": 0.0,
+                "completion_tokens": 0.0,
+                "cost_usd": 0.0,
+                "latency_sum": 0.0,
+                "total_latency_sum": 0.0,
+                "buckets": [0.0] * len(LATENCY_BUCKETS),
+                "recent": deque(maxlen=self.window),
+                "errors_by_type": {},
+            }
+
+        return series
+
+    def _add_usage(self, series, model, usage, weight):
+        prompt_tokens = getattr(usage, "prompt_tokens", None) or 0
+        completion_tokens = getattr(usage, "completion_tokens", None) or 0
+        prompt_price, completion_price = MISTRAL_PRICES.get(model, (0.0, 0.0))
+
+        series["prompt_tokens"] += prompt_tokens * weight
+        series["completion_tokens"] += completion_tokens * weight
+        series["cost_usd"] += (prompt_tokens * prompt_price + completion_tokens * completion_price) * weight / 1e6
+
+    def record(
+        self, model, purpose, endpoint, latency, total_latency, retries, usage=None, error=None, weight=1.0
+    ):
+        """Records a finished call
+
+        :param model: The model of the call
+        :param purpose: What the call was for, e.g. "embedding", "summary", "label", "chat" or "completion"
+        :param endpoint: The route the call was made for, see `current_endpoint`
+        :param latency: Seconds of the last attempt; for a stream, until the stream opened
+        :param total_latency: Seconds including the rate limit waits, the failed attempts and the backoff
+        :param retries: The number of failed attempts before the last one
+        :param usage: The `usage` of the response, with the prompt and completion tokens
+        :param error: The exception of a call that failed for good
+        :param weight: The weight returned by `sample_weight`
+        """
+
+        with self.lock:
+            series = self._series(endpoint, purpose, model)
+            series["calls"] += weight
+            series["retries"] += retries * weight
+            series["latency_sum"] += latency * weight
+            series["total_latency_sum"] += total_latency * weight
+            series["buckets"][bisect.bisect_left(LATENCY_BUCKETS, latency)] += weight
+            if error is None:
+                series["recent"].append(latency)
+            else:
+                series["errors"] += weight
+                error_type = type(error).__name__
+                series["errors_by_type"][error_type] = series["errors_by_type"].get(error_type, 0.0) + weight
+            if usage is not None:
+                self._add_usage(series, model, usage, weight)
+
+    def record_usage(self, model, purpose, endpoint, usage, weight=1.0):
+        """Adds the tokens of a call whose usage only became known later, e.g. at the end of a stream"""
+
+        if usage is None:
+            return
+
+        with self.lock:
+            self._add_usage(self._series(endpoint, purpose, model), model, usage, weight)
+
+    def record_context_packing(self, purpose, original_tokens, packed_tokens):
+        """Records the estimated prompt tokens before and after packing the context of a prompt
+
+        :param purpose: The prompt the context is for, e.g. "chat" or "summary"
+        :param original_tokens: The tokens of the retrieved texts
+        :param packed_tokens: The tokens of the packed context
+        """
+
+        with self.lock:
+            stats = self.context_packing.setdefault(
+                purpose, {"prompts": 0, "original_tokens": 0, "packed_tokens": 0, "saved_tokens": 0}
+            )
+            stats["prompts"] += 1
+            stats["original_tokens"] += original_tokens
+            stats["packed_tokens"] += packed_tokens
+            stats["saved_tokens"] += max(original_tokens - packed_tokens, 0)
+
+    def record_search_branches(self, timings):
+        """Records the latencies of the branches of a multi-search
+
+        :param timings: Milliseconds per branch, as reported by OpenSearch, and the "total" round-trip
+        """
+
+        with self.lock:
+            for branch, took in timings.items():
+                if took is None:
+                    continue
+                stats = self.search_branches.setdefault(branch, {"searches": 0, "total_ms": 0, "max_ms": 0})
+                stats["searches"] += 1
+                stats["total_ms"] += took
+                stats["max_ms"] = max(stats["max_ms"], took)
+
+    def latency_quantile(self, quantile, purpose=None, model=None, min_samples=1):
+        """Returns a percentile of the recent successful latencies, over all matching series
+
+        :param quantile: The quantile, e.g. 0.95
+        :param purpose: Only uses the calls with this purpose
+        :param model: Only uses the calls with this model
+        :param min_samples: The number of recorded calls below which None is returned
+
+        :returns: The latency in seconds, or None with too few recorded calls
+        :rtype: float
+        """
+
+        with self.lock:
+            values = sorted(
+                latency
+                for (_, series_purpose, series_model), series in self.series.items()
+                if purpose in (None, series_purpose) and model in (None, series_model)
+                for latency in series["recent"]
+            )
+
+        if len(values) < max(min_samples, 1):
+            return None
+
+        return _quantile(values, quantile)
+
+    def snapshot(self):
+        """Returns the metrics of this process, one entry per endpoint, purpose and model"""
+
+        with self.lock:
+            series_list = []
+            for (endpoint, purpose, model), series in sorted(self.series.items()):
+                recent = sorted(series["recent"])
+                calls = series["calls"]
+                cumulative = 0.0
+                buckets = []
+                for bound, count in zip(LATENCY_BUCKETS, series["buckets"]):
+                    cumulative += count
+                    buckets.append({"le": "+Inf" if bound == float("inf") else bound, "count": round(cumulative, 2)})
+
+                series_list.append(
+                    {
+                        "endpoint": endpoint,
+                        "purpose": purpose,
+                        "model": model,
+                        "calls": round(calls, 2),
+                        "errors": round(series["errors"], 2),
+                        "errors_by_type": {name: round(count, 2) for name, count in series["errors_by_type"].items()},
+                        "retries": round(series["retries"], 2),
+                        "prompt_tokens": round(series["prompt_tokens"]),
+                        "completion_tokens": round(series["completion_tokens"]),
+                        "cost_usd": round(series["cost_usd"], 6),
+                        "latency": {
+                            "mean": series["latency_sum"] / calls if calls else None,
+                            "mean_total": series["total_latency_sum"] / calls if calls else None,
+                            "p50": _quantile(recent, 0.5),
+                            "p95": _quantile(recent, 0.95),
+                            "p99": _quantile(recent, 0.99),
+                            "buckets": buckets,
+                        },
+                    }
+                )
+
+        return {
+            "pid": os.getpid(),
+            "since": self.started_at,
+            "sample_rate": self.sample_rate,
+            "sample_rates": self.sample_rates,
+            "series": series_list,
+            "context_packing": {purpose: dict(stats) for purpose, stats in sorted(self.context_packing.items())},
+            "search_branches": {
+                branch: {
+                    "searches": stats["searches"],
+                    "mean_ms": stats["total_ms"] / stats["searches"],
+                    "max_ms": stats["max_ms"],
+                }
+                for branch, stats in sorted(self.search_branches.items())
+            },
+        }
+
+    def reset(self):
+        """Drops all recorded calls, e.g. in a freshly forked child that should not report its parent's calls"""
+
+        self.lock = threading.Lock()
+        self.series = {}
+        self.context_packing = {}
+        self.search_branches = {}
+        self.started_at = time.time()
+
+
+LLM_METRICS = LLMMetrics() if LLM_METRICS_ENABLED else None
+
+if LLM_METRICS is not None and hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=LLM_METRICS.reset)
@@ -0,0 +1,109 @@
+"""Helpers for the local SQLite stores that live next to `project.db`"""
+
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+from dotenv import load_dotenv
+
+load_dotenv()
+
+LOCAL_STORAGE_PATH = os.getenv(
+    "LOCAL_STORAGE_PATH",
+    os.path.join(
+        os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+        "instance",
+    ),
+)
+
+
+def local_storage_path(filename):
+    """Returns the absolute path of a file in the local storage folder
+
+    :param filename: The name of the file inside the local storage folder
+
+    :returns: The absolute path of the file
+    :rtype: str
+    """
+
+    if not os.path.exists(LOCAL_STORAGE_PATH):
+        os.makedirs(LOCAL_STORAGE_PATH, exist_ok=True)
+
+    return os.path.join(LOCAL_STORAGE_PATH, filename)
+
+
+def sqlite_connection(path):
+    """Opens a SQLite connection that can be shared safely by gunicorn workers
+
+    The database runs in WAL mode so readers in other processes are not blocked
+    by a writer, and waits for locks instead of failing straight away.
+
+    :param path: The path of the SQLite database file
+
+    :returns: An open connection in autocommit mode
+    :rtype: sqlite3.Connection
+    """
+
+    connection = sqlite3.connect(
+        path, timeout=30, isolation_level=None, check_same_thread=False
+    )
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+
+    return connection
+
+
+class LocalSQLiteStore:
+    """Base class for a store backed by a local SQLite database
+
+    Every process opens its own connection, so a store created before a gunicorn
+    fork reconnects in the worker. Access to the connection is serialized per process.
+    """
+
+    schema = ""
+
+    def __init__(self, path):
+        """Initializes a `LocalSQLiteStore` object
+
+        :param path: The path of the SQLite database file
+        """
+
+        self.path = path
+        self.lock = threading.RLock()
+        self._connection = None
+        self._pid = None
+
+    def connection(self):
+        """Returns the connection of the current process, creating the schema if needed"""
+
+        if self._connection is None or self._pid != os.getpid():
+            self._connection = sqlite_connection(self.path)
+            self._connection.executescript(self.schema)
+            self._pid = os.getpid()
+
+        return self._connection
+
+
+def normalize_cache_text(text):
+    """Normalizes text before it is used as (part of) a cache key
+
+    :param text: The text to normalize
+
+    :returns: The lowercased text with collapsed whitespace
+    :rtype: str
+    """
+
+    return re.sub(r"\s+", " ", text or "").strip().lower()
+
+
+def cache_key(*parts):
+    """Builds a fixed length cache key from its parts
+
+    :param parts: The strings that together identify a cache entry
+
+    :returns: A hex encoded SHA-256 digest
+    :rtype: str
+    """
+
+    return hashlib.sha256("\0".join(str(part) for part in parts).encode("utf-8")).hexdigest()
@@ -6,6 +6,11 @@ from datetime import timedelta
 from db import db
 from elasticsearch import Elasticsearch
 import certifi
+from resources.resource_classes.cl_search_backend import (
+    OpenSearchBackend,
+    get_search_backend,
+    register_search_backend,
+)
 
 
 class LoginRequirements:
@@ -39,15 +44,24 @@ class LoginRequirements:
         return {k: v for k, v in checks.items() if not v["passed"]}
 
 
-class LastLogin:
+def _opportunities_backend():
+    """Creates the backend for the cluster that holds the opportunities"""
 
-    esConnection = Elasticsearch(
-        "https://be00d451564e4a808d79d7e5f061760a.westeurope.azure.elastic-cloud.com:9243",
-        basic_auth=("elastic", "exBpmFlMVnuZNItT9MuPPcHD"),
-        ca_certs=certifi.where(),
-        request_timeout=900,
+    return OpenSearchBackend(
+        Elasticsearch(
+            "https://be00d451564e4a808d79d7e5f061760a.westeurope.azure.elastic-cloud.com:9243",
+            basic_auth=("elastic", "exBpmFlMVnuZNItT9MuPPcHD"),
+            ca_certs=certifi.where(),
+            request_timeout=900,
+        )
     )
 
+
+register_search_backend("opportunities", _opportunities_backend)
+
+
+class LastLogin:
+
     @staticmethod
     def is_longer_than_7_days_ago(last_login_date):
         """Checks if the last_login date is greater than 7 days ago"""
@@ -89,10 +103,12 @@ class LastLogin:
                     ]
                 }
             }
-            result = LastLogin.esConnection.search(
-                index="es_opportunities",
-                query=query,
-                size=1000,  # Adjust this value based on your needs
+            result = get_search_backend("opportunities").search(
+                "es_opportunities",
+                {
+                    "query": query,
+                    "size": 1000,  # Adjust this value based on your needs
+                },
             )
 
             count = result["hits"]["total"]["value"]
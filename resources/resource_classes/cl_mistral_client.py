@@ -0,0 +1,196 @@
+"""Process-wide Mistral client that reuses its HTTP connections"""
+
+import asyncio
+import os
+import threading
+import httpx
+from mistralai import Mistral
+from dotenv import load_dotenv
+
+load_dotenv()
+
+MISTRAL_API_KEY = os.environ["MISTRAL_API_KEY"]
+# Points the clients at another server, e.g. the mock server in benchmarks.mock_mistral_server
+MISTRAL_SERVER_URL = os.getenv("MISTRAL_SERVER_URL") or None
+MISTRAL_MAX_CONNECTIONS = int(os.getenv("MISTRAL_MAX_CONNECTIONS", "20"))
+MISTRAL_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("MISTRAL_MAX_KEEPALIVE_CONNECTIONS", "10"))
+MISTRAL_KEEPALIVE_EXPIRY_SECONDS = float(os.getenv("MISTRAL_KEEPALIVE_EXPIRY_SECONDS", "60"))
+MISTRAL_CONNECT_TIMEOUT_SECONDS = float(os.getenv("MISTRAL_CONNECT_TIMEOUT_SECONDS", "5"))
+MISTRAL_READ_TIMEOUT_SECONDS = float(os.getenv("MISTRAL_READ_TIMEOUT_SECONDS", "60"))
+MISTRAL_POOL_TIMEOUT_SECONDS = float(os.getenv("MISTRAL_POOL_TIMEOUT_SECONDS", "10"))
+# Maximum number of concurrent calls on the event loop of the async classes
+MISTRAL_ASYNC_MAX_IN_FLIGHT = int(os.getenv("MISTRAL_ASYNC_MAX_IN_FLIGHT", "200"))
+
+
+class MistralClientManager:
+    """Hands out one `Mistral` client per process, backed by a pooled HTTP client
+
+    The underlying `httpx.Client` keeps connections alive between calls, so
+    only the first call of a process pays for the TLS handshake. The client is
+    thread-safe. A client inherited through a gunicorn fork is never used,
+    because its sockets are shared with the parent; the child builds its own.
+
+    Async calls share a single event loop per process with their own pooled
+    `httpx.AsyncClient`, since an async client cannot move between loops.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._client = None
+        self._http_client = None
+        self._pid = None
+        self._loop = None
+        self._loop_pid = None
+        self._async_client = None
+        self._async_semaphore = None
+
+    @staticmethod
+    def build_http_client(client_class=httpx.Client, max_connections=None):
+        """Builds the pooled HTTP client with the configured limits and timeouts
+
+        :param client_class: Either `httpx.Client` or `httpx.AsyncClient`
+        :param max_connections: Overrides `MISTRAL_MAX_CONNECTIONS`
+        """
+
+        return client_class(
+            limits=httpx.Limits(
+                max_connections=max_connections or MISTRAL_MAX_CONNECTIONS,
+                max_keepalive_connections=MISTRAL_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=MISTRAL_KEEPALIVE_EXPIRY_SECONDS,
+            ),
+            timeout=httpx.Timeout(
+                MISTRAL_READ_TIMEOUT_SECONDS,
+                connect=MISTRAL_CONNECT_TIMEOUT_SECONDS,
+                pool=MISTRAL_POOL_TIMEOUT_SECONDS,
+            ),
+        )
+
+    def get_client(self):
+        """Returns the `Mistral` client of the current process, building it on first use"""
+
+        if self._client is not None and self._pid == os.getpid():
+            return self._client
+
+        with self.lock:
+            if self._client is None or self._pid != os.getpid():
+                self._http_client = self.build_http_client()
+                self._client = Mistral(
+                    api_key=MISTRAL_API_KEY, client=self._http_client, server_url=MISTRAL_SERVER_URL
+                )
+                self._pid = os.getpid()
+
+        return self._client
+
+    def event_loop(self):
+        """Returns the event loop of the current process on which the async calls run
+
+        The loop runs in a daemon thread, so synchronous code can hand it
+        coroutines with `submit`. Keeping a single loop lets the async HTTP
+        client keep its connections alive between requests.
+        """
+
+        if self._loop is not None and self._loop_pid == os.getpid():
+            return self._loop
+
+        with self.lock:
+            if self._loop is None or self._loop_pid != os.getpid():
+                loop = asyncio.new_event_loop()
+                threading.Thread(
+                    target=loop.run_forever, name="mistral-event-loop", daemon=True
+                ).start()
+                self._loop = loop
+                self._loop_pid = os.getpid()
+                self._async_client = None
+                self._async_semaphore = None
+
+        return self._loop
+
+    def submit(self, coroutine):
+        """Schedules a coroutine on the event loop of the async calls
+
+        :returns: A future that resolves to the result of the coroutine
+        :rtype: `concurrent.futures.Future`
+        """
+
+        return asyncio.run_coroutine_threadsafe(coroutine, self.event_loop())
+
+    def run(self, coroutine):
+        """Runs a coroutine on the event loop of the async calls and waits for its result"""
+
+        return self.submit(coroutine).result()
+
+    def get_async_client(self):
+        """Returns the `Mistral` client for async calls, which must run on `event_loop()`
+
+        :raises RuntimeError: Called outside the event loop of the async calls
+        """
+
+        if asyncio.get_running_loop() is not self.event_loop():
+            raise RuntimeError("Async Mistral calls must run on MISTRAL_CLIENT_MANAGER.event_loop()")
+
+        # Only the loop thread gets here, so no lock is needed
+        if self._async_client is None:
+            self._async_semaphore = asyncio.Semaphore(MISTRAL_ASYNC_MAX_IN_FLIGHT)
+            self._async_client = Mistral(
+                api_key=MISTRAL_API_KEY,
+                server_url=MISTRAL_SERVER_URL,
+                client=self.get_client().sdk_configuration.client,
+                # As many connections as calls in flight, so no call waits for the pool
+                async_client=self.build_http_client(httpx.AsyncClient, MISTRAL_ASYNC_MAX_IN_FLIGHT),
+            )
+
+        return self._async_client
+
+    def async_semaphore(self):
+        """Returns the semaphore that caps the number of concurrent async calls"""
+
+        self.get_async_client()
+
+        return self._async_semaphore
+
+    def reset(self):
+        """Forgets the clients without closing them, e.g. in a freshly forked child"""
+
+        self.lock = threading.Lock()
+        self._client = None
+        self._http_client = None
+        self._pid = None
+        self._loop = None
+        self._loop_pid = None
+        self._async_client = None
+        self._async_semaphore = None
+
+    def close(self):
+        """Closes the connections of the current process"""
+
+        with self.lock:
+            if self._http_client is not None and self._pid == os.getpid():
+                self._http_client.close()
+            self._client = None
+            self._http_client = None
+            self._pid = None
+
+
+MISTRAL_CLIENT_MANAGER = MistralClientManager()
+
+if hasattr(os, "register_at_fork"):
+    # The lock may be held by another thread of the parent at the moment of the fork
+    os.register_at_fork(after_in_child=MISTRAL_CLIENT_MANAGER.reset)
+
+
+def get_mistral_client():
+    """Returns the shared `Mistral` client of the current process"""
+
+    return MISTRAL_CLIENT_MANAGER.get_client()
+
+
+def get_async_mistral_client():
+    """Returns the shared `Mistral` client for async calls on the event loop of the current process"""
+
+    return MISTRAL_CLIENT_MANAGER.get_async_client()
+
+
+def run_async(coroutine):
+    """Runs a coroutine with async Mistral calls from synchronous code and returns its result"""
+
+    return MISTRAL_CLIENT_MANAGER.run(coroutine)
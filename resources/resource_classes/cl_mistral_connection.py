@@ -1,24 +1,73 @@
+import asyncio
 import os
-from mistralai import Mistral, SDKError
 from dotenv import load_dotenv
-import time
+from resources.resource_classes.cl_embedding_cache import EMBEDDING_CACHE
+from resources.resource_classes.cl_mistral_client import (
+    MISTRAL_CLIENT_MANAGER,
+    get_async_mistral_client,
+    get_mistral_client,
+)
+from resources.resource_classes.cl_rate_limiter import call_mistral, call_mistral_async
+from resources.resource_classes.cl_context_packing import estimate_tokens
+from resources.resource_classes.cl_embedding_batcher import EMBEDDING_MICROBATCHER
+from resources.resource_classes.cl_single_flight import single_flight, single_flight_async
+from resources.resource_classes.cl_local_storage import normalize_cache_text
+from resources.resource_classes.cl_llm_metrics import LLM_METRICS, current_endpoint
 load_dotenv()
 
-MISTRAL_API_KEY = os.environ["MISTRAL_API_KEY"]
+MISTRAL_COMPLETION_MODEL = "ministral-3b-latest"
+
+# Tokens reserved for the answer when the token budget of a completion is estimated
+MISTRAL_ESTIMATED_COMPLETION_TOKENS = int(os.getenv("MISTRAL_ESTIMATED_COMPLETION_TOKENS", "300"))
+# Limits of a single embeddings request
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))
+EMBEDDING_BATCH_MAX_TOKENS = int(os.getenv("EMBEDDING_BATCH_MAX_TOKENS", "16000"))
+
+
+def _total_tokens(response):
+    """Reads the total number of used tokens from an API response"""
+
+    usage = getattr(response, "usage", None)
+    return getattr(usage, "total_tokens", None)
+
+
+def _record_stream_usage(model, endpoint, event):
+    """Records the tokens of a streamed chat, which the last event of the stream reports"""
+
+    usage = getattr(event.data, "usage", None)
+    if usage is None or LLM_METRICS is None:
+        return
+
+    weight = LLM_METRICS.sample_weight("chat")
+    if weight:
+        LLM_METRICS.record_usage(model, "chat", endpoint, usage, weight)
+
 
 class CL_Mistral_Embeddings:
     """This class is responsible for generating embeddings using the Mistral API"""
 
-    def __init__(self, model="mistral-embed"):
-        """This is constructor that initializes a CL_Openai_Embeddings object"""
+    def __init__(self, model="mistral-embed", priority="default", endpoint=None):
+        """This is constructor that initializes a CL_Openai_Embeddings object
+
+        :param model: The embedding model
+        :param priority: The rate limit priority class of the calls
+        :param endpoint: The route the calls are attributed to in the metrics, by default the current one
+        """
 
-        self.client = Mistral(api_key=MISTRAL_API_KEY)
+        self.client = get_mistral_client()
         self.model = model
-        
+        self.priority = priority
+        self.endpoint = endpoint or current_endpoint()
+
 
     def generate_embedding(self, input_text):
         """Generates a 1024 dimension embedding over input text
 
+        Embeddings of previously seen texts are served from the embedding cache.
+        Other texts are sent together with the concurrent requests of other
+        threads by the embedding micro-batcher. Concurrent requests for the same
+        text share a single call.
+
         :param input_text: The text used to generate an embedding over
         :returns: Returns a 1024 dimensions embedding
         :rtype: List
@@ -31,161 +80,393 @@ class CL_Mistral_Embeddings:
                 f"Expected the input_text variable to be a string, but got:  {type(input_text)}"
             )
 
-        try:
-            response = self.client.embeddings.create(
-                    model=self.model,
-                    inputs=[input_text],
-            )
-        except SDKError as e:
-            print("Rate limit exceeded.")
-            time.sleep(3)
-            print("Retrying...")
-            response = self.client.embeddings.create(
-                    model=self.model,
-                    inputs=[input_text],
-            )
-        
-        return response.data[0].embedding
+        if EMBEDDING_CACHE is not None:
+            cached = EMBEDDING_CACHE.get(input_text, self.model)
+            if cached is not None:
+                return cached
+
+        def embed():
+            if EMBEDDING_MICROBATCHER is not None:
+                return EMBEDDING_MICROBATCHER.embed(input_text, self.model, self.priority, self.endpoint)
+
+            return self.generate_embeddings([input_text])[0]
+
+        # Identical concurrent requests, also in other workers, share one upstream call
+        return single_flight(("embedding", self.model, normalize_cache_text(input_text)), embed)
+
+    def generate_embeddings(self, input_texts):
+        """Generates the embeddings of several texts in as few API calls as possible
+
+        Cached texts and duplicates are left out of the calls. The remaining
+        texts are split into batches of at most `EMBEDDING_BATCH_SIZE` texts
+        and `EMBEDDING_BATCH_MAX_TOKENS` estimated tokens.
+
+        :param input_texts: The texts to generate embeddings over
+        :returns: The embeddings, in the order of the texts
+        :rtype: list
+        :raises TypeError: Expected every input text to be a string, but got something else
+        """
+
+        for input_text in input_texts:
+            if not isinstance(input_text, str):
+                raise TypeError(
+                    f"Expected the input_text variable to be a string, but got:  {type(input_text)}"
+                )
+
+        embeddings = {}
+        if EMBEDDING_CACHE is not None:
+            for input_text in set(input_texts):
+                cached = EMBEDDING_CACHE.get(input_text, self.model)
+                if cached is not None:
+                    embeddings[input_text] = cached
+
+        missing = list(dict.fromkeys(text for text in input_texts if text not in embeddings))
+
+        batch = []
+        batch_tokens = 0
+        for input_text in missing:
+            tokens = estimate_tokens(input_text)
+            if batch and (len(batch) >= EMBEDDING_BATCH_SIZE or batch_tokens + tokens > EMBEDDING_BATCH_MAX_TOKENS):
+                embeddings.update(self._embed_batch(batch, batch_tokens))
+                batch, batch_tokens = [], 0
+
+            batch.append(input_text)
+            batch_tokens += tokens
+
+        if batch:
+            embeddings.update(self._embed_batch(batch, batch_tokens))
+
+        return [embeddings[input_text] for input_text in input_texts]
+
+    def _embed_batch(self, input_texts, estimated_tokens):
+        """Sends one batch of texts to the embeddings endpoint and caches the results"""
+
+        response = call_mistral(
+            self.client.embeddings.create,
+            estimated_tokens,
+            self.priority,
+            _total_tokens,
+            purpose="embedding",
+            endpoint=self.endpoint,
+            model=self.model,
+            inputs=input_texts,
+        )
+
+        embeddings = {}
+        for position, item in enumerate(response.data):
+            index = item.index if getattr(item, "index", None) is not None else position
+            embeddings[input_texts[index]] = item.embedding
+            if EMBEDDING_CACHE is not None:
+                EMBEDDING_CACHE.set(input_texts[index], self.model, item.embedding)
+
+        return embeddings
 
 class CL_Mistral_Completions:
     """This class is responsible for generating completions using the Mistral API"""
 
-    def __init__(self, model="ministral-3b-latest", temperature=0.7):
-        """This is constructor that initializes a CL_Openai_Embeddings object"""
+    def __init__(self, model=MISTRAL_COMPLETION_MODEL, temperature=0.7, priority="default", endpoint=None):
+        """This is constructor that initializes a CL_Openai_Embeddings object
+
+        :param model: The completion model
+        :param temperature: Sampling temperature
+        :param priority: The rate limit priority class of the calls, e.g. "interactive" for chat
+        :param endpoint: The route the calls are attributed to in the metrics, by default the current one
+        """
 
-        self.client = Mistral(api_key=MISTRAL_API_KEY)
+        self.client = get_mistral_client()
         self.model = model
         self.temperature = temperature
-            
-    def generate_completion(self, prompt):
-        """Generates a text completion for a given prompt using the Mistral completions endpoint.
+        self.priority = priority
+        self.endpoint = endpoint or current_endpoint()
+
+    def _complete(self, prompt, purpose="completion"):
+        """Sends a prompt to the chat completions endpoint within the rate limits
 
         :param prompt: The user prompt to send to the model
-        :param temperature: Sampling temperature
-        :param max_tokens: Maximum number of tokens to generate
-        :returns: Generated completion text
-        :rtype: str
+        :param purpose: What the completion is for in the metrics, e.g. "summary"
         """
 
         if not isinstance(prompt, str):
             raise TypeError(f"Expected prompt to be a string, but got: {type(prompt)}")
 
-        try:
-            response = self.client.chat.complete(
-                model=self.model,
-                messages=[{"role": "user", "content": prompt}],
-                temperature=self.temperature
-            )
-        except SDKError as e:
-            print("Error from SDK:", str(e))
-            time.sleep(3)
-            print("Retrying completion...")
-            response = self.client.chat.complete(
+        def complete():
+            response = call_mistral(
+                self.client.chat.complete,
+                estimate_tokens(prompt) + MISTRAL_ESTIMATED_COMPLETION_TOKENS,
+                self.priority,
+                _total_tokens,
+                purpose=purpose,
+                endpoint=self.endpoint,
                 model=self.model,
                 messages=[{"role": "user", "content": prompt}],
                 temperature=self.temperature
             )
 
-        return response.choices[0].message.content
-    
-    def chat_response(self, prompt):
-            """Generates a text completion for a given prompt using the Mistral completions endpoint.
-
-            :param prompt: The user prompt to send to the model
-            :param temperature: Sampling temperature
-            :param max_tokens: Maximum number of tokens to generate
-            :returns: Generated completion text
-            :rtype: str
-            """
-            print("Prompt: ", prompt)
-            if not isinstance(prompt, str):
-                raise TypeError(f"Expected prompt to be a string, but got: {type(prompt)}")
-
-            try:
-                response = self.client.chat.complete(
-                    model=self.model,
-                    messages=[{"role": "user", "content": prompt}],
-                    temperature=self.temperature,
-                    stream=True
-                )
+            return response.choices[0].message.content
 
-                # Collect the streamed response
-                full_response = ""
-                for chunk in response:
-                    if hasattr(chunk, 'choices') and len(chunk.choices) > 0:
-                        full_response += chunk.choices[0].delta.content
+        # Identical concurrent prompts, also in other workers, share one upstream call
+        return single_flight(
+            ("completion", self.model, self.temperature, normalize_cache_text(prompt)), complete
+        )
 
-                return full_response
-
-            except SDKError as e:
-                print("Error from SDK:", str(e))
-                time.sleep(3)
-                print("Retrying completion...")
-                response = self.client.chat.complete(
-                    model=self.model,
-                    messages=[{"role": "user", "content": prompt}],
-                    temperature=self.temperature
-                )
-
-                return response.choices[0].message.content
-        
-    def generate_summary(self, prompt):
+    def generate_completion(self, prompt):
         """Generates a text completion for a given prompt using the Mistral completions endpoint.
 
         :param prompt: The user prompt to send to the model
-        :param temperature: Sampling temperature
-        :param max_tokens: Maximum number of tokens to generate
         :returns: Generated completion text
         :rtype: str
         """
 
+        return self._complete(prompt)
+
+    def stream_chat(self, prompt):
+        """Streams a chat completion for a given prompt, one delta at a time.
+
+        Opening the stream is retried like any other call, but only as long as
+        nothing has been yielded yet. Errors after the first delta are raised to
+        the caller, who already forwarded part of the answer.
+
+        :param prompt: The user prompt to send to the model
+        :returns: A generator of the text deltas of the completion
+        :rtype: generator
+        """
+
         if not isinstance(prompt, str):
             raise TypeError(f"Expected prompt to be a string, but got: {type(prompt)}")
 
-        try:
-            response = self.client.chat.complete(
-                model=self.model,
-                messages=[{"role": "user", "content": prompt}],
-                temperature=self.temperature
-            )
-        except SDKError as e:
-            print("Error from SDK:", str(e))
-            time.sleep(3)
-            print("Retrying completion...")
-            response = self.client.chat.complete(
-                model=self.model,
-                messages=[{"role": "user", "content": prompt}],
-                temperature=self.temperature
-            )
+        response = call_mistral(
+            self.client.chat.stream,
+            estimate_tokens(prompt) + MISTRAL_ESTIMATED_COMPLETION_TOKENS,
+            self.priority,
+            purpose="chat",
+            endpoint=self.endpoint,
+            model=self.model,
+            messages=[{"role": "user", "content": prompt}],
+            temperature=self.temperature
+        )
+
+        for event in response:
+            _record_stream_usage(self.model, self.endpoint, event)
+            if event.data.choices and event.data.choices[0].delta.content:
+                yield event.data.choices[0].delta.content
+
+    def chat_response(self, prompt):
+        """Generates a text completion for a given prompt using the Mistral completions endpoint.
+
+        :param prompt: The user prompt to send to the model
+        :returns: Generated completion text
+        :rtype: str
+        """
+        print("Prompt: ", prompt)
+
+        return "".join(self.stream_chat(prompt))
+
+    def generate_summary(self, prompt):
+        """Generates a text completion for a given prompt using the Mistral completions endpoint.
+
+        :param prompt: The user prompt to send to the model
+        :returns: Generated completion text
+        :rtype: str
+        """
+
+        return self._complete(prompt, "summary")
 
-        return response.choices[0].message.content
-    
     def categorize_label(self, prompt):
         """Generates a text completion for a given prompt using the Mistral completions endpoint.
 
         :param prompt: The user prompt to send to the model
-        :param temperature: Sampling temperature
-        :param max_tokens: Maximum number of tokens to generate
         :returns: Generated completion text
         :rtype: str
         """
 
-        if not isinstance(prompt, str):
-            raise TypeError(f"Expected prompt to be a string, but got: {type(prompt)}")
+        return self._complete(prompt, "label")
+
+
+class CL_Mistral_Async_Embeddings:
+    """Async counterpart of `CL_Mistral_Embeddings`
+
+    The methods must run on the event loop of `MISTRAL_CLIENT_MANAGER`, e.g.
+    through `run_async`, where they share one pooled async HTTP client.
+    """
+
+    def __init__(self, model="mistral-embed", priority="default", endpoint=None):
+        """This is constructor that initializes a CL_Mistral_Async_Embeddings object
+
+        :param model: The embedding model
+        :param priority: The rate limit priority class of the calls
+        :param endpoint: The route the calls are attributed to in the metrics, by default the current one
+        """
+
+        self.model = model
+        self.priority = priority
+        self.endpoint = endpoint or current_endpoint()
+
+    async def generate_embedding(self, input_text):
+        """Generates a 1024 dimension embedding over input text, see `CL_Mistral_Embeddings.generate_embedding`"""
+
+        if not isinstance(input_text, str):
+            raise TypeError(
+                f"Expected the input_text variable to be a string, but got:  {type(input_text)}"
+            )
+
+        embeddings = await single_flight_async(
+            ("embedding", self.model, normalize_cache_text(input_text)),
+            lambda: self.generate_embeddings([input_text]),
+        )
+
+        return embeddings[0]
+
+    async def generate_embeddings(self, input_texts):
+        """Generates the embeddings of several texts, see `CL_Mistral_Embeddings.generate_embeddings`
+
+        The batches are sent concurrently.
+        """
+
+        for input_text in input_texts:
+            if not isinstance(input_text, str):
+                raise TypeError(
+                    f"Expected the input_text variable to be a string, but got:  {type(input_text)}"
+                )
+
+        embeddings = {}
+        if EMBEDDING_CACHE is not None:
+            for input_text in set(input_texts):
+                cached = EMBEDDING_CACHE.get(input_text, self.model)
+                if cached is not None:
+                    embeddings[input_text] = cached
+
+        missing = list(dict.fromkeys(text for text in input_texts if text not in embeddings))
+
+        batches = []
+        batch = []
+        batch_tokens = 0
+        for input_text in missing:
+            tokens = estimate_tokens(input_text)
+            if batch and (len(batch) >= EMBEDDING_BATCH_SIZE or batch_tokens + tokens > EMBEDDING_BATCH_MAX_TOKENS):
+                batches.append((batch, batch_tokens))
+                batch, batch_tokens = [], 0
+
+            batch.append(input_text)
+            batch_tokens += tokens
+
+        if batch:
+            batches.append((batch, batch_tokens))
+
+        for result in await asyncio.gather(*(self._embed_batch(*batch) for batch in batches)):
+            embeddings.update(result)
 
-        try:
-            response = self.client.chat.complete(
+        return [embeddings[input_text] for input_text in input_texts]
+
+    async def _embed_batch(self, input_texts, estimated_tokens):
+        """Sends one batch of texts to the embeddings endpoint and caches the results"""
+
+        async with MISTRAL_CLIENT_MANAGER.async_semaphore():
+            response = await call_mistral_async(
+                get_async_mistral_client().embeddings.create_async,
+                estimated_tokens,
+                self.priority,
+                _total_tokens,
+                purpose="embedding",
+                endpoint=self.endpoint,
                 model=self.model,
-                messages=[{"role": "user", "content": prompt}],
-                temperature=self.temperature
+                inputs=input_texts,
             )
-        except SDKError as e:
-            print("Error from SDK:", str(e))
-            time.sleep(3)
-            print("Retrying completion...")
-            response = self.client.chat.complete(
+
+        embeddings = {}
+        for position, item in enumerate(response.data):
+            index = item.index if getattr(item, "index", None) is not None else position
+            embeddings[input_texts[index]] = item.embedding
+            if EMBEDDING_CACHE is not None:
+                EMBEDDING_CACHE.set(input_texts[index], self.model, item.embedding)
+
+        return embeddings
+
+
+class CL_Mistral_Async_Completions:
+    """Async counterpart of `CL_Mistral_Completions`
+
+    The methods must run on the event loop of `MISTRAL_CLIENT_MANAGER`, e.g.
+    through `run_async`, where they share one pooled async HTTP client.
+    """
+
+    def __init__(self, model=MISTRAL_COMPLETION_MODEL, temperature=0.7, priority="default", endpoint=None):
+        """This is constructor that initializes a CL_Mistral_Async_Completions object
+
+        :param model: The completion model
+        :param temperature: Sampling temperature
+        :param priority: The rate limit priority class of the calls
+        :param endpoint: The route the calls are attributed to in the metrics, by default the current one
+        """
+
+        self.model = model
+        self.temperature = temperature
+        self.priority = priority
+        self.endpoint = endpoint or current_endpoint()
+
+    async def _complete(self, prompt, purpose="completion"):
+        """Sends a prompt to the chat completions endpoint within the rate limits, see `CL_Mistral_Completions._complete`"""
+
+        if not isinstance(prompt, str):
+            raise TypeError(f"Expected prompt to be a string, but got: {type(prompt)}")
+
+        async def complete():
+            async with MISTRAL_CLIENT_MANAGER.async_semaphore():
+                response = await call_mistral_async(
+                    get_async_mistral_client().chat.complete_async,
+                    estimate_tokens(prompt) + MISTRAL_ESTIMATED_COMPLETION_TOKENS,
+                    self.priority,
+                    _total_tokens,
+                    purpose=purpose,
+                    endpoint=self.endpoint,
+                    model=self.model,
+                    messages=[{"role": "user", "content": prompt}],
+                    temperature=self.temperature
+                )
+
+            return response.choices[0].message.content
+
+        return await single_flight_async(
+            ("completion", self.model, self.temperature, normalize_cache_text(prompt)), complete
+        )
+
+    async def generate_completion(self, prompt):
+        """Generates a text completion for a given prompt, see `CL_Mistral_Completions.generate_completion`"""
+
+        return await self._complete(prompt)
+
+    async def generate_summary(self, prompt):
+        """Generates a summary for a given prompt, see `CL_Mistral_Completions.generate_summary`"""
+
+        return await self._complete(prompt, "summary")
+
+    async def categorize_label(self, prompt):
+        """Generates a label for a given prompt, see `CL_Mistral_Completions.categorize_label`"""
+
+        return await self._complete(prompt, "label")
+
+    async def stream_chat(self, prompt):
+        """Streams a chat completion one delta at a time, see `CL_Mistral_Completions.stream_chat`
+
+        :returns: An async generator of the text deltas of the completion
+        :rtype: async generator
+        """
+
+        if not isinstance(prompt, str):
+            raise TypeError(f"Expected prompt to be a string, but got: {type(prompt)}")
+
+        async with MISTRAL_CLIENT_MANAGER.async_semaphore():
+            response = await call_mistral_async(
+                get_async_mistral_client().chat.stream_async,
+                estimate_tokens(prompt) + MISTRAL_ESTIMATED_COMPLETION_TOKENS,
+                self.priority,
+                purpose="chat",
+                endpoint=self.endpoint,
                 model=self.model,
                 messages=[{"role": "user", "content": prompt}],
                 temperature=self.temperature
             )
-        return response.choices[0].message.content
\ No newline at end of file
+
+            async for event in response:
+                _record_stream_usage(self.model, self.endpoint, event)
+                if event.data.choices and event.data.choices[0].delta.content:
+                    yield event.data.choices[0].delta.content
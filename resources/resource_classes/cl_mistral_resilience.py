@@ -0,0 +1,427 @@
+"""Timeouts, hedged requests and circuit breakers for the Mistral calls"""
+
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, TimeoutError as FutureTimeoutError, wait
+from dotenv import load_dotenv
+from resources.resource_classes.cl_llm_metrics import LLM_METRICS
+
+load_dotenv()
+
+# Seconds a call may take in total, including the waits for capacity and the retries
+MISTRAL_TIMEOUTS = {
+    "embedding": 10.0,
+    "label": 15.0,
+    "summary": 20.0,
+    "completion": 30.0,
+    "chat": 30.0,
+}
+MISTRAL_TIMEOUTS.update(
+    {
+        purpose: float(os.environ[f"MISTRAL_TIMEOUT_{purpose.upper()}_SECONDS"])
+        for purpose in MISTRAL_TIMEOUTS
+        if os.getenv(f"MISTRAL_TIMEOUT_{purpose.upper()}_SECONDS")
+    }
+)
+
+MISTRAL_BREAKER_ENABLED = os.getenv("MISTRAL_BREAKER_ENABLED", "true").lower() == "true"
+# Consecutive failed attempts after which the breaker of a model opens
+MISTRAL_BREAKER_FAILURE_THRESHOLD = int(os.getenv("MISTRAL_BREAKER_FAILURE_THRESHOLD", "5"))
+# Seconds an open breaker rejects calls before it lets a single probe call through
+MISTRAL_BREAKER_RESET_SECONDS = float(os.getenv("MISTRAL_BREAKER_RESET_SECONDS", "30"))
+
+MISTRAL_HEDGING_ENABLED = os.getenv("MISTRAL_HEDGING_ENABLED", "true").lower() == "true"
+# Streams are never hedged, part of the answer may already have been forwarded
+MISTRAL_HEDGE_PURPOSES = set(os.getenv("MISTRAL_HEDGE_PURPOSES", "embedding,summary,label,completion").split(","))
+# The p95 latency is used as the hedge delay once this many calls were recorded
+MISTRAL_HEDGE_MIN_SAMPLES = int(os.getenv("MISTRAL_HEDGE_MIN_SAMPLES", "20"))
+MISTRAL_HEDGE_DEFAULT_DELAY_SECONDS = float(os.getenv("MISTRAL_HEDGE_DEFAULT_DELAY_SECONDS", "2"))
+MISTRAL_HEDGE_MIN_DELAY_SECONDS = float(os.getenv("MISTRAL_HEDGE_MIN_DELAY_SECONDS", "0.2"))
+# Maximum share of the calls that gets a hedge, so a slow API is not flooded with duplicates
+MISTRAL_HEDGE_MAX_RATIO = float(os.getenv("MISTRAL_HEDGE_MAX_RATIO", "0.1"))
+# Threads that run the hedgeable synchronous calls, no hedge is sent while all of them are busy
+MISTRAL_HEDGE_WORKERS = int(os.getenv("MISTRAL_HEDGE_WORKERS", "64"))
+
+# Unused hedges saved up for a burst of slow calls
+HEDGE_BUDGET_MAX = 10.0
+# Seconds a computed hedge delay is reused before the percentile is computed again
+HEDGE_DELAY_REFRESH_SECONDS = 1.0
+
+
+def timeout_for(purpose):
+    """Returns the number of seconds a call with a purpose may take in total"""
+
+    return MISTRAL_TIMEOUTS.get(purpose, MISTRAL_TIMEOUTS["completion"])
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a model whose circuit breaker is open"""
+
+
+class CircuitBreaker:
+    """Stops calling a model after repeated failures, until a probe call succeeds
+
+    The breaker is closed while calls succeed. After
+    `MISTRAL_BREAKER_FAILURE_THRESHOLD` consecutive failed attempts it opens
+    and every call fails immediately with `CircuitOpenError`. After
+    `MISTRAL_BREAKER_RESET_SECONDS` it is half open: one probe call is let
+    through, which closes the breaker when it succeeds and opens it again when
+    it fails. Each worker process keeps its own breakers.
+    """
+
+    def __init__(self, name, failure_threshold=None, reset_seconds=None):
+        """Initializes a `CircuitBreaker` object
+
+        :param name: The name of the breaker, the model it protects
+        :param failure_threshold: Consecutive failures after which the breaker opens
+        :param reset_seconds: Seconds before an open breaker lets a probe call through
+        """
+
+        self.name = name
+        self.failure_threshold = failure_threshold or MISTRAL_BREAKER_FAILURE_THRESHOLD
+        self.reset_seconds = MISTRAL_BREAKER_RESET_SECONDS if reset_seconds is None else reset_seconds
+        self.lock = threading.Lock()
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.probe_started_at = None
+        self.trips = 0
+        self.rejected = 0
+
+    def is_open(self):
+        """Tells if calls are currently rejected, without taking the probe of a half open breaker"""
+
+        with self.lock:
+            return self.state == "open" and time.monotonic() - self.opened_at < self.reset_seconds
+
+    def before_call(self):
+        """Lets a call through, or raises when the breaker is open
+
+        :raises CircuitOpenError: The breaker is open, or half open with its probe call in flight
+        """
+
+        with self.lock:
+            now = time.monotonic()
+            if self.state == "open" and now - self.opened_at >= self.reset_seconds:
+                self.state = "half_open"
+                self.probing = False
+
+            if self.state == "closed":
+                return
+            # A probe that never reported back, e.g. because it timed out waiting for capacity, is replaced
+            if self.state == "half_open" and (not self.probing or now - self.probe_started_at >= self.reset_seconds):
+                self.probing = True
+                self.probe_started_at = now
+                return
+
+            self.rejected += 1
+
+        raise CircuitOpenError(f"The circuit breaker of {self.name} is open")
+
+    def record_success(self):
+        with self.lock:
+            self.state = "closed"
+            self.failures = 0
+            self.probing = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == "half_open" or (self.state == "closed" and self.failures >= self.failure_threshold):
+                if self.state == "closed":
+                    self.trips += 1
+                    print(f"Circuit breaker of {self.name} opened after {self.failures} failures")
+                self.state = "open"
+                self.opened_at = time.monotonic()
+                self.probing = False
+
+    def snapshot(self):
+        """Returns the state of the breaker"""
+
+        with self.lock:
+            reopens_in = None
+            if self.state == "open":
+                reopens_in = max(self.reset_seconds - (time.monotonic() - self.opened_at), 0.0)
+
+            return {
+                "name": self.name,
+                "state": self.state,
+                "consecutive_failures": self.failures,
+                "reopens_in": reopens_in,
+                "trips": self.trips,
+                "rejected": self.rejected,
+            }
+
+
+class CircuitBreakerRegistry:
+    """Hands out one `CircuitBreaker` per model"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.breakers = {}
+
+    def get(self, name):
+        breaker = self.breakers.get(name)
+        if breaker is None:
+            with self.lock:
+                breaker = self.breakers.setdefault(name, CircuitBreaker(name))
+
+        return breaker
+
+    def is_open(self, name):
+        """Tells if the breaker of a model rejects calls"""
+
+        breaker = self.breakers.get(name)
+        return breaker is not None and breaker.is_open()
+
+    def snapshot(self):
+        return [breaker.snapshot() for _, breaker in sorted(self.breakers.items())]
+
+    def reset(self):
+        """Forgets all breakers, e.g. in a freshly forked child"""
+
+        self.lock = threading.Lock()
+        self.breakers = {}
+
+
+class HedgePolicy:
+    """Decides when a duplicate of a slow call is sent, and keeps the hedge statistics
+
+    A call that has not answered after the p95 latency of its purpose and
+    model gets a duplicate, and the first answer wins. Every call adds
+    `MISTRAL_HEDGE_MAX_RATIO` to a budget that a hedge takes 1 from, so at most
+    that share of the calls is hedged.
+    """
+
+    def __init__(self, max_ratio=None):
+        """Initializes a `HedgePolicy` object
+
+        :param max_ratio: The maximum share of the calls that is hedged
+        """
+
+        self.max_ratio = MISTRAL_HEDGE_MAX_RATIO if max_ratio is None else max_ratio
+        self.lock = threading.Lock()
+        self.budget = 1.0
+        self.stats = {}
+        self.delays = {}
+        self.running = 0
+        self._executor = None
+        self._pid = None
+
+    def executor(self):
+        """Returns the thread pool of the synchronous hedgeable calls of the current process"""
+
+        if self._pid != os.getpid():
+            with self.lock:
+                if self._pid != os.getpid():
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=MISTRAL_HEDGE_WORKERS, thread_name_prefix="mistral-hedge"
+                    )
+                    self._pid = os.getpid()
+
+        return self._executor
+
+    def submit(self, function, kwargs):
+        """Runs a call in the thread pool, counting the calls that are queued or running
+
+        :returns: The future of the call
+        """
+
+        executor = self.executor()
+        with self.lock:
+            self.running += 1
+
+        future = executor.submit(function, **kwargs)
+        future.add_done_callback(self._finished)
+
+        return future
+
+    def _finished(self, future):
+        with self.lock:
+            self.running -= 1
+
+    def has_idle_worker(self):
+        with self.lock:
+            return self.running < MISTRAL_HEDGE_WORKERS
+
+    def _count(self, purpose, name):
+        with self.lock:
+            stats = self.stats.setdefault(
+                purpose, {"calls": 0, "hedged": 0, "hedge_wins": 0, "skipped": 0}
+            )
+            stats[name] += 1
+
+    def delay(self, purpose, model):
+        """Returns the seconds after which a call gets a duplicate"""
+
+        now = time.monotonic()
+        cached = self.delays.get((purpose, model))
+        if cached is not None and now - cached[1] < HEDGE_DELAY_REFRESH_SECONDS:
+            return cached[0]
+
+        p95 = None
+        if LLM_METRICS is not None:
+            p95 = LLM_METRICS.latency_quantile(0.95, purpose, model, MISTRAL_HEDGE_MIN_SAMPLES)
+        delay = MISTRAL_HEDGE_DEFAULT_DELAY_SECONDS if p95 is None else max(p95, MISTRAL_HEDGE_MIN_DELAY_SECONDS)
+        self.delays[(purpose, model)] = (delay, now)
+
+        return delay
+
+    def start(self, purpose):
+        """Counts a hedgeable call and adds its share to the hedge budget"""
+
+        self._count(purpose, "calls")
+        with self.lock:
+            self.budget = min(self.budget + self.max_ratio, HEDGE_BUDGET_MAX)
+
+    def admit(self, purpose, has_capacity, pooled=False):
+        """Decides if a slow call gets a duplicate
+
+        :param purpose: The purpose of the call
+        :param has_capacity: A callable that takes rate limit capacity for the duplicate, if there is any
+        :param pooled: Whether the duplicate runs in the thread pool. A duplicate that would
+            wait in its queue starts too late to help, so it is refused without taking budget
+            or capacity.
+        """
+
+        if pooled and not self.has_idle_worker():
+            self._count(purpose, "skipped")
+            return False
+
+        with self.lock:
+            admitted = self.budget >= 1
+            if admitted:
+                self.budget -= 1
+
+        if admitted and not has_capacity():
+            with self.lock:
+                self.budget += 1
+            admitted = False
+
+        self._count(purpose, "hedged" if admitted else "skipped")
+
+        return admitted
+
+    def record_win(self, purpose):
+        self._count(purpose, "hedge_wins")
+
+    def snapshot(self):
+        """Returns the hedge statistics per purpose, with the share of the hedges that answered first"""
+
+        with self.lock:
+            return {
+                purpose: {**stats, "win_rate": stats["hedge_wins"] / stats["hedged"] if stats["hedged"] else None}
+                for purpose, stats in sorted(self.stats.items())
+            }
+
+    def reset(self):
+        """Forgets the thread pool and the lock, e.g. in a freshly forked child"""
+
+        self.lock = threading.Lock()
+        self.running = 0
+        self._executor = None
+        self._pid = None
+
+
+MISTRAL_CIRCUIT_BREAKERS = CircuitBreakerRegistry() if MISTRAL_BREAKER_ENABLED else None
+MISTRAL_HEDGE_POLICY = HedgePolicy() if MISTRAL_HEDGING_ENABLED else None
+
+if hasattr(os, "register_at_fork"):
+    if MISTRAL_CIRCUIT_BREAKERS is not None:
+        os.register_at_fork(after_in_child=MISTRAL_CIRCUIT_BREAKERS.reset)
+    if MISTRAL_HEDGE_POLICY is not None:
+        os.register_at_fork(after_in_child=MISTRAL_HEDGE_POLICY.reset)
+
+
+def is_hedgeable(purpose):
+    return MISTRAL_HEDGE_POLICY is not None and purpose in MISTRAL_HEDGE_PURPOSES
+
+
+def hedged_call(function, kwargs, purpose, model, remaining, has_capacity):
+    """Calls `function`, sending a duplicate when it is slower than usual
+
+    Both calls run in the thread pool and the first successful response is
+    returned. The losing call cannot be interrupted, it finishes in the
+    background and its response is dropped. The hedge delay counts from the
+    moment the first call starts, not from when it was queued.
+
+    :param function: The SDK method to call
+    :param kwargs: The arguments of the SDK method
+    :param purpose: The purpose of the call
+    :param model: The model of the call
+    :param remaining: Seconds left before the call times out
+    :param has_capacity: A callable that takes rate limit capacity for the duplicate, if there is any
+
+    :returns: The first successful response
+    """
+
+    policy = MISTRAL_HEDGE_POLICY
+    policy.start(purpose)
+    delay = policy.delay(purpose, model)
+    started = threading.Event()
+
+    def call():
+        started.set()
+        return function(**kwargs)
+
+    primary = policy.submit(call, {})
+    if delay >= remaining:
+        return primary.result()
+
+    started.wait(remaining)
+    try:
+        return primary.result(timeout=delay)
+    except FutureTimeoutError:
+        pass
+
+    if not policy.admit(purpose, has_capacity, pooled=True):
+        return primary.result()
+
+    hedge = policy.submit(function, kwargs)
+    pending = {primary, hedge}
+    error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                if future is hedge:
+                    policy.record_win(purpose)
+                return future.result()
+            error = future.exception()
+
+    raise error
+
+
+async def hedged_call_async(function, kwargs, purpose, model, remaining, has_capacity):
+    """Awaits an async SDK method like `hedged_call`, cancelling the losing call"""
+
+    policy = MISTRAL_HEDGE_POLICY
+    policy.start(purpose)
+    delay = policy.delay(purpose, model)
+    primary = asyncio.ensure_future(function(**kwargs))
+    pending = {primary}
+    try:
+        if delay < remaining:
+            done, _ = await asyncio.wait(pending, timeout=delay)
+            # Taking rate limit capacity for the hedge is a SQLite transaction, run it off the loop
+            if not done and await asyncio.to_thread(policy.admit, purpose, has_capacity):
+                hedge = asyncio.ensure_future(function(**kwargs))
+                pending.add(hedge)
+
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is not primary:
+                        policy.record_win(purpose)
+                    return task.result()
+                error = task.exception()
+
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
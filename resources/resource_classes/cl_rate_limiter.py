@@ -0,0 +1,450 @@
+"""Rate limiting and retries for the Mistral API, shared by all worker processes"""
+
+import asyncio
+import datetime
+import email.utils
+import math
+import os
+import random
+import time
+import httpx
+from mistralai import SDKError
+from dotenv import load_dotenv
+from resources.resource_classes.cl_local_storage import LocalSQLiteStore, local_storage_path
+from resources.resource_classes.cl_llm_metrics import LLM_METRICS
+from resources.resource_classes.cl_mistral_resilience import (
+    MISTRAL_CIRCUIT_BREAKERS,
+    hedged_call,
+    hedged_call_async,
+    is_hedgeable,
+    timeout_for,
+)
+
+load_dotenv()
+
+MISTRAL_RATE_LIMIT_ENABLED = os.getenv("MISTRAL_RATE_LIMIT_ENABLED", "true").lower() == "true"
+MISTRAL_RATE_LIMIT_FILE = os.getenv("MISTRAL_RATE_LIMIT_FILE", "mistral_rate_limit.db")
+MISTRAL_REQUESTS_PER_MINUTE = float(os.getenv("MISTRAL_REQUESTS_PER_MINUTE", "300"))
+MISTRAL_TOKENS_PER_MINUTE = float(os.getenv("MISTRAL_TOKENS_PER_MINUTE", "500000"))
+# Maximum number of seconds a call waits for capacity before it gives up
+MISTRAL_RATE_LIMIT_MAX_WAIT_SECONDS = float(os.getenv("MISTRAL_RATE_LIMIT_MAX_WAIT_SECONDS", "30"))
+MISTRAL_MAX_RETRIES = int(os.getenv("MISTRAL_MAX_RETRIES", "4"))
+MISTRAL_BACKOFF_BASE_SECONDS = float(os.getenv("MISTRAL_BACKOFF_BASE_SECONDS", "0.5"))
+MISTRAL_BACKOFF_MAX_SECONDS = float(os.getenv("MISTRAL_BACKOFF_MAX_SECONDS", "20"))
+
+# Share of both buckets that a priority class has to leave for the classes above it
+PRIORITY_RESERVES = {
+    "interactive": 0.0,
+    "default": 0.1,
+    "background": 0.3,
+}
+
+# Seconds between two attempts to take capacity from the buckets
+RATE_LIMIT_POLL_SECONDS = 0.05
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class RateLimitTimeout(Exception):
+    """Raised when a call did not get capacity within the maximum wait time"""
+
+
+class MistralRateLimiter(LocalSQLiteStore):
+    """Token buckets for the requests and the tokens per minute of the Mistral API
+
+    The bucket levels live in a local SQLite database, so all gunicorn workers
+    draw from the same budget. Lower priority classes keep a reserve free for
+    the classes above them, so background enrichment backs off first when the
+    budget runs low. A 429 pauses every worker until the Retry-After passed.
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS rate_limit_buckets (
+            name TEXT PRIMARY KEY,
+            level REAL NOT NULL,
+            updated_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS rate_limit_pause (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            paused_until REAL NOT NULL
+        );
+    """
+
+    def __init__(self, path=None, requests_per_minute=None, tokens_per_minute=None):
+        """Initializes a `MistralRateLimiter` object
+
+        :param path: The path of the SQLite database file
+        :param requests_per_minute: The request budget per minute
+        :param tokens_per_minute: The token budget per minute
+        """
+
+        super().__init__(path or local_storage_path(MISTRAL_RATE_LIMIT_FILE))
+        self.capacities = {
+            "requests": requests_per_minute or MISTRAL_REQUESTS_PER_MINUTE,
+            "tokens": tokens_per_minute or MISTRAL_TOKENS_PER_MINUTE,
+        }
+
+    def try_acquire(self, tokens, priority="default"):
+        """Takes one request and a number of tokens from the buckets if they have room
+
+        :returns: 0 when the capacity was taken, otherwise the seconds to wait before trying again
+        :rtype: float
+        """
+
+        reserve = PRIORITY_RESERVES.get(priority, PRIORITY_RESERVES["default"])
+        wanted = {"requests": 1.0, "tokens": float(tokens)}
+        now = time.time()
+
+        with self.lock:
+            connection = self.connection()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                pause = connection.execute(
+                    "SELECT paused_until FROM rate_limit_pause WHERE id = 1"
+                ).fetchone()
+                if pause is not None and pause[0] > now:
+                    connection.execute("COMMIT")
+                    return pause[0] - now
+
+                levels = {}
+                wait = 0.0
+                for name, capacity in self.capacities.items():
+                    row = connection.execute(
+                        "SELECT level, updated_at FROM rate_limit_buckets WHERE name = ?", (name,)
+                    ).fetchone()
+                    level = capacity if row is None else min(
+                        capacity, row[0] + (now - row[1]) * capacity / 60
+                    )
+                    levels[name] = level
+
+                    # A request larger than the bucket may go once the bucket is full
+                    needed = min(wanted[name] + reserve * capacity, capacity)
+                    if level < needed:
+                        wait = max(wait, (needed - level) * 60 / capacity)
+
+                if wait == 0.0:
+                    for name, level in levels.items():
+                        connection.execute(
+                            "INSERT OR REPLACE INTO rate_limit_buckets (name, level, updated_at) "
+                            "VALUES (?, ?, ?)",
+                            (name, level - wanted[name], now),
+                        )
+                connection.execute("COMMIT")
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+
+        return wait
+
+    def acquire(self, tokens, priority="default", max_wait=None):
+        """Waits until the buckets have room for one request and a number of tokens
+
+        :param tokens: The estimated number of tokens of the request
+        :param priority: The priority class, a key of `PRIORITY_RESERVES`
+        :param max_wait: The maximum number of seconds to wait
+
+        :raises RateLimitTimeout: No capacity became available within `max_wait`
+        """
+
+        max_wait = MISTRAL_RATE_LIMIT_MAX_WAIT_SECONDS if max_wait is None else max_wait
+        deadline = time.monotonic() + max_wait
+
+        while True:
+            wait = self.try_acquire(tokens, priority)
+            if wait == 0.0:
+                return
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise RateLimitTimeout(f"No Mistral capacity for a {priority} call within {max_wait} seconds")
+            time.sleep(min(max(wait, RATE_LIMIT_POLL_SECONDS), remaining))
+
+    async def acquire_async(self, tokens, priority="default", max_wait=None):
+        """Waits like `acquire`, but without blocking the event loop
+
+        The SQLite transaction of every attempt runs in a worker thread, so a
+        busy database or lock contention never stalls the other coroutines.
+        """
+
+        max_wait = MISTRAL_RATE_LIMIT_MAX_WAIT_SECONDS if max_wait is None else max_wait
+        deadline = time.monotonic() + max_wait
+
+        while True:
+            wait = await asyncio.to_thread(self.try_acquire, tokens, priority)
+            if wait == 0.0:
+                return
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise RateLimitTimeout(f"No Mistral capacity for a {priority} call within {max_wait} seconds")
+            await asyncio.sleep(min(max(wait, RATE_LIMIT_POLL_SECONDS), remaining))
+
+    def settle(self, estimated_tokens, used_tokens):
+        """Corrects the token bucket with the actual usage reported by the API"""
+
+        if used_tokens is None or used_tokens == estimated_tokens:
+            return
+
+        with self.lock:
+            self.connection().execute(
+                "UPDATE rate_limit_buckets SET level = MIN(level + ?, ?) WHERE name = 'tokens'",
+                (estimated_tokens - used_tokens, self.capacities["tokens"]),
+            )
+
+    def pause(self, seconds):
+        """Holds back all calls of all workers, e.g. after the API answered with a 429"""
+
+        with self.lock:
+            self.connection().execute(
+                "INSERT INTO rate_limit_pause (id, paused_until) VALUES (1, ?) "
+                "ON CONFLICT (id) DO UPDATE SET paused_until = MAX(paused_until, excluded.paused_until)",
+                (time.time() + seconds,),
+            )
+
+
+MISTRAL_RATE_LIMITER = MistralRateLimiter() if MISTRAL_RATE_LIMIT_ENABLED else None
+
+
+def retry_after_seconds(error):
+    """Reads the Retry-After header of a failed API response
+
+    :returns: The number of seconds to wait, or None when the header is missing or malformed
+    :rtype: float
+    """
+
+    response = getattr(error, "raw_response", None)
+    value = response.headers.get("retry-after") if response is not None else None
+    if not value:
+        return None
+
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            moment = email.utils.parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        if moment.tzinfo is None:
+            # An HTTP date without a zone ("-0000") is in UTC
+            moment = moment.replace(tzinfo=datetime.timezone.utc)
+        seconds = moment.timestamp() - time.time()
+
+    return max(seconds, 0.0) if math.isfinite(seconds) else None
+
+
+def backoff_seconds(attempt):
+    """Returns the exponential backoff with full jitter for a retry attempt"""
+
+    return random.uniform(0, min(MISTRAL_BACKOFF_MAX_SECONDS, MISTRAL_BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+
+def is_retryable(error):
+    """Tells if a failed call may succeed when it is retried"""
+
+    if isinstance(error, SDKError):
+        return error.status_code in RETRYABLE_STATUS_CODES
+
+    return isinstance(error, (httpx.TimeoutException, httpx.NetworkError))
+
+
+def retry_delay(error, attempt):
+    """Decides if a failed call is retried, and after how many seconds
+
+    A 429 also pauses the calls of all workers for the same delay.
+
+    :returns: The seconds to wait before the next attempt, or None when the error should be raised
+    :rtype: float
+    """
+
+    if attempt >= MISTRAL_MAX_RETRIES or not is_retryable(error):
+        return None
+
+    delay = retry_after_seconds(error)
+    if delay is None:
+        delay = backoff_seconds(attempt)
+    if isinstance(error, SDKError) and error.status_code == 429 and MISTRAL_RATE_LIMITER is not None:
+        MISTRAL_RATE_LIMITER.pause(delay)
+
+    print(f"Mistral call failed ({(str(error).splitlines() or [type(error).__name__])[0]}), retrying in {delay:.1f} seconds")
+
+    return delay
+
+
+def _settle(estimated_tokens, usage, response):
+    if usage is not None and MISTRAL_RATE_LIMITER is not None:
+        try:
+            MISTRAL_RATE_LIMITER.settle(estimated_tokens, usage(response))
+        except Exception as e:
+            print(f"Failed to settle Mistral token usage: {str(e)}")
+
+
+def _record(weight, kwargs, purpose, endpoint, attempt_started, started, attempt, response=None, error=None):
+    if not weight:
+        return
+
+    now = time.perf_counter()
+    try:
+        LLM_METRICS.record(
+            kwargs.get("model"),
+            purpose,
+            endpoint,
+            now - attempt_started,
+            now - started,
+            attempt,
+            usage=getattr(response, "usage", None),
+            error=error,
+            weight=weight,
+        )
+    except Exception as e:
+        print(f"Failed to record Mistral call metrics: {str(e)}")
+
+
+def _breaker(kwargs):
+    return MISTRAL_CIRCUIT_BREAKERS.get(kwargs.get("model")) if MISTRAL_CIRCUIT_BREAKERS is not None else None
+
+
+def _is_outage(error):
+    """Tells if a failure counts towards the circuit breaker; a 429 only means the budget ran out"""
+
+    return is_retryable(error) and not (isinstance(error, SDKError) and error.status_code == 429)
+
+
+def _hedge_capacity(estimated_tokens, priority):
+    # A duplicate only goes out when the buckets have room for it right away
+    return lambda: MISTRAL_RATE_LIMITER is None or MISTRAL_RATE_LIMITER.try_acquire(estimated_tokens, priority) == 0.0
+
+
+def call_mistral(function, estimated_tokens, priority="default", usage=None, purpose=None, endpoint=None, **kwargs):
+    """Calls a Mistral API method within the rate limits, retrying transient failures
+
+    Before every attempt the call takes capacity from the shared buckets.
+    Rate limit and server errors are retried with exponential backoff and
+    jitter, or after the Retry-After of the response when it has one. The
+    whole call, retries included, has to finish within the timeout of its
+    purpose. Slow attempts of hedgeable purposes get a duplicate request,
+    and calls to a model whose circuit breaker is open fail right away. The
+    finished call is recorded in `LLM_METRICS`.
+
+    :param function: The SDK method to call, e.g. `client.chat.complete`
+    :param estimated_tokens: The estimated number of prompt and completion tokens
+    :param priority: The priority class, a key of `PRIORITY_RESERVES`
+    :param usage: A callable that reads the used tokens from the response
+    :param purpose: What the call is for, e.g. "embedding" or "summary"; sets the timeout and the metrics
+    :param endpoint: The route the call is made for in the metrics
+    :param kwargs: The arguments of the SDK method
+
+    :returns: The response of the SDK method
+
+    :raises CircuitOpenError: The circuit breaker of the model is open
+    :raises RateLimitTimeout: No capacity became available in time
+    """
+
+    weight = LLM_METRICS.sample_weight(purpose) if LLM_METRICS is not None else 0.0
+    breaker = _breaker(kwargs)
+    started = time.perf_counter()
+    deadline = started + timeout_for(purpose)
+    attempt = 0
+    while True:
+        if breaker is not None:
+            breaker.before_call()
+        if MISTRAL_RATE_LIMITER is not None:
+            MISTRAL_RATE_LIMITER.acquire(
+                estimated_tokens,
+                priority,
+                max_wait=max(min(MISTRAL_RATE_LIMIT_MAX_WAIT_SECONDS, deadline - time.perf_counter()), 0.0),
+            )
+
+        attempt_started = time.perf_counter()
+        remaining = max(deadline - attempt_started, 0.001)
+        attempt_kwargs = {**kwargs, "timeout_ms": int(remaining * 1000)}
+        try:
+            if is_hedgeable(purpose):
+                response = hedged_call(
+                    function,
+                    attempt_kwargs,
+                    purpose,
+                    kwargs.get("model"),
+                    remaining,
+                    _hedge_capacity(estimated_tokens, priority),
+                )
+            else:
+                response = function(**attempt_kwargs)
+        except Exception as e:
+            if breaker is not None:
+                if _is_outage(e):
+                    breaker.record_failure()
+                else:
+                    # The API answered, e.g. with a 400 or a 429, so it is up
+                    breaker.record_success()
+            delay = retry_delay(e, attempt)
+            if delay is None or time.perf_counter() + delay >= deadline:
+                _record(weight, kwargs, purpose, endpoint, attempt_started, started, attempt, error=e)
+                raise
+            time.sleep(delay)
+            attempt += 1
+            continue
+
+        if breaker is not None:
+            breaker.record_success()
+        _settle(estimated_tokens, usage, response)
+        _record(weight, kwargs, purpose, endpoint, attempt_started, started, attempt, response)
+
+        return response
+
+
+async def call_mistral_async(
+    function, estimated_tokens, priority="default", usage=None, purpose=None, endpoint=None, **kwargs
+):
+    """Awaits an async Mistral API method with the rate limits, retries, timeouts, hedging and metrics of `call_mistral`"""
+
+    weight = LLM_METRICS.sample_weight(purpose) if LLM_METRICS is not None else 0.0
+    breaker = _breaker(kwargs)
+    started = time.perf_counter()
+    deadline = started + timeout_for(purpose)
+    attempt = 0
+    while True:
+        if breaker is not None:
+            breaker.before_call()
+        if MISTRAL_RATE_LIMITER is not None:
+            await MISTRAL_RATE_LIMITER.acquire_async(
+                estimated_tokens,
+                priority,
+                max_wait=max(min(MISTRAL_RATE_LIMIT_MAX_WAIT_SECONDS, deadline - time.perf_counter()), 0.0),
+            )
+
+        attempt_started = time.perf_counter()
+        remaining = max(deadline - attempt_started, 0.001)
+        attempt_kwargs = {**kwargs, "timeout_ms": int(remaining * 1000)}
+        try:
+            if is_hedgeable(purpose):
+                response = await hedged_call_async(
+                    function,
+                    attempt_kwargs,
+                    purpose,
+                    kwargs.get("model"),
+                    remaining,
+                    _hedge_capacity(estimated_tokens, priority),
+                )
+            else:
+                response = await function(**attempt_kwargs)
+        except Exception as e:
+            if breaker is not None:
+                if _is_outage(e):
+                    breaker.record_failure()
+                else:
+                    breaker.record_success()
+            # A 429 pauses the other workers through SQLite, which stays off the event loop
+            delay = await asyncio.to_thread(retry_delay, e, attempt)
+            if delay is None or time.perf_counter() + delay >= deadline:
+                _record(weight, kwargs, purpose, endpoint, attempt_started, started, attempt, error=e)
+                raise
+            await asyncio.sleep(delay)
+            attempt += 1
+            continue
+
+        if breaker is not None:
+            breaker.record_success()
+        await asyncio.to_thread(_settle, estimated_tokens, usage, response)
+        _record(weight, kwargs, purpose, endpoint, attempt_started, started, attempt, response)
+
+        return response
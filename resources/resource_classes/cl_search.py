@@ -1,35 +1,104 @@
 """Resource class for searching though OpenSearch indices"""
 
 import os
-from opensearchpy import OpenSearch
+import threading
+import time
+from collections import OrderedDict
 from dotenv import load_dotenv
 from resources.resource_classes.cl_mistral_connection import CL_Mistral_Embeddings
+from resources.resource_classes.cl_search_cache import SEARCH_CACHE
+from resources.resource_classes.cl_answer_cache import ANSWER_CACHE
+from resources.resource_classes.cl_local_storage import cache_key
+from resources.resource_classes.cl_llm_metrics import LLM_METRICS
+from resources.resource_classes.cl_search_backend import (
+    KNN_FILTER_ENGINES,
+    OPENSEARCH_KNN_ENGINE,
+    get_search_backend,
+    knn_cosine_score,
+)
+from resources.resource_classes.cl_facet_index import get_facet_index, update_facet_index
+from resources.resource_classes.cl_vector_index import VECTOR_BACKEND, get_local_vector_index
 
 load_dotenv()
 
-OPENSEARCH_URL = os.getenv("OPENSEARCH_URL")
-OPENSEARCH_USERNAME = os.getenv("OPENSEARCH_USERNAME")
-OPENSEARCH_PASSWORD = os.getenv("OPENSEARCH_PASSWORD")
-
-OPENSEARCH_CONNECTION = OpenSearch(
-    OPENSEARCH_URL,
-    http_auth=(OPENSEARCH_USERNAME, OPENSEARCH_PASSWORD),
-    request_timeout=900,
-    verify_certs=False,
-)
+# Number of days on a page of the paged timeline, and documents shown per day
+TIMELINE_PAGE_SIZE = int(os.getenv("TIMELINE_PAGE_SIZE", "14"))
+TIMELINE_PAGE_DOCUMENTS_PER_DAY = int(os.getenv("TIMELINE_PAGE_DOCUMENTS_PER_DAY", "100"))
+# Send the kNN branch and the transcript branch as separate requests in one _msearch
+SEARCH_MSEARCH_ENABLED = os.getenv("SEARCH_MSEARCH_ENABLED", "true").lower() == "true"
+# How chat retrieval searches inside the selected documents: "auto", "exact" or "filtered".
+# "filtered" needs a kNN engine that supports filters, see KNN_FILTER_ENGINES, otherwise "exact" is used
+CHAT_KNN_STRATEGY = os.getenv("CHAT_KNN_STRATEGY", "auto")
+# With "auto", up to this many candidate chunks are scored exactly instead of with filtered kNN
+CHAT_KNN_EXACT_MAX_CANDIDATES = int(os.getenv("CHAT_KNN_EXACT_MAX_CANDIDATES", "5000"))
+# Seconds the number of chunks of a set of documents is reused by the "auto" strategy
+CHAT_CANDIDATE_COUNT_TTL_SECONDS = 3600
+CHAT_CANDIDATE_COUNT_MAX_ENTRIES = 1024
+# Number of chunks retrieved to answer a chat question
+CHAT_CHUNKS = 10
+
+
+_CHAT_CANDIDATE_COUNTS = OrderedDict()
+_CHAT_CANDIDATE_COUNTS_LOCK = threading.Lock()
+
+
+def chat_knn_strategy(backend, document_identifiers, document_filter, strategy=None):
+    """Decides how the chat retrieval searches inside a set of documents
+
+    With "auto", the chunks of the documents are counted once per set of
+    documents and then reused for an hour; the count only picks the strategy,
+    so a slightly outdated count is harmless.
+
+    :param backend: The `SearchBackend` to count the chunks with
+    :param document_identifiers: The identifiers of the selected documents
+    :param document_filter: The query clause that selects their chunks
+    :param strategy: The configured strategy, defaults to CHAT_KNN_STRATEGY
+
+    :returns: Either "exact" or "filtered"
+    :rtype: str
+    """
+
+    strategy = strategy or CHAT_KNN_STRATEGY
+    if OPENSEARCH_KNN_ENGINE not in KNN_FILTER_ENGINES or strategy == "exact":
+        return "exact"
+    if strategy != "auto":
+        return strategy
+
+    key = cache_key(*sorted(set(document_identifiers)))
+    now = time.monotonic()
+    with _CHAT_CANDIDATE_COUNTS_LOCK:
+        cached = _CHAT_CANDIDATE_COUNTS.get(key)
+        if cached is not None and now - cached[1] < CHAT_CANDIDATE_COUNT_TTL_SECONDS:
+            _CHAT_CANDIDATE_COUNTS.move_to_end(key)
+            candidates = cached[0]
+        else:
+            candidates = None
+
+    if candidates is None:
+        candidates = backend.search(
+            "es_hackethon",
+            {"size": 0, "track_total_hits": True, "query": document_filter},
+        )["hits"]["total"]["value"]
+        with _CHAT_CANDIDATE_COUNTS_LOCK:
+            _CHAT_CANDIDATE_COUNTS[key] = (candidates, now)
+            _CHAT_CANDIDATE_COUNTS.move_to_end(key)
+            while len(_CHAT_CANDIDATE_COUNTS) > CHAT_CANDIDATE_COUNT_MAX_ENTRIES:
+                _CHAT_CANDIDATE_COUNTS.popitem(last=False)
+
+    return "exact" if candidates <= CHAT_KNN_EXACT_MAX_CANDIDATES else "filtered"
 
 
 class ChunkSearchingClass:
     """Simple class for searching `Chunk` objects"""
 
     def __init__(self):
-        pass
+        self.branch_timings = {}
 
     def search(self):
         """Retrieves 10 random documents from our index"""
 
         chunks_to_return = []
-        response = OPENSEARCH_CONNECTION.search(body={"size": 10}, index="es_hackethon")
+        response = get_search_backend().search("es_hackethon", {"size": 10})
 
         for chunk in response["hits"]["hits"]:
             chunks_to_return.append(chunk["_source"])
@@ -43,14 +112,16 @@ class ChunkSearchingClass:
         return document_ids
 
     @staticmethod 
-    def get_chunks_for_chat(question, document_identifiers):
+    def get_chunks_for_chat(question, document_identifiers, question_embedding=None):
         """
         Retrieves relevant document chunks for a given opportunity and question.
 
         This method performs a hybrid search using question embeddings and retrieves
         chunks of text from documents associated with the specified opportunity. The
         search leverages Elasticsearch's k-NN capabilities to find the most relevant
-        document segments.
+        document segments. Only chunks of the given documents are considered: a
+        small candidate set is scored exactly, a large one with filtered kNN when
+        the kNN engine supports it.
 
         :param document_ids:
             A list of document identifiers to search through
@@ -59,51 +130,102 @@ class ChunkSearchingClass:
             The question for which relevant document chunks are to be retrieved.
             An embedding of the question is generated for k-NN search.
 
+        :param question_embedding:
+            The embedding of the question, when the caller already generated it
+
         :returns:   A list of text chunks from the documents that are relevant to the given question.
                     Returns an empty list if no opportunity is found or if no relevant chunks are identified.
         :rtype: list
 
         """
         # Step 1. Generate embedding from question
-        question_embedding = (
-            CL_Mistral_Embeddings().generate_embedding(question)
-        )
+        if question_embedding is None:
+            question_embedding = (
+                CL_Mistral_Embeddings().generate_embedding(question)
+            )
 
-        # Step 2. Retrieve chunks based on KNN search
-        es_query = {
-            "size": 10,
-            "query": {
-                "bool": {
-                    "must": [
-                        {
-                            "terms": {
-                                "document_id.keyword": document_identifiers
-                            }
-                        }
-                    ],
-                    "must": {
-                        "knn": {
-                            "content_embedding": {
-                                "vector": question_embedding,
-                                "k": 100
-                            }
-                        }
+        # Step 2. Retrieve the nearest chunks within the selected documents
+        backend = get_search_backend()
+        document_filter = {"terms": {"document_id.keyword": document_identifiers}}
+
+        if VECTOR_BACKEND == "local":
+            # The local index applies the document filter before the neighbour search
+            es_query = {
+                "size": CHAT_CHUNKS,
+                "query": {
+                    "bool": {
+                        "must": ChunkSearchingClass.build_knn_clause(
+                            question_embedding, CHAT_CHUNKS, {"document_id": document_identifiers}
+                        ),
+                        "filter": [document_filter]
                     }
                 }
             }
-        }
+        else:
+            strategy = chat_knn_strategy(backend, document_identifiers, document_filter)
+            es_query = ChunkSearchingClass.build_chat_knn_query(
+                question_embedding, document_filter, CHAT_CHUNKS, strategy
+            )
 
         # Step 3. Return relevant chunks to base answer on
-        response = OPENSEARCH_CONNECTION.search(
-            index="es_hackethon",
-            body=es_query,
-        )
+        response = backend.search("es_hackethon", es_query)
         chunks = [
             hit["_source"]["content_text"]
             for hit in response["hits"]["hits"]
         ]
 
         return chunks
+
+    @staticmethod
+    def build_chat_knn_query(vector, document_filter, size, strategy):
+        """Builds the query for the chunks nearest to a vector within a set of documents
+
+        The "exact" strategy scores every chunk that passes the filter with the
+        k-NN scoring script, which is the cheapest option for a small set of
+        candidates. The "filtered" strategy runs the approximate kNN search with
+        the filter applied during the graph traversal, which only the Lucene and
+        faiss engines support; see `chat_knn_strategy`.
+
+        :param vector: The query embedding
+        :param document_filter: The query clause that selects the candidate chunks
+        :param size: The number of chunks to retrieve
+        :param strategy: Either "exact" or "filtered"
+
+        :returns: The search body
+        :rtype: dict
+        """
+
+        if strategy == "exact":
+            return {
+                "size": size,
+                "query": {
+                    "script_score": {
+                        "query": {"bool": {"filter": [document_filter]}},
+                        "script": {
+                            "source": "knn_score",
+                            "lang": "knn",
+                            "params": {
+                                "field": "content_embedding",
+                                "query_value": vector,
+                                "space_type": "cosinesimil"
+                            }
+                        }
+                    }
+                }
+            }
+
+        return {
+            "size": size,
+            "query": {
+                "knn": {
+                    "content_embedding": {
+                        "vector": vector,
+                        "k": size,
+                        "filter": document_filter
+                    }
+                }
+            }
+        }
     
     def get_documents_for_timeline(self):
         """Retrieves all the related document identifiers"""
@@ -112,9 +234,9 @@ class ChunkSearchingClass:
         return document_ids
     
    
-    def search_documents(self, config):
-        """Retrieves documents based on a search string"""
-        
+    @staticmethod
+    def build_search_filters(config):
+        """Builds the filter clauses for the date range, publisher and types in a search config"""
 
         #Filter on date
         range_filter = {}
@@ -169,53 +291,151 @@ class ChunkSearchingClass:
                 }
             })
 
-        aggs = {
-            "Publicatiedatum": {
-                "date_histogram": {
-                    "field": "published",
-                    "calendar_interval": "day",
-                    "format": "yyyy-MM-dd",
-                    "order": {
-                        "_key": "desc"
+        return filters
+
+    @staticmethod
+    def build_knn_clause(vector, k, prefilters=None):
+        """Builds the query clause that matches the `k` chunks nearest to a vector
+
+        With the "opensearch" vector backend this is a kNN query on the
+        `content_embedding` field. With the "local" backend the neighbours are
+        looked up in the in-process vector index, and the clause matches exactly
+        those chunks, scored by their similarity.
+
+        :param vector: The query embedding
+        :param k: The number of nearest chunks
+        :param prefilters: The metadata pre-filters for the local index, see `LocalVectorIndex.filter_mask`
+
+        :returns: The query clause
+        :rtype: dict
+        """
+
+        if VECTOR_BACKEND != "local":
+            return {
+                "knn": {
+                    "content_embedding": {
+                        "vector": vector,
+                        "k": k
+                    }
+                }
+            }
+
+        neighbours = get_local_vector_index().search(vector, k=k, filters=prefilters)
+        if not neighbours:
+            return {"match_none": {}}
+
+        return {
+            "bool": {
+                "should": [
+                    {
+                        "constant_score": {
+                            "filter": {"term": {"chunk_id.keyword": chunk_id}},
+                            # The score the OpenSearch kNN query gives this neighbour
+                            "boost": knn_cosine_score(score)
+                        }
+                    }
+                    for chunk_id, score in neighbours
+                ],
+                "minimum_should_match": 1
+            }
+        }
+
+    @staticmethod
+    def build_knn_branch(config):
+        """Builds the clause that matches the chunks nearest to the search embedding"""
+
+        return ChunkSearchingClass.build_knn_clause(
+            config["embedding"],
+            100,
+            {
+                "publisher": config.get("publisher"),
+                "type_primary": config.get("type_primary"),
+                "published_from": config.get("search_from"),
+                "published_until": config.get("search_until"),
+            }
+        )
+
+    @staticmethod
+    def build_transcript_branch(config):
+        """Builds the clause that matches transcripts on their agenda item"""
+
+        return {
+            "bool": {
+                "must": [
+                    {
+                        "match": {
+                            "type_secondary.keyword": "Transcript"
+                        }
                     },
-                    "min_doc_count": 1
+                    {
+                        "match": {
+                            "transcription.agenda_item": config["search_string"]
+                        }
+                    }
+                ]
+            }
+        }
+
+    @staticmethod
+    def build_search_query(config, filters):
+        """Builds the query that matches chunks on the embedding or the transcript agenda item"""
+
+        return {
+            "bool": {
+                "should": [
+                    ChunkSearchingClass.build_knn_branch(config),
+                    ChunkSearchingClass.build_transcript_branch(config)
+                ],
+                "minimum_should_match": 1,
+                "filter": filters  # dit is [] als er geen datumfilter is
+            }
+        }
+
+    @staticmethod
+    def build_documents_aggregation(documents_per_day=1000):
+        """Builds the aggregation that groups the chunks of a day per document"""
+
+        return {
+            "Documents": {
+                "terms": {
+                    "field": "document_id.keyword",
+                    "size": documents_per_day
                 },
                 "aggs": {
-                    "Documents": {
-                        "terms": {
-                            "field": "document_id.keyword",
-                            "size": 1000
-                        },
-                        "aggs": {
-                            "Document_Chunks": {
-                                "top_hits": {
-                                    "size": 3,
-                                    "sort": [
-                                        {
-                                            "_score": {
-                                                "order": "desc"
-                                            }
-                                        }
-                                    ],
-                                    "_source": {
-                                        "excludes": [
-                                            "frontend.group*",
-                                            "content_embedding"
-                                        ]
-                                    }
-                                }
-                            },
-                            "max_score": {
-                                "max": {
-                                    "script": {
-                                        "source": "_score"
+                    "Document_Chunks": {
+                        "top_hits": {
+                            "size": 3,
+                            "sort": [
+                                {
+                                    "_score": {
+                                        "order": "desc"
                                     }
                                 }
+                            ],
+                            "_source": {
+                                "excludes": [
+                                    "frontend.group*",
+                                    "content_embedding"
+                                ]
+                            }
+                        }
+                    },
+                    "max_score": {
+                        "max": {
+                            "script": {
+                                "source": "_score"
                             }
                         }
                     }
                 }
-            },
+            }
+        }
+
+    @staticmethod
+    def build_facet_aggregations():
+        """Builds the aggregations that count the chunks per publisher and type"""
+
+        return {
             "type_primary": {
                 "terms": {
                     "field": "type_primary.keyword",
@@ -236,127 +456,393 @@ class ChunkSearchingClass:
             }
         }
 
+    @staticmethod
+    def parse_date_bucket(date, date_bucket):
+        """Turns a date bucket of the timeline aggregation into a timeline entry
 
+        The chunks of every document are merged into a single document whose
+        `content_text` is the concatenated text of its top chunks.
 
+        :param date: The formatted date of the bucket
+        :param date_bucket: The bucket from the aggregation response
 
-        query = {
-            "bool": {
-                "should": [
-                    {
-                        "knn": {
-                            "content_embedding": {
-                                "vector": config["embedding"],
-                                "k": 100
-                            }
-                        }
-                    },
-                    {
-                        "bool": {
-                            "must": [
-                                {
-                                    "match": {
-                                        "type_secondary.keyword": "Transcript"
-                                    }
-                                },
-                                {
-                                    "match": {
-                                        "transcription.agenda_item": config["search_string"]
-                                    }
-                                }
-                            ]
-                        }
-                    }
-                ],
-                "minimum_should_match": 1,
-                "filter": filters  # dit is [] als er geen datumfilter is
-            }
-        }
+        :returns: A ``{"date": ..., "documents": [...]}`` dictionary
+        :rtype: dict
+        """
 
+        chunks_to_return = []
 
-        body = {
-            "size": 0,
-            "query": query,
-            "aggs": aggs
+        for document_bucket in date_bucket['Documents']['buckets']:
+            chunks = document_bucket["Document_Chunks"]["hits"]["hits"]
+            content_parts = []
+            source_data = {}
+
+            # Loop over all chunks
+            for chunk in chunks:
+                if "content_text" in chunk["_source"]:
+                    content_parts.append(chunk["_source"]["content_text"])
+
+                # Update source_data with each chunk's _source that contains a chunk_id
+                if "chunk_id" in chunk["_source"]:
+                    source_data = chunk["_source"]
+
+            # Ensure the document has the necessary fields
+            if "chunk_id" in source_data:
+                source_data["content_text"] = "".join(content_parts)
+                chunks_to_return.append(source_data)
+
+        return {"date": date, "documents": chunks_to_return}
+
+    @staticmethod
+    def parse_facets(aggregations):
+        """Turns the facet aggregations into the filters returned to the frontend"""
+
+        filters = {}
+        for facet in ["type_primary", "type_secondary", "publisher"]:
+            filters[facet] = [
+                {
+                    facet: aggregation_results["key"],
+                    "amount_of_docs": aggregation_results["doc_count"],
+                }
+                for aggregation_results in aggregations[facet]["buckets"]
+            ]
+
+        return filters
+
+    @staticmethod
+    def build_timeline_aggregation():
+        """Builds the aggregation that groups the matching chunks per day and per document"""
+
+        return {
+            "date_histogram": {
+                "field": "published",
+                "calendar_interval": "day",
+                "format": "yyyy-MM-dd",
+                "order": {
+                    "_key": "desc"
+                },
+                "min_doc_count": 1
+            },
+            "aggs": ChunkSearchingClass.build_documents_aggregation()
         }
 
+    @staticmethod
+    def merge_timeline_buckets(bucket_lists):
+        """Fuses the timeline aggregations of several query branches
 
+        Buckets of the same day and document are merged. The chunks found by
+        more than one branch are counted once: a bucket may carry an `Overlap`
+        filter aggregation with the number of its chunks that another branch
+        matches as well, which is subtracted from its `doc_count`. That branch
+        scores those chunks with the combined score, so of a chunk found twice
+        the best scored hit is kept, and every document keeps its three best chunks.
 
-        
-        response = OPENSEARCH_CONNECTION.search(body=body, index="es_hackethon")
-
-        objects_to_return = []
-        for date_bucket in response["aggregations"]["Publicatiedatum"]["buckets"]:
-            chunks_to_return = []
-            date = date_bucket['key_as_string']
-            
-            for document_bucket in date_bucket['Documents']['buckets']:
-                chunks = document_bucket["Document_Chunks"]["hits"]["hits"]
-                concatenated_content = ''
-                source_data = {}
-
-                # Loop over all chunks
-                for chunk in chunks:
-                    if "content_text" in chunk["_source"]:
-                        concatenated_content += chunk["_source"]["content_text"]
-                    
-                    # Update source_data with each chunk's _source that contains a chunk_id
-                    if "chunk_id" in chunk["_source"]:
-                        source_data = chunk["_source"]
-
-                # Ensure the document has the necessary fields
-                if "chunk_id" in source_data:
-                    source_data["content_text"] = concatenated_content
-                    chunks_to_return.append(source_data)
-
-                # print("Chunks to return: ", chunks_to_return)
-
-            object = {"date": date, "documents": chunks_to_return}
-            objects_to_return.append(object)
+        :param bucket_lists: The `Publicatiedatum` buckets of every branch
 
-    
-        type_primary = []
-        if len(response["aggregations"]["type_primary"]["buckets"]) > 0:
-            for aggregation_results in response["aggregations"]["type_primary"][
-                "buckets"
-            ]:
-                type_primary.append(
+        :returns: The fused buckets, newest day first
+        :rtype: list
+        """
+
+        days = {}
+        for buckets in bucket_lists:
+            for date_bucket in buckets:
+                day = days.setdefault(
+                    date_bucket["key_as_string"],
+                    {"key_as_string": date_bucket["key_as_string"], "key": date_bucket["key"], "documents": {}},
+                )
+                for document_bucket in date_bucket["Documents"]["buckets"]:
+                    document = day["documents"].setdefault(
+                        document_bucket["key"], {"doc_count": 0, "hits": {}}
+                    )
+                    document["doc_count"] += document_bucket["doc_count"]
+                    document["doc_count"] -= document_bucket.get("Overlap", {}).get("doc_count", 0)
+                    for hit in document_bucket["Document_Chunks"]["hits"]["hits"]:
+                        known = document["hits"].get(hit["_id"])
+                        if known is None or (known["_score"] or 0) < (hit["_score"] or 0):
+                            document["hits"][hit["_id"]] = hit
+
+        fused = []
+        for day in sorted(days.values(), key=lambda day: day["key_as_string"], reverse=True):
+            document_buckets = []
+            for document_id, document in day["documents"].items():
+                hits = sorted(document["hits"].values(), key=lambda hit: -(hit["_score"] or 0))[:3]
+                document_buckets.append(
                     {
-                        "type_primary": aggregation_results["key"],
-                        "amount_of_docs": aggregation_results["doc_count"],
+                        "key": document_id,
+                        "doc_count": document["doc_count"],
+                        "Document_Chunks": {"hits": {"hits": hits}},
+                        "max_score": {"value": hits[0]["_score"] if hits else None},
                     }
                 )
+            # Same order as the terms aggregation: most matching chunks first
+            document_buckets.sort(key=lambda bucket: (-bucket["doc_count"], bucket["key"]))
+            fused.append(
+                {
+                    "key_as_string": day["key_as_string"],
+                    "key": day["key"],
+                    "doc_count": sum(bucket["doc_count"] for bucket in document_buckets),
+                    "Documents": {"buckets": document_buckets},
+                }
+            )
 
-        publisher = []
-        if len(response["aggregations"]["publisher"]["buckets"]) > 0:
-            for aggregation_results in response["aggregations"]["publisher"][
-                "buckets"
-            ]:
-                publisher.append(
-                    {
-                        "publisher": aggregation_results["key"],
-                        "amount_of_docs": aggregation_results["doc_count"],
+        return fused
+
+    @staticmethod
+    def merge_facet_aggregations(aggregation_list):
+        """Fuses the facet aggregations of several query branches
+
+        Like in `merge_timeline_buckets`, the counts of an `Overlap` filter
+        aggregation are subtracted, so a chunk found by two branches counts once.
+
+        :param aggregation_list: The aggregations of every branch
+
+        :returns: The facet aggregations, in the shape of `build_facet_aggregations`
+        :rtype: dict
+        """
+
+        merged = {}
+        for facet in ChunkSearchingClass.build_facet_aggregations():
+            counts = {}
+            for aggregations in aggregation_list:
+                for sign, source in [(1, aggregations), (-1, aggregations.get("Overlap"))]:
+                    if source is None:
+                        continue
+                    for bucket in source[facet]["buckets"]:
+                        counts[bucket["key"]] = counts.get(bucket["key"], 0) + sign * bucket["doc_count"]
+
+            merged[facet] = {
+                "buckets": [
+                    {"key": key, "doc_count": count}
+                    for key, count in sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+                    if count > 0
+                ]
+            }
+
+        return merged
+
+    def search_branches(self, config, filters, include_facets=True):
+        """Runs the kNN branch and the transcript branch as one multi-search
+
+        The independent branches are sent in a single `_msearch` round-trip and
+        their timelines and facets are fused client-side. The kNN branch also
+        scores the transcript clause and counts the chunks that match both
+        branches in `Overlap` filter aggregations, so the fused counts and
+        scores equal those of the combined query without running kNN twice.
+        The latency OpenSearch reports for every branch is kept in `branch_timings`
+        and recorded in the search branch metrics served by `/metrics/llm`.
+
+        :param config: The search config
+        :param filters: The filter clauses built by `build_search_filters`
+        :param include_facets: Whether the facet aggregations should be computed
+
+        :returns: A search response in the same shape as the combined query
+        :rtype: dict
+        """
+
+        transcript_branch = self.build_transcript_branch(config)
+        knn_timeline = self.build_timeline_aggregation()
+        knn_timeline["aggs"]["Documents"]["aggs"]["Overlap"] = {"filter": transcript_branch}
+
+        branches = {
+            "knn": {
+                "size": 0,
+                "query": {
+                    "bool": {
+                        "must": [self.build_knn_branch(config)],
+                        # Adds the transcript score of the chunks that match both branches
+                        "should": [transcript_branch],
+                        "filter": filters
                     }
+                },
+                "aggs": {"Publicatiedatum": knn_timeline}
+            },
+            "transcript": {
+                "size": 0,
+                "query": {"bool": {"must": [transcript_branch], "filter": filters}},
+                "aggs": {"Publicatiedatum": self.build_timeline_aggregation()}
+            },
+        }
+        if include_facets:
+            branches["knn"]["aggs"].update(self.build_facet_aggregations())
+            branches["knn"]["aggs"]["Overlap"] = {
+                "filter": transcript_branch,
+                "aggs": self.build_facet_aggregations()
+            }
+            branches["transcript"]["aggs"].update(self.build_facet_aggregations())
+
+        started = time.perf_counter()
+        responses = dict(
+            zip(branches, get_search_backend().msearch("es_hackethon", list(branches.values())))
+        )
+        self.branch_timings = {name: response.get("took") for name, response in responses.items()}
+        self.branch_timings["total"] = int((time.perf_counter() - started) * 1000)
+        if LLM_METRICS is not None:
+            LLM_METRICS.record_search_branches(self.branch_timings)
+
+        branch_aggregations = [responses["knn"]["aggregations"], responses["transcript"]["aggregations"]]
+        aggregations = {
+            "Publicatiedatum": {
+                "buckets": self.merge_timeline_buckets(
+                    [branch["Publicatiedatum"]["buckets"] for branch in branch_aggregations]
                 )
+            }
+        }
+        if include_facets:
+            aggregations.update(self.merge_facet_aggregations(branch_aggregations))
 
-        type_secondary = []
-        if len(response["aggregations"]["type_secondary"]["buckets"]) > 0:
-            for aggregation_results in response["aggregations"]["type_secondary"][
-                "buckets"
-            ]:
-                type_secondary.append(
-                    {
-                        "type_secondary": aggregation_results["key"],
-                        "amount_of_docs": aggregation_results["doc_count"],
+        return {"aggregations": aggregations}
+
+    @classmethod
+    def parse_search_response(cls, response):
+        """Turns the response of the timeline search into the timeline and the filters
+
+        :param response: The search response with the `Publicatiedatum` and facet aggregations
+
+        :returns: An ``(objects, filters)`` tuple, `filters` is empty when the facets were not aggregated
+        :rtype: tuple
+        """
+
+        objects_to_return = [
+            cls.parse_date_bucket(date_bucket['key_as_string'], date_bucket)
+            for date_bucket in response["aggregations"]["Publicatiedatum"]["buckets"]
+        ]
+
+        filters = {}
+        if "type_primary" in response["aggregations"]:
+            filters = cls.parse_facets(response["aggregations"])
+
+        return objects_to_return, filters
+
+    @staticmethod
+    def collect_document_ids(objects):
+        """Collects the identifiers of all documents on a timeline, in timeline order"""
+
+        return [
+            doc['document_id']
+            for entry in objects
+            for doc in entry['documents']
+        ]
+
+    def search_documents(self, config):
+        """Retrieves documents based on a search string
+
+        Parsed results are cached per search config until the TTL expires or
+        the index is written to through `update_document`. When the facet index
+        is enabled, the facet counts are computed from it instead of by OpenSearch.
+        """
+
+        cache_key = None
+        if SEARCH_CACHE is not None:
+            cache_key = SEARCH_CACHE.build_key(config)
+            cached = SEARCH_CACHE.get(cache_key)
+            if cached is not None:
+                return cached
+
+        filters = self.build_search_filters(config)
+
+        facet_index = get_facet_index(get_search_backend())
+
+        if SEARCH_MSEARCH_ENABLED:
+            response = self.search_branches(config, filters, facet_index is None)
+        else:
+            aggs = {"Publicatiedatum": self.build_timeline_aggregation()}
+            if facet_index is None:
+                aggs.update(self.build_facet_aggregations())
+
+            body = {
+                "size": 0,
+                "query": self.build_search_query(config, filters),
+                "aggs": aggs
+            }
+
+            response = get_search_backend().search("es_hackethon", body)
+
+        objects_to_return, filters = self.parse_search_response(response)
+        if facet_index is not None:
+            filters = facet_index.counts(self.collect_document_ids(objects_to_return))
+
+        if cache_key is not None:
+            SEARCH_CACHE.set(cache_key, (objects_to_return, filters))
+
+        return objects_to_return, filters
+
+    def search_documents_page(self, config, after=None, page_size=None):
+        """Retrieves one page of the timeline for a search string
+
+        Instead of building every day bucket at once, a composite aggregation
+        returns at most `page_size` days, newest first, starting after the
+        `after` cursor. The facet counts are only computed for the first page.
+
+        :param config: The search config, as for `search_documents`
+        :param after: The cursor returned with the previous page, or None for the first page
+        :param page_size: The number of days on a page
+
+        :returns: An ``(objects, filters, next_cursor)`` tuple; `next_cursor` is None on the last page
+        :rtype: tuple
+        """
+
+        page_size = page_size or TIMELINE_PAGE_SIZE
+
+        cache_key = None
+        if SEARCH_CACHE is not None:
+            cache_key = SEARCH_CACHE.build_key(config, "page", after, page_size)
+            cached = SEARCH_CACHE.get(cache_key)
+            if cached is not None:
+                return cached
+
+        composite = {
+            "size": page_size,
+            "sources": [
+                {
+                    "date": {
+                        "date_histogram": {
+                            "field": "published",
+                            "calendar_interval": "day",
+                            "format": "yyyy-MM-dd",
+                            "order": "desc"
+                        }
                     }
-                )
+                }
+            ]
+        }
+        if after:
+            composite["after"] = {"date": after}
 
-        filters = {
-            "type_primary": type_primary, 
-            "type_secondary": type_secondary, 
-            "publisher": publisher
+        aggs = {
+            "Publicatiedatum": {
+                "composite": composite,
+                "aggs": self.build_documents_aggregation(TIMELINE_PAGE_DOCUMENTS_PER_DAY)
+            }
         }
+        if not after:
+            aggs.update(self.build_facet_aggregations())
 
-        return objects_to_return, filters
+        body = {
+            "size": 0,
+            "query": self.build_search_query(config, self.build_search_filters(config)),
+            "aggs": aggs
+        }
+
+        response = get_search_backend().search("es_hackethon", body)
+
+        timeline = response["aggregations"]["Publicatiedatum"]
+        objects_to_return = [
+            self.parse_date_bucket(date_bucket["key"]["date"], date_bucket)
+            for date_bucket in timeline["buckets"]
+        ]
+
+        filters = {}
+        if not after:
+            filters = self.parse_facets(response["aggregations"])
+
+        next_cursor = None
+        if len(timeline["buckets"]) == page_size and "after_key" in timeline:
+            next_cursor = timeline["after_key"]["date"]
+
+        if cache_key is not None:
+            SEARCH_CACHE.set(cache_key, (objects_to_return, filters, next_cursor))
+
+        return objects_to_return, filters, next_cursor
 
     def update_document(self, index, chunk_id, update_body):
         """
@@ -369,16 +855,66 @@ class ChunkSearchingClass:
         :return: The response of the update operation.
         """
         try:
-            response = OPENSEARCH_CONNECTION.update(
-                index="es_hackethon",
-                id=chunk_id,    
-                body={"doc": update_body}
-            )
+            response = get_search_backend().update("es_hackethon", chunk_id, update_body)
+            if SEARCH_CACHE is not None:
+                SEARCH_CACHE.invalidate()
+            if ANSWER_CACHE is not None:
+                self.invalidate_answers(chunk_id, update_body)
+            update_facet_index(chunk_id, update_body)
             return response
         except Exception as e:
             print(f"Failed to update document {chunk_id}: {str(e)}")
             return None
         
+    def invalidate_answers(self, chunk_id, update_body):
+        """Removes the cached chat answers about the document of an updated chunk"""
+
+        source = update_body.get("doc", update_body)
+        document_id = source.get("document_id")
+        if document_id is None:
+            chunk = self.get_by_id(chunk_id)
+            document_id = chunk.get("document_id") if chunk else None
+
+        if document_id is None:
+            ANSWER_CACHE.clear()
+        else:
+            ANSWER_CACHE.invalidate_documents([document_id])
+
+    def get_by_ids(self, chunk_ids):
+        """
+        Retrieves several documents by their unique identifiers in a single multi-search.
+
+        :param chunk_ids: The unique identifiers of the documents to retrieve.
+
+        :return: The document records, in the order of `chunk_ids`; None for documents that were not found.
+        """
+        if not chunk_ids:
+            return []
+
+        try:
+            responses = get_search_backend().msearch(
+                "es_hackethon",
+                [
+                    {"size": 1, "query": {"bool": {"must": [{"term": {"chunk_id.keyword": chunk_id}}]}}}
+                    for chunk_id in chunk_ids
+                ],
+                raise_on_error=False
+            )
+        except Exception as e:
+            print(f"Failed to retrieve documents {chunk_ids}: {str(e)}")
+            return [self.get_by_id(chunk_id) for chunk_id in chunk_ids]
+
+        documents = []
+        for chunk_id, response in zip(chunk_ids, responses):
+            if "hits" not in response:
+                # A failed item of the multi-search carries an "error" instead of hits
+                print(f"Failed to retrieve document {chunk_id}: {response.get('error')}")
+                documents.append(self.get_by_id(chunk_id))
+            else:
+                documents.append(response["hits"]["hits"][0]["_source"] if response["hits"]["hits"] else None)
+
+        return documents
+
     def get_by_id(self, chunk_id):
         """
         Retrieves a document from the specified OpenSearch index by its unique identifier.
@@ -389,9 +925,9 @@ class ChunkSearchingClass:
         :return: The document record.
         """
         try:
-            response = OPENSEARCH_CONNECTION.search(
-                index="es_hackethon", 
-                body={"query": {"bool": {"must": [{"term": {"chunk_id.keyword": chunk_id}}]}}}
+            response = get_search_backend().search(
+                "es_hackethon",
+                {"query": {"bool": {"must": [{"term": {"chunk_id.keyword": chunk_id}}]}}}
             )
             hits = response['hits']['hits']
             if hits:
@@ -0,0 +1,852 @@
+"""Search backends used to talk to the search indices
+
+The application only talks to its indices through a `SearchBackend`. The
+default backend forwards every call to an OpenSearch (or Elasticsearch)
+client. The in-memory backend evaluates the subset of the query DSL this
+application uses, so the whole API can be run and load-tested without a cluster.
+"""
+
+import fnmatch
+import json
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Either "opensearch" or "memory"
+SEARCH_BACKEND = os.getenv("SEARCH_BACKEND", "opensearch")
+# NDJSON file with the documents the in-memory backend starts with
+SEARCH_BACKEND_FIXTURE = os.getenv("SEARCH_BACKEND_FIXTURE")
+
+OPENSEARCH_URL = os.getenv("OPENSEARCH_URL")
+OPENSEARCH_USERNAME = os.getenv("OPENSEARCH_USERNAME")
+OPENSEARCH_PASSWORD = os.getenv("OPENSEARCH_PASSWORD")
+# Engine of the `content_embedding` kNN field, "nmslib", "faiss" or "lucene"; it decides the kNN scores
+OPENSEARCH_KNN_ENGINE = os.getenv("OPENSEARCH_KNN_ENGINE", "nmslib")
+# The engines that apply a kNN `filter` during the graph search; nmslib rejects it
+KNN_FILTER_ENGINES = {"lucene", "faiss"}
+
+
+def knn_cosine_score(similarity, engine=None):
+    """Returns the score a kNN query gives a neighbour in the "cosinesimil" space
+
+    nmslib and faiss score the distance ``1 - cos`` as ``1 / (1 + distance)``,
+    Lucene scores ``(1 + cos) / 2``. The exact `knn_score` script differs from
+    both and scores ``1 + cos``.
+
+    :param similarity: The cosine similarity of the neighbour and the query vector
+    :param engine: The kNN engine, defaults to OPENSEARCH_KNN_ENGINE
+
+    :returns: The score of the neighbour
+    :rtype: float
+    """
+
+    if (engine or OPENSEARCH_KNN_ENGINE) == "lucene":
+        return (1.0 + similarity) / 2.0
+
+    return 1.0 / (2.0 - similarity)
+
+
+class SearchBackend:
+    """Interface of a search backend"""
+
+    def search(self, index, body):
+        """Runs a search request and returns the raw response
+
+        :param index: The name of the index
+        :param body: The search request body, with `query`, `size`, `aggs`, ...
+
+        :returns: The search response
+        :rtype: dict
+        """
+
+        raise NotImplementedError
+
+    def msearch(self, index, bodies, raise_on_error=True):
+        """Runs several independent search requests
+
+        Backends without a native multi-search run the requests concurrently.
+
+        :param index: The name of the index
+        :param bodies: A list of search request bodies
+        :param raise_on_error: Whether a failed request raises, otherwise its response is
+            an ``{"error": ...}`` item, like in the OpenSearch `_msearch` response
+
+        :returns: The search responses, in the order of `bodies`
+        :rtype: list
+        """
+
+        def search(body):
+            try:
+                return self.search(index, body)
+            except Exception as e:
+                if raise_on_error:
+                    raise
+                return {"error": str(e)}
+
+        if len(bodies) <= 1:
+            return [search(body) for body in bodies]
+
+        with ThreadPoolExecutor(max_workers=len(bodies), thread_name_prefix="msearch") as executor:
+            return list(executor.map(search, bodies))
+
+    def aggregate(self, index, query, aggs):
+        """Runs aggregations over the documents matching a query
+
+        :returns: The `aggregations` part of the search response
+        :rtype: dict
+        """
+
+        response = self.search(index, {"size": 0, "query": query, "aggs": aggs})
+
+        return response.get("aggregations", {})
+
+    def get(self, index, document_id):
+        """Retrieves the source of a document by its identifier
+
+        :returns: The document source, or None when it does not exist
+        :rtype: dict
+        """
+
+        raise NotImplementedError
+
+    def update(self, index, document_id, doc):
+        """Partially updates a document
+
+        :param doc: The fields to update
+
+        :returns: The update response
+        :rtype: dict
+        """
+
+        raise NotImplementedError
+
+    def bulk(self, actions):
+        """Runs bulk index, update and delete actions
+
+        :param actions:
+            Actions in the format of `opensearchpy.helpers.bulk`, with `_op_type`,
+            `_index`, `_id` and either `_source` or `doc`
+
+        :returns: A ``(successful, errors)`` tuple
+        :rtype: tuple
+        """
+
+        raise NotImplementedError
+
+    def scan(self, index, body, batch_size=1000):
+        """Iterates over all the hits of a query
+
+        :returns: A generator of hits
+        :rtype: generator
+        """
+
+        raise NotImplementedError
+
+
+class OpenSearchBackend(SearchBackend):
+    """Search backend that forwards every call to an OpenSearch compatible client"""
+
+    def __init__(self, client):
+        """Initializes an `OpenSearchBackend` object
+
+        :param client: An `OpenSearch` or `Elasticsearch` client
+        """
+
+        self.client = client
+
+    def search(self, index, body):
+        return self.client.search(index=index, body=body)
+
+    def msearch(self, index, bodies, raise_on_error=True):
+        """Sends all search requests in a single `_msearch` round-trip"""
+
+        lines = []
+        for body in bodies:
+            lines.append({"index": index})
+            lines.append(body)
+
+        responses = self.client.msearch(body=lines)["responses"]
+        for response in responses:
+            if raise_on_error and "error" in response:
+                raise RuntimeError(f"Multi-search request failed: {response['error']}")
+
+        return responses
+
+    def get(self, index, document_id):
+        try:
+            return self.client.get(index=index, id=document_id)["_source"]
+        except Exception as e:
+            if getattr(e, "status_code", None) == 404:
+                return None
+            raise
+
+    def update(self, index, document_id, doc):
+        return self.client.update(index=index, id=document_id, body={"doc": doc})
+
+    def bulk(self, actions):
+        from opensearchpy import helpers
+
+        return helpers.bulk(self.client, actions, raise_on_error=False)
+
+    def scan(self, index, body, batch_size=1000):
+        from opensearchpy import helpers
+
+        return helpers.scan(self.client, index=index, query=body, size=batch_size)
+
+
+class InMemorySearchBackend(SearchBackend):
+    """Search backend that keeps all documents in memory
+
+    Supports the query clauses `bool`, `term`, `terms`, `match`, `range`,
+    `ids`, `exists`, `match_all`, `match_none`, `constant_score`, `knn` and
+    `script_score` with the k-NN scoring script, and the aggregations
+    `date_histogram`, `composite`, `terms`, `filter`, `top_hits` and `max`.
+    Relevance is simplified: every matching clause scores 1 and a kNN match
+    scores like the OpenSearch kNN query, see `knn_cosine_score`.
+    """
+
+    def __init__(self, documents=None):
+        """Initializes an `InMemorySearchBackend` object
+
+        :param documents: An optional ``{index: {document_id: source}}`` dictionary
+        """
+
+        self.indices = documents or {}
+        self.lock = threading.RLock()
+
+    @classmethod
+    def from_fixture(cls, path):
+        """Loads documents from an NDJSON file
+
+        Every line is either a ``{"_index": ..., "_id": ..., "_source": ...}`` hit or
+        a bare chunk source, which is stored in `es_hackethon` under its `chunk_id`.
+
+        :param path: The path of the NDJSON file
+
+        :returns: An `InMemorySearchBackend` instance
+        :rtype: `InMemorySearchBackend`
+        """
+
+        backend = cls()
+        with open(path, encoding="utf-8") as fixture:
+            for line in fixture:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if "_source" in record:
+                    backend.index(record["_index"], record["_id"], record["_source"])
+                else:
+                    backend.index("es_hackethon", record["chunk_id"], record)
+
+        return backend
+
+    def index(self, index, document_id, source):
+        """Stores a document, replacing any existing document with the same identifier"""
+
+        with self.lock:
+            self.indices.setdefault(index, {})[str(document_id)] = source
+
+    # Search
+
+    def search(self, index, body):
+        started = time.perf_counter()
+        body = body or {}
+        query = body.get("query", {"match_all": {}})
+
+        with self.lock:
+            documents = list(self.indices.get(index, {}).items())
+
+        knn_scores = self._prepare_knn(query, documents)
+        matches = []
+        for document_id, source in documents:
+            matched, score = self._evaluate(query, document_id, source, knn_scores)
+            if matched:
+                matches.append((document_id, source, score))
+
+        hits = self._sort(matches, body.get("sort"))
+        offset = body.get("from", 0)
+        size = body.get("size", 10)
+
+        response = {
+            "took": int((time.perf_counter() - started) * 1000),
+            "timed_out": False,
+            "hits": {
+                "total": {"value": len(matches), "relation": "eq"},
+                "max_score": max((match[2] for match in matches), default=None),
+                "hits": [
+                    self._hit(index, match, body.get("_source"))
+                    for match in hits[offset:offset + size]
+                ],
+            },
+        }
+
+        aggs = body.get("aggs", body.get("aggregations"))
+        if aggs:
+            response["aggregations"] = self._aggregate(aggs, matches, index)
+
+        return response
+
+    def get(self, index, document_id):
+        with self.lock:
+            return self.indices.get(index, {}).get(str(document_id))
+
+    def update(self, index, document_id, doc):
+        with self.lock:
+            source = self.indices.get(index, {}).get(str(document_id))
+            if source is None:
+                raise KeyError(f"Document {document_id} does not exist in {index}")
+            source.update(doc)
+
+        return {"_index": index, "_id": str(document_id), "result": "updated"}
+
+    def bulk(self, actions):
+        successful = 0
+        errors = []
+        for action in actions:
+            operation = action.get("_op_type", "index")
+            try:
+                if operation in ("index", "create"):
+                    self.index(action["_index"], action["_id"], action["_source"])
+                elif operation == "update":
+                    self.update(action["_index"], action["_id"], action["doc"])
+                elif operation == "delete":
+                    with self.lock:
+                        self.indices.get(action["_index"], {}).pop(str(action["_id"]), None)
+                else:
+                    raise ValueError(f"Unsupported bulk operation: {operation}")
+                successful += 1
+            except Exception as e:
+                errors.append({operation: {"_id": action.get("_id"), "error": str(e)}})
+
+        return successful, errors
+
+    def scan(self, index, body, batch_size=1000):
+        body = dict(body or {})
+        body.pop("aggs", None)
+        body.pop("aggregations", None)
+        body["size"] = len(self.indices.get(index, {}))
+
+        yield from self.search(index, body)["hits"]["hits"]
+
+    # Query evaluation
+
+    @staticmethod
+    def _values(source, field):
+        """Returns the values of a (dotted) field in a source as a list"""
+
+        if field.endswith(".keyword"):
+            field = field[: -len(".keyword")]
+
+        values = [source]
+        for part in field.split("."):
+            next_values = []
+            for value in values:
+                if isinstance(value, dict) and part in value:
+                    child = value[part]
+                    if isinstance(child, list):
+                        next_values.extend(child)
+                    else:
+                        next_values.append(child)
+            values = next_values
+
+        return [value for value in values if value is not None]
+
+    @staticmethod
+    def _tokens(text):
+        return re.findall(r"\w+", str(text).lower())
+
+    @staticmethod
+    def _compare(value, bound):
+        """Compares numbers numerically and everything else as strings"""
+
+        try:
+            return (float(value) > float(bound)) - (float(value) < float(bound))
+        except (TypeError, ValueError):
+            value, bound = str(value), str(bound)
+            return (value > bound) - (value < bound)
+
+    def _prepare_knn(self, query, documents):
+        """Computes the nearest neighbours for every kNN clause in a query"""
+
+        knn_scores = {}
+
+        def walk(clause):
+            if isinstance(clause, dict):
+                if "knn" in clause:
+                    for field, options in clause["knn"].items():
+                        knn_scores[id(clause)] = self._knn(field, options, documents)
+                for value in clause.values():
+                    walk(value)
+            elif isinstance(clause, list):
+                for value in clause:
+                    walk(value)
+
+        walk(query)
+
+        return knn_scores
+
+    def _knn(self, field, options, documents):
+        """Returns the `k` nearest documents for a kNN clause as ``{document_id: score}``"""
+
+        candidates = []
+        vectors = []
+        for document_id, source in documents:
+            if "filter" in options and not self._evaluate(options["filter"], document_id, source, {})[0]:
+                continue
+            vector = source.get(field)
+            if vector is not None and len(vector) > 0:
+                candidates.append(document_id)
+                vectors.append(vector)
+
+        if not candidates:
+            return {}
+
+        matrix = np.asarray(vectors, dtype=np.float32)
+        matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+        query = np.asarray(options["vector"], dtype=np.float32)
+        query /= max(float(np.linalg.norm(query)), 1e-12)
+
+        scores = matrix @ query
+        best = np.argsort(-scores)[: options.get("k", 10)]
+
+        return {candidates[i]: knn_cosine_score(float(scores[i])) for i in best}
+
+    def _evaluate(self, query, document_id, source, knn_scores):
+        """Evaluates a query clause against a document
+
+        :returns: A ``(matched, score)`` tuple
+        :rtype: tuple
+        """
+
+        if not query:
+            return True, 1.0
+
+        (clause_type, clause), = query.items()
+
+        if clause_type == "match_all":
+            return True, clause.get("boost", 1.0)
+
+        if clause_type == "match_none":
+            return False, 0.0
+
+        if clause_type == "bool":
+            score = 0.0
+            for must in self._as_list(clause.get("must")):
+                matched, must_score = self._evaluate(must, document_id, source, knn_scores)
+                if not matched:
+                    return False, 0.0
+                score += must_score
+            for must_filter in self._as_list(clause.get("filter")):
+                if not self._evaluate(must_filter, document_id, source, knn_scores)[0]:
+                    return False, 0.0
+            for must_not in self._as_list(clause.get("must_not")):
+                if self._evaluate(must_not, document_id, source, knn_scores)[0]:
+                    return False, 0.0
+
+            should = self._as_list(clause.get("should"))
+            minimum = clause.get(
+                "minimum_should_match",
+                0 if clause.get("must") or clause.get("filter") else (1 if should else 0),
+            )
+            matched_should = 0
+            for should_clause in should:
+                matched, should_score = self._evaluate(should_clause, document_id, source, knn_scores)
+                if matched:
+                    matched_should += 1
+                    score += should_score
+            if matched_should < int(minimum):
+                return False, 0.0
+
+            return True, score * clause.get("boost", 1.0)
+
+        if clause_type == "constant_score":
+            matched = self._evaluate(clause["filter"], document_id, source, knn_scores)[0]
+            return matched, clause.get("boost", 1.0) if matched else 0.0
+
+        if clause_type == "script_score":
+            matched = self._evaluate(clause["query"], document_id, source, knn_scores)[0]
+            if not matched:
+                return False, 0.0
+            return True, self._script_score(clause["script"], source)
+
+        if clause_type == "knn":
+            scores = knn_scores.get(id(query), {})
+            if document_id in scores:
+                return True, scores[document_id]
+            return False, 0.0
+
+        if clause_type == "ids":
+            return document_id in [str(value) for value in clause["values"]], 1.0
+
+        if clause_type == "exists":
+            return bool(self._values(source, clause["field"])), 1.0
+
+        (field, options), = clause.items()
+
+        if clause_type == "term":
+            expected = options["value"] if isinstance(options, dict) else options
+            return expected in self._values(source, field), 1.0
+
+        if clause_type == "terms":
+            expected = set(options)
+            return any(value in expected for value in self._values(source, field)), 1.0
+
+        if clause_type == "match":
+            text = options["query"] if isinstance(options, dict) else options
+            values = self._values(source, field)
+            if field.endswith(".keyword"):
+                return text in values, 1.0
+            query_tokens = set(self._tokens(text))
+            value_tokens = set(token for value in values for token in self._tokens(value))
+            matched = query_tokens & value_tokens
+            if not matched:
+                return False, 0.0
+            return True, len(matched) / len(query_tokens)
+
+        if clause_type == "range":
+            for value in self._values(source, field):
+                if all(
+                    operator not in options or check(self._compare(value, options[operator]))
+                    for operator, check in [
+                        ("gte", lambda result: result >= 0),
+                        ("gt", lambda result: result > 0),
+                        ("lte", lambda result: result <= 0),
+                        ("lt", lambda result: result < 0),
+                    ]
+                ):
+                    return True, 1.0
+            return False, 0.0
+
+        raise ValueError(f"Unsupported query clause: {clause_type}")
+
+    def _script_score(self, script, source):
+        """Scores a document with the exact k-NN scoring script of the k-NN plugin"""
+
+        if script.get("lang") != "knn" or script.get("source") != "knn_score":
+            raise ValueError(f"Unsupported script: {script.get('source')}")
+
+        params = script["params"]
+        vector = source.get(params["field"])
+        if vector is None or len(vector) == 0:
+            return 0.0
+
+        vector = np.asarray(vector, dtype=np.float32)
+        query = np.asarray(params["query_value"], dtype=np.float32)
+        space_type = params.get("space_type", "l2")
+
+        if space_type == "cosinesimil":
+            norms = max(float(np.linalg.norm(vector) * np.linalg.norm(query)), 1e-12)
+            return 1.0 + float(vector @ query) / norms
+        if space_type == "innerproduct":
+            product = float(vector @ query)
+            return 1.0 + product if product >= 0 else 1.0 / (1.0 - product)
+        if space_type == "l2":
+            return 1.0 / (1.0 + float(np.sum((vector - query) ** 2)))
+
+        raise ValueError(f"Unsupported space type: {space_type}")
+
+    @staticmethod
+    def _as_list(value):
+        if value is None:
+            return []
+        if isinstance(value, list):
+            return value
+        return [value]
+
+    # Hits
+
+    def _sort(self, matches, sort=None):
+        """Sorts matches on score (the default) or on the given fields"""
+
+        if not sort:
+            return sorted(matches, key=lambda match: -match[2])
+
+        sorted_matches = list(matches)
+        for sort_clause in reversed(self._as_list(sort)):
+            if isinstance(sort_clause, str):
+                field, order = sort_clause, "asc" if sort_clause != "_score" else "desc"
+            else:
+                (field, options), = sort_clause.items()
+                order = options.get("order", "asc") if isinstance(options, dict) else options
+
+            def sort_key(match, field=field):
+                if field == "_score":
+                    return match[2]
+                values = self._values(match[1], field)
+                return (values[0] is None, values[0]) if values else (True, "")
+
+            sorted_matches.sort(key=sort_key, reverse=order == "desc")
+
+        return sorted_matches
+
+    def _filter_source(self, source, source_filter):
+        """Applies `_source` includes and excludes to a source"""
+
+        if source_filter is None or source_filter is True:
+            return source
+        if source_filter is False:
+            return {}
+
+        if isinstance(source_filter, (list, str)):
+            includes, excludes = self._as_list(source_filter), []
+        else:
+            includes = self._as_list(source_filter.get("includes"))
+            excludes = self._as_list(source_filter.get("excludes"))
+
+        def keep(path):
+            if any(fnmatch.fnmatch(path, pattern) for pattern in excludes):
+                return False
+            return not includes or any(
+                fnmatch.fnmatch(path, pattern) or pattern.startswith(path + ".")
+                for pattern in includes
+            )
+
+        def filter_dict(value, prefix=""):
+            filtered = {}
+            for key, child in value.items():
+                path = f"{prefix}{key}"
+                if not keep(path):
+                    continue
+                if isinstance(child, dict):
+                    filtered[key] = filter_dict(child, path + ".")
+                else:
+                    filtered[key] = child
+            return filtered
+
+        return filter_dict(source)
+
+    def _hit(self, index, match, source_filter=None):
+        document_id, source, score = match
+
+        return {
+            "_index": index,
+            "_id": document_id,
+            "_score": score,
+            "_source": self._filter_source(source, source_filter),
+        }
+
+    # Aggregations
+
+    def _aggregate(self, aggs, matches, index):
+        """Computes the aggregations over a list of ``(document_id, source, score)`` matches"""
+
+        results = {}
+        for name, aggregation in aggs.items():
+            sub_aggs = aggregation.get("aggs", aggregation.get("aggregations"))
+            aggregation_type = next(
+                key for key in aggregation if key not in ("aggs", "aggregations")
+            )
+            options = aggregation[aggregation_type]
+
+            if aggregation_type == "date_histogram":
+                results[name] = self._date_histogram(options, matches, sub_aggs, index)
+            elif aggregation_type == "composite":
+                results[name] = self._composite(options, matches, sub_aggs, index)
+            elif aggregation_type == "terms":
+                results[name] = self._terms(options, matches, sub_aggs, index)
+            elif aggregation_type == "filter":
+                filtered = [match for match in matches if self._evaluate(options, match[0], match[1], {})[0]]
+                results[name] = {"doc_count": len(filtered)}
+                if sub_aggs:
+                    results[name].update(self._aggregate(sub_aggs, filtered, index))
+            elif aggregation_type == "top_hits":
+                hits = self._sort(matches, options.get("sort"))
+                results[name] = {
+                    "hits": {
+                        "total": {"value": len(matches), "relation": "eq"},
+                        "max_score": max((match[2] for match in matches), default=None),
+                        "hits": [
+                            self._hit(index, match, options.get("_source"))
+                            for match in hits[: options.get("size", 3)]
+                        ],
+                    }
+                }
+            elif aggregation_type == "max":
+                if "field" in options:
+                    values = [
+                        float(value)
+                        for match in matches
+                        for value in self._values(match[1], options["field"])
+                    ]
+                else:
+                    # Only the `_score` script is supported
+                    values = [match[2] for match in matches]
+                results[name] = {"value": max(values) if values else None}
+            else:
+                raise ValueError(f"Unsupported aggregation: {aggregation_type}")
+
+        return results
+
+    def _bucket(self, key, matches, sub_aggs, index, key_as_string=None):
+        bucket = {"key": key, "doc_count": len(matches)}
+        if key_as_string is not None:
+            bucket["key_as_string"] = key_as_string
+        if sub_aggs:
+            bucket.update(self._aggregate(sub_aggs, matches, index))
+
+        return bucket
+
+    @staticmethod
+    def _date_key(value, interval):
+        """Returns the formatted start of the calendar interval a date falls in"""
+
+        date = str(value)[:10]
+        if interval == "month":
+            return date[:7] + "-01"
+        if interval == "year":
+            return date[:4] + "-01-01"
+
+        return date
+
+    @staticmethod
+    def _epoch_millis(date):
+        moment = datetime.strptime(date, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+
+        return int(moment.timestamp() * 1000)
+
+    def _group(self, matches, key_function):
+        groups = {}
+        for match in matches:
+            for key in set(key_function(match)):
+                groups.setdefault(key, []).append(match)
+
+        return groups
+
+    def _date_groups(self, options, matches):
+        interval = options.get("calendar_interval", "day")
+
+        return self._group(
+            matches,
+            lambda match: [
+                self._date_key(value, interval)
+                for value in self._values(match[1], options["field"])
+            ],
+        )
+
+    def _date_histogram(self, options, matches, sub_aggs, index):
+        groups = self._date_groups(options, matches)
+        order = options.get("order", {"_key": "asc"})
+        descending = order.get("_key", order.get("_count")) == "desc"
+        sort_on_count = "_count" in order
+
+        keys = sorted(
+            groups,
+            key=lambda key: (len(groups[key]), key) if sort_on_count else key,
+            reverse=descending,
+        )
+
+        return {
+            "buckets": [
+                self._bucket(self._epoch_millis(key), groups[key], sub_aggs, index, key)
+                for key in keys
+                if len(groups[key]) >= options.get("min_doc_count", 0)
+            ]
+        }
+
+    def _composite(self, options, matches, sub_aggs, index):
+        # Only a single date_histogram or terms source is supported
+        (source_name, source), = options["sources"][0].items()
+        (source_type, source_options), = source.items()
+
+        if source_type == "date_histogram":
+            groups = self._date_groups(source_options, matches)
+        else:
+            groups = self._group(
+                matches, lambda match: self._values(match[1], source_options["field"])
+            )
+
+        descending = source_options.get("order", "asc") == "desc"
+        keys = sorted(groups, reverse=descending)
+
+        after = options.get("after", {}).get(source_name)
+        if after is not None:
+            keys = [key for key in keys if (key < after if descending else key > after)]
+        keys = keys[: options.get("size", 10)]
+
+        result = {
+            "buckets": [
+                self._bucket({source_name: key}, groups[key], sub_aggs, index)
+                for key in keys
+            ]
+        }
+        if keys:
+            result["after_key"] = {source_name: keys[-1]}
+
+        return result
+
+    def _terms(self, options, matches, sub_aggs, index):
+        groups = self._group(
+            matches, lambda match: [str(value) for value in self._values(match[1], options["field"])]
+        )
+        keys = sorted(groups, key=lambda key: (-len(groups[key]), key))[: options.get("size", 10)]
+
+        return {
+            "doc_count_error_upper_bound": 0,
+            "sum_other_doc_count": sum(len(groups[key]) for key in groups) - sum(len(groups[key]) for key in keys),
+            "buckets": [self._bucket(key, groups[key], sub_aggs, index) for key in keys],
+        }
+
+
+def _opensearch_backend():
+    from opensearchpy import OpenSearch
+
+    return OpenSearchBackend(
+        OpenSearch(
+            OPENSEARCH_URL,
+            http_auth=(OPENSEARCH_USERNAME, OPENSEARCH_PASSWORD),
+            request_timeout=900,
+            verify_certs=False,
+        )
+    )
+
+
+_BACKEND_FACTORIES = {"hackathon": _opensearch_backend}
+_BACKENDS = {}
+_BACKENDS_LOCK = threading.Lock()
+_MEMORY_BACKEND = None
+
+
+def register_search_backend(name, factory):
+    """Registers the factory of a named backend for the "opensearch" mode
+
+    :param name: The name of the backend
+    :param factory: A callable without arguments that returns a `SearchBackend`
+    """
+
+    _BACKEND_FACTORIES[name] = factory
+
+
+def get_search_backend(name="hackathon"):
+    """Returns the process-wide search backend with the given name
+
+    Backends are created on first use. With ``SEARCH_BACKEND=memory`` every
+    name shares a single `InMemorySearchBackend`, loaded from `SEARCH_BACKEND_FIXTURE`.
+
+    :param name: The name of the backend
+
+    :returns: A `SearchBackend` instance
+    :rtype: `SearchBackend`
+    """
+
+    global _MEMORY_BACKEND
+
+    with _BACKENDS_LOCK:
+        if SEARCH_BACKEND == "memory":
+            if _MEMORY_BACKEND is None:
+                if SEARCH_BACKEND_FIXTURE:
+                    _MEMORY_BACKEND = InMemorySearchBackend.from_fixture(SEARCH_BACKEND_FIXTURE)
+                else:
+                    _MEMORY_BACKEND = InMemorySearchBackend()
+            return _MEMORY_BACKEND
+
+        if name not in _BACKENDS:
+            _BACKENDS[name] = _BACKEND_FACTORIES[name]()
+
+        return _BACKENDS[name]
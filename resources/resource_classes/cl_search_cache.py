@@ -0,0 +1,154 @@
+"""Cache for the parsed results of `ChunkSearchingClass.search_documents`"""
+
+import copy
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from dotenv import load_dotenv
+from resources.resource_classes.cl_local_storage import (
+    cache_key,
+    local_storage_path,
+    normalize_cache_text,
+)
+
+load_dotenv()
+
+SEARCH_CACHE_ENABLED = os.getenv("SEARCH_CACHE_ENABLED", "true").lower() == "true"
+SEARCH_CACHE_TTL_SECONDS = int(os.getenv("SEARCH_CACHE_TTL_SECONDS", "300"))
+SEARCH_CACHE_MAX_ENTRIES = int(os.getenv("SEARCH_CACHE_MAX_ENTRIES", "256"))
+SEARCH_CACHE_GENERATION_FILE = os.getenv(
+    "SEARCH_CACHE_GENERATION_FILE", "search_cache.generation"
+)
+
+# The search config fields that determine the search results
+SEARCH_CACHE_KEY_FIELDS = [
+    "search_string",
+    "search_from",
+    "search_until",
+    "publisher",
+    "type_primary",
+    "type_secondary",
+]
+
+
+class SearchResultCache:
+    """Caches the ``(objects, filters)`` tuple of a search per search config
+
+    Entries expire after a TTL. Invalidation touches a generation file in the
+    local storage folder, so every gunicorn worker drops its entries as well.
+    """
+
+    def __init__(self, ttl=None, max_entries=None, generation_path=None):
+        """Initializes a `SearchResultCache` object
+
+        :param ttl: Number of seconds after which an entry expires
+        :param max_entries: Maximum number of entries kept in the cache
+        :param generation_path: The path of the shared generation file
+        """
+
+        self.ttl = ttl if ttl is not None else SEARCH_CACHE_TTL_SECONDS
+        self.max_entries = max_entries or SEARCH_CACHE_MAX_ENTRIES
+        self.generation_path = generation_path or local_storage_path(
+            SEARCH_CACHE_GENERATION_FILE
+        )
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.generation = self._read_generation()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def build_key(config, *extra):
+        """Builds a canonical cache key for a search config
+
+        The order of the values in the list filters does not matter, and the
+        embedding is left out because it is derived from the search string.
+
+        :param config: The search config passed to `search_documents`
+        :param extra: Additional values that distinguish the cached result
+
+        :returns: The cache key
+        :rtype: str
+        """
+
+        canonical = {}
+        for field in SEARCH_CACHE_KEY_FIELDS:
+            value = config.get(field)
+            if isinstance(value, (list, tuple)):
+                value = sorted(value)
+            elif field == "search_string":
+                value = normalize_cache_text(value)
+            canonical[field] = value or None
+
+        return cache_key(json.dumps(canonical, sort_keys=True), *extra)
+
+    def _read_generation(self):
+        """Reads the generation that is shared by all processes"""
+
+        try:
+            return os.stat(self.generation_path).st_mtime_ns
+        except FileNotFoundError:
+            return 0
+
+    def _check_generation(self):
+        """Drops all entries when another process invalidated the cache"""
+
+        generation = self._read_generation()
+        if generation != self.generation:
+            self.entries.clear()
+            self.generation = generation
+
+    def get(self, key):
+        """Retrieves a copy of a cached result
+
+        :returns: The cached result, or None when there is no valid entry
+        """
+
+        with self.lock:
+            self._check_generation()
+            entry = self.entries.get(key)
+            if entry is None or time.monotonic() - entry[0] > self.ttl:
+                self.entries.pop(key, None)
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            result = entry[1]
+
+        # Callers enrich the results in place, so they always get their own copy
+        return copy.deepcopy(result)
+
+    def set(self, key, result):
+        """Stores a copy of a result"""
+
+        result = copy.deepcopy(result)
+
+        with self.lock:
+            self._check_generation()
+            self.entries[key] = (time.monotonic(), result)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self):
+        """Drops all cached results in every process"""
+
+        with self.lock:
+            self.entries.clear()
+            try:
+                with open(self.generation_path, "a"):
+                    os.utime(self.generation_path)
+            except OSError as e:
+                print(f"Failed to invalidate the search cache: {str(e)}")
+            self.generation = self._read_generation()
+
+    def stats(self):
+        """Returns the hit/miss counters and the size of the cache"""
+
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.entries)}
+
+
+SEARCH_CACHE = SearchResultCache() if SEARCH_CACHE_ENABLED else None
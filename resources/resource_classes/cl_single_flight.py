@@ -0,0 +1,342 @@
+"""Coalesces identical concurrent Mistral calls into a single upstream call"""
+
+import asyncio
+import json
+import os
+import threading
+import time
+from concurrent.futures import Future
+from dotenv import load_dotenv
+from resources.resource_classes.cl_local_storage import LocalSQLiteStore, cache_key, local_storage_path
+
+load_dotenv()
+
+SINGLE_FLIGHT_ENABLED = os.getenv("SINGLE_FLIGHT_ENABLED", "true").lower() == "true"
+SINGLE_FLIGHT_FILE = os.getenv("SINGLE_FLIGHT_FILE", "single_flight.db")
+# Seconds a finished result stays readable for the callers in other processes that were already
+# waiting for it. It only has to cover one poll interval: callers that arrive after the call
+# finished never get the result, they make a call of their own.
+SINGLE_FLIGHT_RESULT_RETENTION_SECONDS = float(os.getenv("SINGLE_FLIGHT_RESULT_RETENTION_SECONDS", "2"))
+# Seconds after which a call claimed by another process is considered lost
+SINGLE_FLIGHT_TIMEOUT_SECONDS = float(os.getenv("SINGLE_FLIGHT_TIMEOUT_SECONDS", "120"))
+
+# Seconds between two checks for the result of a call in another process
+SINGLE_FLIGHT_POLL_SECONDS = 0.02
+# Expired entries are purged once every this many claims
+SINGLE_FLIGHT_PURGE_INTERVAL = 200
+
+
+class SingleFlight(LocalSQLiteStore):
+    """Lets concurrent callers with the same key share the result of one call
+
+    Within a process, the first caller runs the call and the others wait on
+    its future. Across gunicorn workers, the first process claims the key in a
+    shared SQLite table and publishes the JSON encoded result there; the other
+    processes poll for it with read-only queries. Only callers that started
+    waiting before the call finished get its result, so this is not a cache.
+    A failed call is not shared across processes: the waiting processes then
+    make the call themselves.
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS single_flight (
+            flight_key TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            claimed_at REAL NOT NULL,
+            result TEXT,
+            finished_at REAL
+        );
+        CREATE INDEX IF NOT EXISTS ix_single_flight_claimed_at
+            ON single_flight (claimed_at);
+    """
+
+    def __init__(self, path=None):
+        super().__init__(path or local_storage_path(SINGLE_FLIGHT_FILE))
+        self.flights_lock = threading.Lock()
+        self.flights = {}
+        self.async_flights = {}
+        self.shared_calls = 0
+        self._claims = 0
+
+    def reset(self):
+        """Forgets the calls in flight, e.g. in a freshly forked child where their threads do not exist"""
+
+        self.flights_lock = threading.Lock()
+        self.flights = {}
+        self.async_flights = {}
+
+    @staticmethod
+    def build_key(*parts):
+        """Builds the key of a call from its normalized parts, e.g. the model and the input"""
+
+        return cache_key("single_flight", *parts)
+
+    # Cross-process coordination
+
+    @staticmethod
+    def _state(row, now, since):
+        """Interprets the row of a key for a caller that started waiting at `since`
+
+        :returns: "free", "running" or "finished"
+        :rtype: str
+        """
+
+        if row is None:
+            return "free"
+
+        result, finished_at, claimed_at = row
+        if finished_at is not None:
+            # Results of calls that finished before the caller arrived are not reused
+            if since <= finished_at and finished_at >= now - SINGLE_FLIGHT_RESULT_RETENTION_SECONDS:
+                return "finished"
+            return "free"
+
+        # A call whose process got lost can be claimed again
+        return "free" if claimed_at < now - SINGLE_FLIGHT_TIMEOUT_SECONDS else "running"
+
+    def _peek(self, key, since):
+        """Reads the state of a key without taking a write lock on the database
+
+        :returns: ``(state, result_json)``, see `_state`
+        :rtype: tuple
+        """
+
+        with self.lock:
+            row = self.connection().execute(
+                "SELECT result, finished_at, claimed_at FROM single_flight WHERE flight_key = ?", (key,)
+            ).fetchone()
+
+        state = self._state(row, time.time(), since)
+        return state, row[0] if state == "finished" else None
+
+    def _claim(self, key, since):
+        """Claims a key for this process, unless another process got to it first
+
+        :returns: ``(state, result_json)``, where the state is "claimed", "running" or "finished"
+        :rtype: tuple
+        """
+
+        now = time.time()
+        owner = str(os.getpid())
+
+        with self.lock:
+            connection = self.connection()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                self._claims += 1
+                if self._claims % SINGLE_FLIGHT_PURGE_INTERVAL == 0:
+                    connection.execute(
+                        "DELETE FROM single_flight WHERE (finished_at IS NOT NULL AND finished_at < ?) "
+                        "OR (finished_at IS NULL AND claimed_at < ?)",
+                        (now - SINGLE_FLIGHT_RESULT_RETENTION_SECONDS, now - SINGLE_FLIGHT_TIMEOUT_SECONDS),
+                    )
+
+                row = connection.execute(
+                    "SELECT result, finished_at, claimed_at FROM single_flight WHERE flight_key = ?", (key,)
+                ).fetchone()
+                state = self._state(row, now, since)
+                if state == "free":
+                    connection.execute(
+                        "INSERT OR REPLACE INTO single_flight (flight_key, owner, claimed_at) VALUES (?, ?, ?)",
+                        (key, owner, now),
+                    )
+                    state = "claimed"
+                connection.execute("COMMIT")
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+
+        return state, row[0] if state == "finished" else None
+
+    def _coordinate(self, key, since):
+        """Checks a key with a read, and only claims it with a write when it is free
+
+        :returns: ``(state, result_json)``, where the state is "claimed", "running" or "finished"
+        :rtype: tuple
+        """
+
+        state, published = self._peek(key, since)
+        if state == "free":
+            return self._claim(key, since)
+
+        return state, published
+
+    def _publish(self, key, result):
+        with self.lock:
+            self.connection().execute(
+                "UPDATE single_flight SET result = ?, finished_at = ? WHERE flight_key = ? AND owner = ?",
+                (json.dumps(result), time.time(), key, str(os.getpid())),
+            )
+
+    def _release(self, key):
+        with self.lock:
+            self.connection().execute(
+                "DELETE FROM single_flight WHERE flight_key = ? AND owner = ? AND finished_at IS NULL",
+                (key, str(os.getpid())),
+            )
+
+    def _step(self, key, since, function):
+        """Makes one attempt to get the result across processes
+
+        :returns: ``(done, result)``; not done means another process is still making the call
+        :rtype: tuple
+        """
+
+        try:
+            state, published = self._coordinate(key, since)
+        except Exception as e:
+            print(f"Failed to coordinate single flight: {str(e)}")
+            return True, function()
+
+        if state == "running":
+            return False, None
+        if state == "finished":
+            self.shared_calls += 1
+            return True, json.loads(published)
+
+        try:
+            result = function()
+        except Exception:
+            self._release(key)
+            raise
+
+        try:
+            self._publish(key, result)
+        except Exception as e:
+            print(f"Failed to publish single flight result: {str(e)}")
+
+        return True, result
+
+    def _run_shared(self, key, function):
+        since = time.time()
+        deadline = time.monotonic() + SINGLE_FLIGHT_TIMEOUT_SECONDS
+        while time.monotonic() < deadline:
+            done, result = self._step(key, since, function)
+            if done:
+                return result
+            time.sleep(SINGLE_FLIGHT_POLL_SECONDS)
+
+        return function()
+
+    # Public API
+
+    def run(self, key, function):
+        """Runs `function`, unless an identical call is in flight, in which case its result is shared
+
+        :param key: The key built with `build_key`
+        :param function: A callable without arguments that returns a JSON serializable result
+
+        :returns: The result of the call
+        """
+
+        with self.flights_lock:
+            future = self.flights.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self.flights[key] = future
+
+        if not leader:
+            self.shared_calls += 1
+            return future.result()
+
+        try:
+            result = self._run_shared(key, function)
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            with self.flights_lock:
+                self.flights.pop(key, None)
+
+        return result
+
+    async def run_async(self, key, function):
+        """Awaits `function()` like `run`, sharing the result with identical concurrent calls
+
+        The SQLite queries run in a worker thread, so a locked database never
+        blocks the event loop.
+
+        :param key: The key built with `build_key`
+        :param function: A callable without arguments that returns an awaitable with a JSON serializable result
+        """
+
+        future = self.async_flights.get(key)
+        if future is not None:
+            self.shared_calls += 1
+            return await asyncio.shield(future)
+
+        future = asyncio.get_running_loop().create_future()
+        self.async_flights[key] = future
+        try:
+            since = time.time()
+            deadline = time.monotonic() + SINGLE_FLIGHT_TIMEOUT_SECONDS
+            result = None
+            while True:
+                if time.monotonic() >= deadline:
+                    result = await function()
+                    break
+
+                try:
+                    state, published = await asyncio.to_thread(self._coordinate, key, since)
+                except Exception as e:
+                    print(f"Failed to coordinate single flight: {str(e)}")
+                    result = await function()
+                    break
+
+                if state == "claimed":
+                    try:
+                        result = await function()
+                    except BaseException:
+                        await asyncio.to_thread(self._release, key)
+                        raise
+                    try:
+                        await asyncio.to_thread(self._publish, key, result)
+                    except Exception as e:
+                        print(f"Failed to publish single flight result: {str(e)}")
+                    break
+                if state == "finished":
+                    self.shared_calls += 1
+                    result = json.loads(published)
+                    break
+                await asyncio.sleep(SINGLE_FLIGHT_POLL_SECONDS)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # Retrieve the exception, so an unawaited future does not log a warning
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            self.async_flights.pop(key, None)
+
+        return result
+
+
+SINGLE_FLIGHT = SingleFlight() if SINGLE_FLIGHT_ENABLED else None
+
+if SINGLE_FLIGHT is not None and hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=SINGLE_FLIGHT.reset)
+
+
+def single_flight(key_parts, function):
+    """Runs `function` through the process-wide `SingleFlight`, or directly when it is disabled"""
+
+    if SINGLE_FLIGHT is None:
+        return function()
+
+    return SINGLE_FLIGHT.run(SingleFlight.build_key(*key_parts), function)
+
+
+async def single_flight_async(key_parts, function):
+    """Awaits `function()` through the process-wide `SingleFlight`, or directly when it is disabled"""
+
+    if SINGLE_FLIGHT is None:
+        return await function()
+
+    return await SINGLE_FLIGHT.run_async(SingleFlight.build_key(*key_parts), function)
@@ -0,0 +1,357 @@
+"""In-process vector index over a snapshot of the chunk embeddings in OpenSearch"""
+
+import os
+import sys
+import threading
+import numpy as np
+from dotenv import load_dotenv
+from resources.resource_classes.cl_local_storage import local_storage_path
+
+load_dotenv()
+
+# Either "opensearch" (kNN queries run in the cluster) or "local" (this index)
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "opensearch")
+VECTOR_INDEX_FILE = os.getenv("VECTOR_INDEX_FILE", "vector_index.npz")
+# Either "exact" or "ivf"
+VECTOR_INDEX_MODE = os.getenv("VECTOR_INDEX_MODE", "exact")
+VECTOR_INDEX_NPROBE = int(os.getenv("VECTOR_INDEX_NPROBE", "8"))
+
+# Number of rows scored per matrix multiplication, bounds the temporary memory use
+VECTOR_INDEX_BLOCK_SIZE = 65536
+
+VECTOR_INDEX_METADATA_FIELDS = ["chunk_id", "document_id", "publisher", "type_primary"]
+
+
+class LocalVectorIndex:
+    """Answers kNN queries from a contiguous float32 matrix of normalized embeddings
+
+    Every row of the matrix belongs to a chunk, with the chunk id and the
+    metadata used for pre-filtering stored in parallel arrays. Queries are
+    scored with exact cosine similarity, or, when partitions are built, only
+    against the rows in the partitions closest to the query (IVF).
+    """
+
+    def __init__(self, vectors, chunk_ids, document_ids, publishers, type_primary, published):
+        """Initializes a `LocalVectorIndex` object
+
+        :param vectors: A ``(n, dimensions)`` array with one embedding per chunk
+        :param chunk_ids: The chunk id of every row
+        :param document_ids: The document id of every row
+        :param publishers: The publisher of every row
+        :param type_primary: The primary type of every row
+        :param published: The publication date of every row, as ``datetime64[D]``
+        """
+
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        self.vectors = vectors / norms
+
+        self.chunk_ids = np.asarray(chunk_ids, dtype=str)
+        self.document_ids = np.asarray(document_ids, dtype=str)
+        self.publishers = np.asarray(publishers, dtype=str)
+        self.type_primary = np.asarray(type_primary, dtype=str)
+        self.published = np.asarray(published, dtype="datetime64[D]")
+
+        self.centroids = None
+        self.assignments = None
+
+    def __len__(self):
+        return self.vectors.shape[0]
+
+    @staticmethod
+    def parse_date(value):
+        """Parses the date part of an OpenSearch date into a ``datetime64[D]``"""
+
+        if not value:
+            return np.datetime64("NaT", "D")
+
+        try:
+            return np.datetime64(str(value)[:10], "D")
+        except ValueError:
+            return np.datetime64("NaT", "D")
+
+    @classmethod
+    def from_sources(cls, sources):
+        """Builds an index from chunk `_source` dictionaries that contain an embedding
+
+        :param sources: An iterable of chunk sources
+
+        :returns: A `LocalVectorIndex` instance
+        :rtype: `LocalVectorIndex`
+        """
+
+        vectors = []
+        metadata = {field: [] for field in VECTOR_INDEX_METADATA_FIELDS}
+        published = []
+
+        for source in sources:
+            embedding = source.get("content_embedding")
+            if embedding is None or len(embedding) == 0 or "chunk_id" not in source:
+                continue
+
+            vectors.append(np.asarray(embedding, dtype=np.float32))
+            for field in VECTOR_INDEX_METADATA_FIELDS:
+                metadata[field].append(source.get(field) or "")
+            published.append(cls.parse_date(source.get("published")))
+
+        if not vectors:
+            raise ValueError("Cannot build a vector index without any embeddings")
+
+        return cls(
+            np.vstack(vectors),
+            metadata["chunk_id"],
+            metadata["document_id"],
+            metadata["publisher"],
+            metadata["type_primary"],
+            published,
+        )
+
+    @classmethod
+    def from_backend(cls, backend, index="es_hackethon", batch_size=1000):
+        """Builds an index from a snapshot of all the embeddings in a search index
+
+        :param backend: The `SearchBackend` to read the chunks from
+        :param index: The index to read the chunks from
+        :param batch_size: The number of chunks fetched per scroll request
+
+        :returns: A `LocalVectorIndex` instance
+        :rtype: `LocalVectorIndex`
+        """
+
+        hits = backend.scan(
+            index,
+            {
+                "query": {"match_all": {}},
+                "_source": VECTOR_INDEX_METADATA_FIELDS + ["published", "content_embedding"],
+            },
+            batch_size=batch_size,
+        )
+
+        return cls.from_sources(hit["_source"] for hit in hits)
+
+    def save(self, path):
+        """Saves the index, including its partitions, to a ``.npz`` file"""
+
+        arrays = {
+            "vectors": self.vectors,
+            "chunk_ids": self.chunk_ids,
+            "document_ids": self.document_ids,
+            "publishers": self.publishers,
+            "type_primary": self.type_primary,
+            "published": self.published,
+        }
+        if self.centroids is not None:
+            arrays["centroids"] = self.centroids
+            arrays["assignments"] = self.assignments
+
+        np.savez(path, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        """Loads an index that was saved with `save`
+
+        :param path: The path of the ``.npz`` file
+
+        :returns: A `LocalVectorIndex` instance
+        :rtype: `LocalVectorIndex`
+        """
+
+        with np.load(path, allow_pickle=False) as arrays:
+            index = cls(
+                arrays["vectors"],
+                arrays["chunk_ids"],
+                arrays["document_ids"],
+                arrays["publishers"],
+                arrays["type_primary"],
+                arrays["published"],
+            )
+            if "centroids" in arrays:
+                index.centroids = arrays["centroids"]
+                index.assignments = arrays["assignments"]
+
+        return index
+
+    def _nearest_centroids(self, vectors, centroids):
+        """Returns the index of the nearest centroid for every vector"""
+
+        assignments = np.empty(vectors.shape[0], dtype=np.int32)
+        for start in range(0, vectors.shape[0], VECTOR_INDEX_BLOCK_SIZE):
+            block = vectors[start:start + VECTOR_INDEX_BLOCK_SIZE]
+            assignments[start:start + block.shape[0]] = np.argmax(block @ centroids.T, axis=1)
+
+        return assignments
+
+    def build_partitions(self, n_lists=None, iterations=10, seed=0):
+        """Partitions the vectors with spherical k-means for approximate (IVF) search
+
+        :param n_lists: The number of partitions, defaults to the square root of the index size
+        :param iterations: The number of k-means iterations
+        :param seed: The seed used to pick the initial centroids
+        """
+
+        n_lists = min(n_lists or max(1, int(np.sqrt(len(self)))), len(self))
+        rng = np.random.default_rng(seed)
+        centroids = self.vectors[rng.choice(len(self), size=n_lists, replace=False)].copy()
+
+        for _ in range(iterations):
+            assignments = self._nearest_centroids(self.vectors, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, self.vectors)
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            # Empty partitions keep their previous centroid
+            non_empty = norms[:, 0] > 0
+            centroids[non_empty] = sums[non_empty] / norms[non_empty]
+
+        self.centroids = centroids
+        self.assignments = self._nearest_centroids(self.vectors, centroids)
+
+    def filter_mask(self, filters=None):
+        """Builds a boolean mask of the rows that match the metadata pre-filters
+
+        :param filters:
+            A dictionary with optional `publisher`, `type_primary` and `document_id`
+            lists and optional `published_from` (inclusive) and `published_until`
+            (exclusive) dates
+
+        :returns: A boolean array with one entry per row, or None when nothing is filtered
+        :rtype: numpy.ndarray
+        """
+
+        if not filters:
+            return None
+
+        mask = np.ones(len(self), dtype=bool)
+        for field, values in [
+            ("publisher", self.publishers),
+            ("type_primary", self.type_primary),
+            ("document_id", self.document_ids),
+        ]:
+            if filters.get(field):
+                mask &= np.isin(values, np.asarray(filters[field], dtype=str))
+
+        if filters.get("published_from"):
+            mask &= self.published >= self.parse_date(filters["published_from"])
+        if filters.get("published_until"):
+            mask &= self.published < self.parse_date(filters["published_until"])
+
+        return mask
+
+    def _top_k(self, query, rows, k):
+        """Scores one query against the given rows and returns the best `k` rows and scores"""
+
+        if rows.size == 0:
+            return rows, np.empty(0, dtype=np.float32)
+
+        scores = self.vectors[rows] @ query
+        if rows.size > k:
+            best = np.argpartition(-scores, k - 1)[:k]
+        else:
+            best = np.arange(rows.size)
+        best = best[np.argsort(-scores[best])]
+
+        return rows[best], scores[best]
+
+    def search(self, vectors, k=100, filters=None, mode=None, nprobe=None):
+        """Finds the `k` most similar chunks for one or more query vectors
+
+        :param vectors: A single query vector or a ``(q, dimensions)`` array of query vectors
+        :param k: The number of chunks to return per query
+        :param filters: The metadata pre-filters, see `filter_mask`
+        :param mode: Either "exact" or "ivf", defaults to `VECTOR_INDEX_MODE`
+        :param nprobe: The number of partitions searched per query in "ivf" mode
+
+        :returns: Per query a list of ``(chunk_id, cosine_similarity)`` tuples, best first
+        :rtype: list
+        """
+
+        queries = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+        norms = np.linalg.norm(queries, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        queries = queries / norms
+
+        mode = mode or VECTOR_INDEX_MODE
+        mask = self.filter_mask(filters)
+
+        if mode == "ivf" and self.centroids is not None:
+            nprobe = min(nprobe or VECTOR_INDEX_NPROBE, self.centroids.shape[0])
+            probes = np.argsort(-(queries @ self.centroids.T), axis=1)[:, :nprobe]
+            candidates = []
+            for probe in probes:
+                candidate_mask = np.isin(self.assignments, probe)
+                if mask is not None:
+                    candidate_mask &= mask
+                candidates.append(np.flatnonzero(candidate_mask))
+        elif mask is not None:
+            candidates = [np.flatnonzero(mask)] * queries.shape[0]
+        else:
+            candidates = None
+
+        results = []
+        if candidates is None:
+            # Unfiltered exact search scores all queries with one matrix multiplication per block
+            best_scores = np.full((queries.shape[0], 0), -np.inf, dtype=np.float32)
+            best_rows = np.empty((queries.shape[0], 0), dtype=np.int64)
+            for start in range(0, len(self), VECTOR_INDEX_BLOCK_SIZE):
+                block_scores = queries @ self.vectors[start:start + VECTOR_INDEX_BLOCK_SIZE].T
+                block_rows = np.arange(start, start + block_scores.shape[1])
+                scores = np.hstack([best_scores, block_scores])
+                rows = np.hstack([best_rows, np.broadcast_to(block_rows, block_scores.shape)])
+                if scores.shape[1] > k:
+                    keep = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+                    scores = np.take_along_axis(scores, keep, axis=1)
+                    rows = np.take_along_axis(rows, keep, axis=1)
+                best_scores, best_rows = scores, rows
+
+            order = np.argsort(-best_scores, axis=1)
+            for query_rows, query_scores, query_order in zip(best_rows, best_scores, order):
+                results.append(
+                    [
+                        (str(self.chunk_ids[query_rows[i]]), float(query_scores[i]))
+                        for i in query_order
+                    ]
+                )
+        else:
+            for query, rows in zip(queries, candidates):
+                rows, scores = self._top_k(query, rows, k)
+                results.append(
+                    [(str(self.chunk_ids[row]), float(score)) for row, score in zip(rows, scores)]
+                )
+
+        if np.ndim(vectors) == 1:
+            return results[0]
+
+        return results
+
+
+_LOCAL_VECTOR_INDEX = None
+_LOCAL_VECTOR_INDEX_LOCK = threading.Lock()
+
+
+def get_local_vector_index():
+    """Returns the process-wide local vector index, loading the snapshot on first use
+
+    :returns: A `LocalVectorIndex` instance
+    :rtype: `LocalVectorIndex`
+    :raises FileNotFoundError: No snapshot has been built yet
+    """
+
+    global _LOCAL_VECTOR_INDEX
+
+    if _LOCAL_VECTOR_INDEX is None:
+        with _LOCAL_VECTOR_INDEX_LOCK:
+            if _LOCAL_VECTOR_INDEX is None:
+                _LOCAL_VECTOR_INDEX = LocalVectorIndex.load(local_storage_path(VECTOR_INDEX_FILE))
+
+    return _LOCAL_VECTOR_INDEX
+
+
+if __name__ == "__main__":
+    # Builds a snapshot: python -m resources.resource_classes.cl_vector_index [n_lists]
+    from resources.resource_classes.cl_search_backend import get_search_backend
+
+    snapshot = LocalVectorIndex.from_backend(get_search_backend())
+    if len(sys.argv) > 1:
+        snapshot.build_partitions(int(sys.argv[1]))
+    snapshot.save(local_storage_path(VECTOR_INDEX_FILE))
+    print(f"Saved a vector index with {len(snapshot)} chunks")
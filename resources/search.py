@@ -1,10 +1,20 @@
 """This module facilitates all search interactions"""
 
+import json
+from flask import Response, stream_with_context
 from flask_smorest import Blueprint, abort
-from flask_jwt_extended import jwt_required
+from flask_jwt_extended import get_jwt, jwt_required
 from flask.views import MethodView
-from schemas import PlainDocumentSchema, SearchDocumentsSchema, SearchObjectsSchema, SearchResultsSchema
-from .resource_classes import ChunkSearchingClass, CL_Mistral_Embeddings, CL_Mistral_Completions
+from schemas import (
+    PlainDocumentSchema,
+    SearchDocumentsSchema,
+    SearchObjectsSchema,
+    SearchResultsSchema,
+    EnrichmentJobQuerySchema,
+    EnrichmentJobSchema,
+)
+from .resource_classes import ChunkSearchingClass, CL_Mistral_Embeddings, DocumentEnrichmentClass
+from .resource_classes.cl_enrichment_jobs import ENRICHMENT_JOB_QUEUE, ENRICHMENT_WORKER_POOL
 
 blp = Blueprint("Search", "search", description="Operations on the search page")
 
@@ -24,7 +34,7 @@ class SearchDocuments(MethodView):
     
         search_config = {
             "search_string": search_string,
-            "embedding": CL_Mistral_Embeddings().generate_embedding(search_string)
+            "embedding": CL_Mistral_Embeddings(priority="interactive").generate_embedding(search_string)
         }
         if input_data.get("search_from"): 
             search_config["search_from"]=input_data.get("search_from")
@@ -41,59 +51,108 @@ class SearchDocuments(MethodView):
         if input_data.get("type_secondary"): 
             search_config["type_secondary"]=input_data.get("type_secondary")
 
-        objects, filters = ChunkSearchingClass().search_documents(search_config)
+        # Paged mode returns a limited number of days and a cursor for the next page
+        paged = bool(input_data.get("page_size") or input_data.get("after"))
+        next_cursor = None
+        if paged:
+            objects, filters, next_cursor = ChunkSearchingClass().search_documents_page(
+                search_config,
+                after=input_data.get("after"),
+                page_size=input_data.get("page_size"),
+            )
+        else:
+            objects, filters = ChunkSearchingClass().search_documents(search_config)
         
         # Aggregate all document IDs into a single list
-        all_document_ids = [
-            doc['document_id'] 
-            for entry in objects 
-            for doc in entry['documents']
-        ]
+        all_document_ids = ChunkSearchingClass.collect_document_ids(objects)
         
         if objects:
             objects[0]['document_ids'] = all_document_ids
 
+        response = {"timeline": objects, "filters": filters}
+        if paged:
+            response["next_cursor"] = next_cursor
+
         # Generate summaries if the search string is not "RijnlandRoute"
-        if search_string.lower() not in ["rijnlandroute", "windpark spui"]:
-            summaries = []
-            for entry in objects[:3]:
-                doc_count = 0
-                for doc in entry['documents']:
-                    document_title = doc['document_title']
-                    content_text = doc['content_text']
-                    if doc_count >= 3:
-                        break
-                   
-                    # print("Content text: ", content_text)
-                    # print("Docid: ", doc['document_id'])
-                    summary_prompt = f"Geef een samenvatting van de volgende tekst: {content_text} over het thema {search_string}. Beschrijf kort wat de kern van de tekst is en wees concreet."
-                  
-                    summary = CL_Mistral_Completions().generate_summary(summary_prompt)
-
-                    label_prompt = f"""Je bent een expert op het gebied van overheidsdocumentatie. Je taak is om het type document te bepalen aan de hand van een titel of korte beschrijving. '
-                    Geef ALLEEN de naam van het label terug, zonder onderbouwing. 
-                    
-                    De titel van het document is {document_title}.
-                    De samenvatting is: {summary}.
-                    en de content van een chunk van dit document is: {content_text}.
-
-                    Het is VERPLICHT om enkel één van deze categorieën te kiezen. Een andere categorie is NIET toegestaan.Geef ALLEEN de naam van de categorie terug:
-
-
-                    Motie
-                    Amendement 
-                    Brief van derden 
-                    Brief van Gedeputeerde Staten (GS) 
-                    Verslag 
-                    Statenvoorstel 
-                    Nota
-                    Overig
-                    """
-                    label = CL_Mistral_Completions().categorize_label(label_prompt)
-                    print("Generating summary for document: ", doc)
-                    doc['summary'] = summary
-                    doc['label'] = label
-                    doc_count += 1
-
-
-        return {"timeline": objects, "filters": filters}
\ No newline at end of file
+        enrich = search_string.lower() not in ["rijnlandroute", "windpark spui"]
+        # While Mistral is failing the results are returned without summaries instead of waiting for it
+        enrich = enrich and DocumentEnrichmentClass.is_available()
+
+        if input_data.get("stream"):
+            return Response(
+                stream_with_context(
+                    self.stream_results(response, search_string if enrich else None)
+                ),
+                mimetype="application/x-ndjson",
+            )
+
+        if enrich and input_data.get("async_enrichment"):
+            # Summaries and labels are generated in the background and polled separately
+            response["enrichment_job_id"] = ENRICHMENT_JOB_QUEUE.create_job(
+                objects, search_string, get_jwt()["sub"]
+            )
+            ENRICHMENT_WORKER_POOL.ensure_started()
+        elif enrich:
+            DocumentEnrichmentClass().enrich(objects, search_string)
+
+        return response
+
+    @staticmethod
+    def stream_results(response, search_string):
+        """Streams the search results as newline-delimited JSON
+
+        The first line contains the timeline and the filters. Every following
+        line is a patch with the summary and label of a single document, sent as
+        soon as it is generated. The last line marks the end of the stream.
+
+        :param response: The search results without summaries and labels
+        :param search_string: The theme to generate summaries for, or None to skip enrichment
+
+        :returns: A generator of NDJSON lines
+        :rtype: generator
+        """
+
+        objects = response["timeline"]
+        yield json.dumps({"type": "results", **SearchResultsSchema().dump(response)}) + "\n"
+
+        if search_string is not None:
+            for bucket_index, document_index, summary, label in DocumentEnrichmentClass().iter_enrichments(
+                objects, search_string
+            ):
+                doc = objects[bucket_index]["documents"][document_index]
+                patch = {
+                    "type": "enrichment",
+                    "bucket_index": bucket_index,
+                    "document_index": document_index,
+                    "chunk_id": doc["chunk_id"],
+                    "summary": summary,
+                    "label": label,
+                }
+                yield json.dumps(patch) + "\n"
+
+        yield json.dumps({"type": "done"}) + "\n"
+
+
+@blp.route("/search_theme/enrichment/<string:job_id>")
+class SearchEnrichmentJob(MethodView):
+    """Progress of the background enrichment of a search"""
+
+    @jwt_required()
+    @blp.arguments(EnrichmentJobQuerySchema, location="query")
+    @blp.response(200, EnrichmentJobSchema)
+    def get(self, query_data, job_id):
+        """Returns the summaries and labels finished since the previous poll
+
+        :param job_id: The `enrichment_job_id` returned by `/search_theme`
+        :param query_data: The `since` value returned by the previous poll
+
+        :raises 404 Not found:
+            The enrichment job does not exist, has expired or was started by another user
+        """
+
+        # A job of another user is reported as missing, so job identifiers cannot be probed
+        job = ENRICHMENT_JOB_QUEUE.get_job(job_id, query_data["since"], get_jwt()["sub"])
+        if job is None:
+            abort(404, message="The enrichment job could not be found.")
+
+        return job
\ No newline at end of file
@@ -1,15 +1,38 @@
 """This module facilitates all search interactions"""
 
+import asyncio
 from flask_smorest import Blueprint, abort
 from flask_jwt_extended import jwt_required
 from flask import request
 from flask.views import MethodView
 from schemas import PlainDocumentSchema, DefaultInputSchema, DefaultOutputSchema
 from .resource_classes import ChunkSearchingClass, CL_Mistral_Embeddings, CL_Mistral_Completions
+from .resource_classes.cl_mistral_connection import CL_Mistral_Async_Completions
+from .resource_classes.cl_mistral_client import run_async
+from .resource_classes.cl_llm_metrics import current_endpoint
 
 blp = Blueprint("Timeline", "timelineh", description="Operations on the timeline page")
 
 
+async def complete_all(method, prompts, endpoint=None):
+    """Sends all prompts concurrently on the shared event loop
+
+    :param method: The name of the `CL_Mistral_Async_Completions` method, e.g. "generate_summary"
+    :param prompts: The prompts to complete
+    :param endpoint: The route the calls are attributed to in the metrics
+
+    :returns: The completion or the raised exception per prompt, in the order of the prompts
+    :rtype: list
+    """
+
+    completions = CL_Mistral_Async_Completions(endpoint=endpoint)
+
+    return await asyncio.gather(
+        *(getattr(completions, method)(prompt) for prompt in prompts),
+        return_exceptions=True,
+    )
+
+
 @blp.route("/completion")
 class Completion(MethodView):
     """Base completions endpoint"""
@@ -34,7 +57,6 @@ class GenerateDocumentSummaries(MethodView):
     @blp.response(200)
     def post(self):
         payload = request.get_json()  # Ensure we get JSON data from the request
-        completion_service = CL_Mistral_Completions()
         chunk_searcher = ChunkSearchingClass()
         data = payload.get("data", {})
         
@@ -65,11 +87,12 @@ class GenerateDocumentSummaries(MethodView):
 
         # Proceed with processing the first chunk_id or handle empty case
         if chunk_ids:
-            for chunk_id in chunk_ids:
+            # Get the complete document records from OpenSearch in one round-trip
+            complete_records = chunk_searcher.get_by_ids(chunk_ids)
+            prompts = {}
+            for chunk_id, complete_record in zip(chunk_ids, complete_records):
                 try:
 
-                    # Get the complete document record from OpenSearch
-                    complete_record = chunk_searcher.get_by_id(chunk_id)
                     # print("Complete record: ", complete_record)
                     
                     content = complete_record.get("content_text", "").strip()
@@ -81,16 +104,28 @@ class GenerateDocumentSummaries(MethodView):
                         prompt += f"Het is NIET nodig om uit te leggen wat de RijnlandRoute is. Beschrijf alleen wat er in de tekst staat."
                         prompt += f"Het document {document_title}, de inhoud van het document is: {content}.\n\n"
                         prompt += f"Houd de tekst vloeiend, gebruik geen onnodige leestekens."
-                        summary = completion_service.generate_summary(prompt)
-                        print("Summary: ", summary)
-
-                        # Update the document with the new summary
-                        new_record = complete_record
-                        new_record["summary"] = summary
-                        print("New record: ", new_record)
-                        # Insert updated document back into OpenSearch
-                        chunk_searcher.update_document(index="es_hackathon", chunk_id=chunk_id, update_body=new_record)
-                
+                        prompts[chunk_id] = (complete_record, prompt)
+
+                except Exception as e:
+                    print(f"Failed to update document {chunk_id}: {str(e)}")
+
+            # Generate all summaries concurrently
+            summaries = run_async(
+                complete_all("generate_summary", [prompt for _, prompt in prompts.values()], current_endpoint())
+            )
+            for (chunk_id, (complete_record, _)), summary in zip(prompts.items(), summaries):
+                try:
+                    if isinstance(summary, Exception):
+                        raise summary
+                    print("Summary: ", summary)
+
+                    # Update the document with the new summary
+                    new_record = complete_record
+                    new_record["summary"] = summary
+                    print("New record: ", new_record)
+                    # Insert updated document back into OpenSearch
+                    chunk_searcher.update_document(index="es_hackathon", chunk_id=chunk_id, update_body=new_record)
+
                 except Exception as e:
                     print(f"Failed to update document {chunk_id}: {str(e)}")
 
@@ -105,7 +140,6 @@ class GenerateDocumentSummaries(MethodView):
     @blp.response(200)
     def post(self):
         payload = request.get_json()  # Ensure we get JSON data from the request
-        completion_service = CL_Mistral_Completions()
         chunk_searcher = ChunkSearchingClass()
         data = payload.get("data", {})
         
@@ -134,10 +168,11 @@ class GenerateDocumentSummaries(MethodView):
                     if chunk_id:
                         chunk_ids.append(chunk_id)
         
-        for chunk_id in chunk_ids:
+        # Get the complete document records from OpenSearch in one round-trip
+        complete_records = chunk_searcher.get_by_ids(chunk_ids)
+        prompts = {}
+        for chunk_id, complete_record in zip(chunk_ids, complete_records):
             try:
-                # Get the complete document record from OpenSearch
-                complete_record = chunk_searcher.get_by_id(chunk_id)
                 print("Complete record: ", complete_record)
 
                 content = complete_record.get("content_text", "").strip()
@@ -167,15 +202,27 @@ class GenerateDocumentSummaries(MethodView):
                     Nota
                     Overig"""
                     
-                    label = completion_service.categorize_label(prompt)
-         
-                    # Update the document with the new summary
-                    new_record = complete_record
-                    new_record["label"] = label
-                    print("New record: ", new_record)
-                    
-                    # Insert updated document back into OpenSearch
-                    chunk_searcher.update_document(index="es_hackathon", chunk_id=chunk_id, update_body=new_record)
+                    prompts[chunk_id] = (complete_record, prompt)
+
+            except Exception as e:
+                print(f"Failed to update document {chunk_id}: {str(e)}")
+
+        # Generate all labels concurrently
+        labels = run_async(
+            complete_all("categorize_label", [prompt for _, prompt in prompts.values()], current_endpoint())
+        )
+        for (chunk_id, (complete_record, _)), label in zip(prompts.items(), labels):
+            try:
+                if isinstance(label, Exception):
+                    raise label
+
+                # Update the document with the new summary
+                new_record = complete_record
+                new_record["label"] = label
+                print("New record: ", new_record)
+                
+                # Insert updated document back into OpenSearch
+                chunk_searcher.update_document(index="es_hackathon", chunk_id=chunk_id, update_body=new_record)
             
             except Exception as e:
                 print(f"Failed to update document {chunk_id}: {str(e)}")
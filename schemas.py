@@ -1,6 +1,6 @@
 """This module defines the Data schemas used by the API"""
 
-from marshmallow import Schema, fields
+from marshmallow import Schema, fields, validate
 
 
 class DefaultResponseSchema(Schema):
@@ -85,6 +85,10 @@ class SearchDocumentsSchema(Schema):
     publisher = fields.List(fields.Str())
     type_primary = fields.List(fields.Str())
     type_secondary = fields.List(fields.Str())
+    after = fields.Str()
+    page_size = fields.Int(validate=validate.Range(min=1, max=365))
+    stream = fields.Bool()
+    async_enrichment = fields.Bool()
 
 
 class DefaultInputSchema(Schema): 
@@ -121,7 +125,93 @@ class SearchObjectFilterSchema(Schema):
 class SearchResultsSchema(Schema): 
     timeline = fields.List(fields.Nested(SearchObjectsSchema()))
     filters = fields.Nested(SearchObjectFilterSchema())
+    next_cursor = fields.Str(allow_none=True)
+    enrichment_job_id = fields.Str()
+
+
+class EnrichmentJobQuerySchema(Schema):
+    since = fields.Int(load_default=0)
+
+class EnrichmentItemSchema(Schema):
+    bucket_index = fields.Int()
+    document_index = fields.Int()
+    chunk_id = fields.Str(allow_none=True)
+    status = fields.Str()
+    summary = fields.Str(allow_none=True)
+    label = fields.Str(allow_none=True)
+
+class EnrichmentJobSchema(Schema):
+    job_id = fields.Str()
+    status = fields.Str()
+    total = fields.Int()
+    completed = fields.Int()
+    next_since = fields.Int()
+    items = fields.List(fields.Nested(EnrichmentItemSchema()))
 
 class ChatInputSchema(Schema):
     question = fields.Str()
-    document_ids = fields.List(fields.Str())
\ No newline at end of file
+    document_ids = fields.List(fields.Str())
+    stream = fields.Bool()
+    new_conversation = fields.Bool()
+
+class LatencyBucketSchema(Schema):
+    le = fields.Raw()
+    count = fields.Float()
+
+class LLMLatencySchema(Schema):
+    mean = fields.Float(allow_none=True)
+    mean_total = fields.Float(allow_none=True)
+    p50 = fields.Float(allow_none=True)
+    p95 = fields.Float(allow_none=True)
+    p99 = fields.Float(allow_none=True)
+    buckets = fields.List(fields.Nested(LatencyBucketSchema()))
+
+class LLMCallSeriesSchema(Schema):
+    endpoint = fields.Str()
+    purpose = fields.Str()
+    model = fields.Str()
+    calls = fields.Float()
+    errors = fields.Float()
+    errors_by_type = fields.Dict(keys=fields.Str(), values=fields.Float())
+    retries = fields.Float()
+    prompt_tokens = fields.Int()
+    completion_tokens = fields.Int()
+    cost_usd = fields.Float()
+    latency = fields.Nested(LLMLatencySchema())
+
+class CircuitBreakerSchema(Schema):
+    name = fields.Str()
+    state = fields.Str()
+    consecutive_failures = fields.Int()
+    reopens_in = fields.Float(allow_none=True)
+    trips = fields.Int()
+    rejected = fields.Int()
+
+class HedgeStatsSchema(Schema):
+    calls = fields.Int()
+    hedged = fields.Int()
+    hedge_wins = fields.Int()
+    skipped = fields.Int()
+    win_rate = fields.Float(allow_none=True)
+
+class ContextPackingSchema(Schema):
+    prompts = fields.Int()
+    original_tokens = fields.Int()
+    packed_tokens = fields.Int()
+    saved_tokens = fields.Int()
+
+class SearchBranchTimingsSchema(Schema):
+    searches = fields.Int()
+    mean_ms = fields.Float()
+    max_ms = fields.Int()
+
+class LLMMetricsSchema(Schema):
+    pid = fields.Int()
+    since = fields.Float()
+    sample_rate = fields.Float()
+    sample_rates = fields.Dict(keys=fields.Str(), values=fields.Float())
+    series = fields.List(fields.Nested(LLMCallSeriesSchema()))
+    context_packing = fields.Dict(keys=fields.Str(), values=fields.Nested(ContextPackingSchema()))
+    search_branches = fields.Dict(keys=fields.Str(), values=fields.Nested(SearchBranchTimingsSchema()))
+    circuit_breakers = fields.List(fields.Nested(CircuitBreakerSchema()))
+    hedging = fields.Dict(keys=fields.Str(), values=fields.Nested(HedgeStatsSchema()))
\ No newline at end of file
@@ -0,0 +1,46 @@
+"""Tests for packing retrieved text into the context of a prompt"""
+
+import os
+
+os.environ.setdefault("MISTRAL_API_KEY", "test")
+
+from resources.resource_classes.cl_context_packing import estimate_tokens, pack_context
+
+
+def test_unpunctuated_text_over_the_budget_is_truncated():
+    text = " ".join(["woord"] * 2000)
+
+    packed = pack_context([text], "summary", budget=100)
+
+    assert packed["chunks"] == 1
+    assert packed["context"]
+    assert text.startswith(packed["context"])
+    assert estimate_tokens(packed["context"]) <= 100
+
+
+def test_single_word_over_the_budget_is_truncated():
+    text = "x" * 12000
+
+    packed = pack_context([text], "label", budget=10)
+
+    assert packed["chunks"] == 1
+    assert packed["context"] and text.startswith(packed["context"])
+    assert estimate_tokens(packed["context"]) <= 10
+
+
+def test_sentence_crossing_the_budget_fills_the_remainder():
+    first = "Dit is de eerste zin."
+    second = " ".join(["lang"] * 500)
+
+    packed = pack_context([f"{first} {second}"], "summary", budget=50)
+
+    assert packed["context"].startswith(first)
+    assert len(packed["context"]) > len(first)
+    assert estimate_tokens(packed["context"]) <= 51
+
+
+def test_text_within_the_budget_is_kept():
+    packed = pack_context(["Een korte zin. Nog een zin."], "chat")
+
+    assert packed["context"] == "Een korte zin. Nog een zin."
+    assert packed["saved_tokens"] == 0
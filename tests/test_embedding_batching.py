@@ -0,0 +1,101 @@
+"""Tests for batching embedding requests, against the local mock Mistral server"""
+
+import os
+
+os.environ.setdefault("MISTRAL_API_KEY", "test")
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from mistralai import SDKError
+
+import resources.resource_classes.cl_mistral_client as cl_mistral_client
+import resources.resource_classes.cl_mistral_connection as cl_mistral_connection
+import resources.resource_classes.cl_rate_limiter as cl_rate_limiter
+from benchmarks.mock_mistral_server import MockMistralServer, embed_text
+from resources.resource_classes.cl_embedding_batcher import EmbeddingMicroBatcher
+from resources.resource_classes.cl_mistral_client import MISTRAL_CLIENT_MANAGER
+from resources.resource_classes.cl_mistral_connection import CL_Mistral_Embeddings
+
+
+def start_server(monkeypatch, **settings):
+    server = MockMistralServer(("127.0.0.1", 0), latency_median_ms=20, latency_p99_ms=40, **settings)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    monkeypatch.setattr(cl_mistral_client, "MISTRAL_SERVER_URL", f"http://127.0.0.1:{server.server_address[1]}")
+    monkeypatch.setattr(cl_mistral_connection, "EMBEDDING_CACHE", None)
+    monkeypatch.setattr(cl_rate_limiter, "MISTRAL_RATE_LIMITER", None)
+    MISTRAL_CLIENT_MANAGER.reset()
+
+    return server
+
+
+@pytest.fixture
+def server(monkeypatch):
+    server = start_server(monkeypatch)
+    yield server
+    server.shutdown()
+    MISTRAL_CLIENT_MANAGER.reset()
+
+
+def test_generate_embeddings_splits_the_texts_into_batches(server, monkeypatch):
+    monkeypatch.setattr(cl_mistral_connection, "EMBEDDING_BATCH_SIZE", 3)
+    texts = [f"tekst {number}" for number in range(7)]
+
+    embeddings = CL_Mistral_Embeddings().generate_embeddings(texts + texts[:2])
+
+    assert server.stats["requests"] == 3
+    # Duplicates are only sent once, and every text gets its own vector back in order
+    assert server.stats["embeddings"] == 7
+    assert embeddings == [embed_text(text) for text in texts + texts[:2]]
+
+
+def test_generate_embeddings_limits_the_tokens_per_batch(server, monkeypatch):
+    texts = ["windpark " * 40, "zonnepark " * 40, "spui"]
+    tokens = max(cl_mistral_connection.estimate_tokens(text) for text in texts)
+    monkeypatch.setattr(cl_mistral_connection, "EMBEDDING_BATCH_MAX_TOKENS", tokens + 5)
+
+    embeddings = CL_Mistral_Embeddings().generate_embeddings(texts)
+
+    assert server.stats["requests"] == 2
+    assert embeddings == [embed_text(text) for text in texts]
+
+
+def test_micro_batcher_sends_concurrent_requests_as_one_call(server):
+    batcher = EmbeddingMicroBatcher(wait_ms=200, max_size=32)
+    texts = [f"vraag {number}" for number in range(8)]
+
+    with ThreadPoolExecutor(len(texts)) as pool:
+        embeddings = list(pool.map(lambda text: batcher.embed(text, "mistral-embed"), texts))
+
+    assert server.stats["requests"] == 1
+    assert embeddings == [embed_text(text) for text in texts]
+
+
+def test_micro_batcher_keeps_models_and_priorities_apart(server):
+    batcher = EmbeddingMicroBatcher(wait_ms=100)
+
+    futures = [
+        batcher.submit("een", "mistral-embed", "interactive"),
+        batcher.submit("twee", "mistral-embed", "background"),
+        batcher.submit("drie", "mistral-embed", "interactive"),
+    ]
+
+    assert [future.result(5) for future in futures] == [embed_text(text) for text in ["een", "twee", "drie"]]
+    assert server.stats["requests"] == 2
+
+
+def test_micro_batcher_fails_every_request_of_a_failed_call(monkeypatch):
+    server = start_server(monkeypatch, api_key="another key")
+    try:
+        batcher = EmbeddingMicroBatcher(wait_ms=100)
+        futures = [batcher.submit(text, "mistral-embed") for text in ["een", "twee"]]
+
+        for future in futures:
+            with pytest.raises(SDKError):
+                future.result(5)
+        assert server.stats["requests"] == 1
+    finally:
+        server.shutdown()
+        MISTRAL_CLIENT_MANAGER.reset()
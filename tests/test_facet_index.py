@@ -0,0 +1,173 @@
+"""Tests for the in-process facet index and its background rebuild"""
+
+import os
+
+os.environ.setdefault("MISTRAL_API_KEY", "test")
+
+import threading
+import time
+
+import pytest
+
+import resources.resource_classes.cl_facet_index as cl_facet_index
+import resources.resource_classes.cl_search as cl_search
+from resources.resource_classes.cl_facet_index import FacetIndex, get_facet_index, update_facet_index
+from resources.resource_classes.cl_search import ChunkSearchingClass
+from resources.resource_classes.cl_search_backend import InMemorySearchBackend
+
+CHUNKS = [
+    # chunk_id, document_id, publisher, type_primary, type_secondary
+    ("c1", "d1", "Provincie", "Kamerstuk", "Transcript"),
+    ("c2", "d1", "Provincie", "Kamerstuk", "Transcript"),
+    ("c3", "d1", "Provincie", "Kamerstuk", "Transcript"),
+    ("c4", "d2", "Provincie", "Vergadering", "Notulen"),
+    ("c5", "d3", "Gemeente", "Kamerstuk", "Notulen"),
+    ("c6", "d3", "Gemeente", "Kamerstuk", "Bijlage"),
+    ("c7", "d4", "Waterschap", "Vergadering", "Notulen"),
+]
+
+
+def make_backend():
+    backend = InMemorySearchBackend()
+    for number, (chunk_id, document_id, publisher, type_primary, type_secondary) in enumerate(CHUNKS):
+        backend.index(
+            "es_hackethon",
+            chunk_id,
+            {
+                "chunk_id": chunk_id,
+                "document_id": document_id,
+                "document_title": document_id,
+                "published": f"2024-01-0{number % 3 + 1}T10:00:00",
+                "publisher": publisher,
+                "type_primary": type_primary,
+                "type_secondary": type_secondary,
+                "transcription": {"agenda_item": "windpark"},
+                "content_text": f"tekst {chunk_id}",
+                "content_embedding": [1.0, number / 10.0],
+            },
+        )
+
+    return backend
+
+
+def counts(filters, facet):
+    return {item[facet]: item["amount_of_docs"] for item in filters[facet]}
+
+
+def test_counts_documents_not_chunks():
+    index = FacetIndex()
+    index.build(make_backend())
+
+    filters = index.counts(["d1", "d3"])
+
+    # d1 has three Provincie chunks, d3 has two chunks with different secondary types
+    assert counts(filters, "publisher") == {"Provincie": 1, "Gemeente": 1}
+    assert counts(filters, "type_primary") == {"Kamerstuk": 2}
+    assert counts(filters, "type_secondary") == {"Transcript": 1, "Notulen": 1, "Bijlage": 1}
+
+
+def test_counts_follow_chunk_updates():
+    index = FacetIndex()
+    index.build(make_backend())
+
+    index.update_chunk("c4", {"publisher": "Gemeente"})
+
+    assert counts(index.counts(["d1", "d2", "d3"]), "publisher") == {"Gemeente": 2, "Provincie": 1}
+
+
+def test_search_counts_under_combined_filters(monkeypatch):
+    backend = make_backend()
+    index = FacetIndex()
+    index.build(backend)
+    monkeypatch.setattr(cl_search, "get_search_backend", lambda: backend)
+    monkeypatch.setattr(cl_search, "get_facet_index", lambda backend: index)
+    monkeypatch.setattr(cl_search, "SEARCH_CACHE", None)
+    monkeypatch.setattr(cl_search, "VECTOR_BACKEND", "opensearch")
+
+    objects, filters = ChunkSearchingClass().search_documents(
+        {
+            "search_string": "windpark",
+            "embedding": [1.0, 0.0],
+            "publisher": ["Provincie", "Gemeente"],
+            "type_primary": ["Kamerstuk"],
+        }
+    )
+
+    document_ids = set(ChunkSearchingClass.collect_document_ids(objects))
+    assert document_ids == {"d1", "d3"}
+    # Every matching document counts once per value, however many of its chunks match
+    assert counts(filters, "publisher") == {"Provincie": 1, "Gemeente": 1}
+    assert counts(filters, "type_primary") == {"Kamerstuk": 2}
+    assert counts(filters, "type_secondary") == {"Transcript": 1, "Notulen": 1, "Bijlage": 1}
+
+
+class BlockingBackend:
+    """Wraps a backend so that `scan` waits until it is released"""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.release = threading.Event()
+
+    def scan(self, index, body, batch_size=1000):
+        for number, hit in enumerate(self.backend.scan(index, body, batch_size)):
+            if number == 2:
+                assert self.release.wait(5)
+            yield hit
+
+
+def wait_until(condition):
+    deadline = time.monotonic() + 5
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def facet_index(monkeypatch):
+    index = FacetIndex()
+    monkeypatch.setattr(cl_facet_index, "_FACET_INDEX", index)
+    monkeypatch.setattr(cl_facet_index, "_FACET_INDEX_BUILD_LOCK", threading.Lock())
+
+    return index
+
+
+def test_first_build_runs_in_the_background(facet_index):
+    backend = BlockingBackend(make_backend())
+
+    started = time.monotonic()
+    assert get_facet_index(backend) is None
+    assert time.monotonic() - started < 1
+
+    backend.release.set()
+    wait_until(lambda: facet_index.built_at is not None)
+
+    assert get_facet_index(backend) is facet_index
+    assert len(facet_index) == 4
+
+
+def test_query_during_a_rebuild_is_served_by_the_previous_index(facet_index):
+    backend = BlockingBackend(make_backend())
+    backend.release.set()
+    facet_index.build(backend)
+    first_build = facet_index.built_at
+
+    backend.release.clear()
+    facet_index.built_at -= cl_facet_index.FACET_INDEX_REFRESH_SECONDS + 1
+    stale_build = facet_index.built_at
+
+    started = time.monotonic()
+    assert get_facet_index(backend) is facet_index
+    assert time.monotonic() - started < 1
+    wait_until(lambda: facet_index.pending_updates is not None)
+
+    # Served from the previous bitmaps while the scan is blocked
+    assert counts(facet_index.counts(["d2"]), "publisher") == {"Provincie": 1}
+    # An update that arrives during the rebuild survives the swap
+    update_facet_index("c1", {"publisher": "Gemeente"})
+
+    backend.release.set()
+    wait_until(lambda: facet_index.built_at != stale_build)
+
+    assert facet_index.built_at > first_build
+    assert facet_index.pending_updates is None
+    assert counts(facet_index.counts(["d1"]), "publisher") == {"Provincie": 1, "Gemeente": 1}
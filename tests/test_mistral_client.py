@@ -0,0 +1,88 @@
+"""Tests for the pooled Mistral client that is shared by the calls of a process"""
+
+import os
+
+os.environ.setdefault("MISTRAL_API_KEY", "test")
+
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+import pytest
+
+import resources.resource_classes.cl_mistral_client as cl_mistral_client
+from benchmarks.mock_mistral_server import MockMistralServer
+from resources.resource_classes.cl_mistral_client import MistralClientManager
+
+
+@pytest.fixture
+def manager(monkeypatch):
+    server = MockMistralServer(("127.0.0.1", 0), latency_median_ms=5, latency_p99_ms=10)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(cl_mistral_client, "MISTRAL_SERVER_URL", f"http://127.0.0.1:{server.server_address[1]}")
+
+    manager = MistralClientManager()
+    yield manager
+    manager.close()
+    server.shutdown()
+
+
+def test_threads_share_one_client(manager):
+    with ThreadPoolExecutor(8) as pool:
+        clients = list(pool.map(lambda _: manager.get_client(), range(32)))
+
+    assert all(client is clients[0] for client in clients)
+
+
+def test_calls_reuse_the_pooled_connections(manager):
+    client = manager.get_client()
+
+    for _ in range(3):
+        client.embeddings.create(model="mistral-embed", inputs=["windpark"])
+
+    # The three sequential calls went over a single kept-alive connection
+    assert len(manager._http_client._transport._pool.connections) == 1
+
+
+def test_client_is_rebuilt_after_a_fork(manager):
+    client = manager.get_client()
+    http_client = manager._http_client
+
+    # A process id that differs from the one the client was built in, as in a forked worker
+    manager._pid = -1
+
+    assert manager.get_client() is not client
+    assert manager._http_client is not http_client
+
+
+def test_http_client_limits_and_timeouts():
+    http_client = MistralClientManager.build_http_client()
+    try:
+        pool = http_client._transport._pool
+        assert pool._max_connections == cl_mistral_client.MISTRAL_MAX_CONNECTIONS
+        assert pool._max_keepalive_connections == cl_mistral_client.MISTRAL_MAX_KEEPALIVE_CONNECTIONS
+        assert http_client.timeout == httpx.Timeout(
+            cl_mistral_client.MISTRAL_READ_TIMEOUT_SECONDS,
+            connect=cl_mistral_client.MISTRAL_CONNECT_TIMEOUT_SECONDS,
+            pool=cl_mistral_client.MISTRAL_POOL_TIMEOUT_SECONDS,
+        )
+    finally:
+        http_client.close()
+
+
+def test_async_calls_share_one_event_loop_and_client(manager):
+    async def client_and_loop():
+        return manager.get_async_client(), asyncio.get_running_loop()
+
+    first = manager.run(client_and_loop())
+    second = manager.run(client_and_loop())
+
+    assert first == second
+    assert first[1] is manager.event_loop()
+
+    async def outside_the_loop():
+        return manager.get_async_client()
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(outside_the_loop())
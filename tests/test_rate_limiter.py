@@ -0,0 +1,167 @@
+"""Tests for the shared Mistral token buckets and the Retry-After handling"""
+
+import os
+
+os.environ.setdefault("MISTRAL_API_KEY", "test")
+
+import asyncio
+import email.utils
+import time
+
+import httpx
+import pytest
+from mistralai import SDKError
+
+import resources.resource_classes.cl_rate_limiter as cl_rate_limiter
+from resources.resource_classes.cl_rate_limiter import (
+    MistralRateLimiter,
+    RateLimitTimeout,
+    retry_after_seconds,
+    retry_delay,
+)
+
+
+@pytest.fixture
+def limiter(tmp_path):
+    return MistralRateLimiter(str(tmp_path / "rate_limit.db"), requests_per_minute=10, tokens_per_minute=1000)
+
+
+def take(limiter, times, tokens=1, priority="interactive"):
+    for _ in range(times):
+        assert limiter.try_acquire(tokens, priority) == 0.0
+
+
+def error(status_code=429, retry_after=None):
+    headers = {} if retry_after is None else {"Retry-After": retry_after}
+    return SDKError("API error occurred", status_code, "", httpx.Response(status_code, headers=headers))
+
+
+def test_empty_bucket_returns_the_wait_for_the_next_request(limiter):
+    take(limiter, 10)
+
+    # Ten requests per minute refill one request every six seconds
+    assert limiter.try_acquire(1, "interactive") == pytest.approx(6.0, abs=0.1)
+
+
+def test_lower_priorities_leave_a_reserve_for_higher_ones(limiter):
+    take(limiter, 7)
+
+    # Background has to leave 30% of the bucket, three requests
+    assert limiter.try_acquire(1, "background") > 0
+    take(limiter, 2, priority="default")
+    # Default has to leave 10%, one request, which interactive may still take
+    assert limiter.try_acquire(1, "default") > 0
+    take(limiter, 1, priority="interactive")
+
+
+def test_token_bucket_limits_large_requests(limiter):
+    assert limiter.try_acquire(600, "interactive") == 0.0
+
+    # 600 of the 1000 tokens per minute are gone, 200 more take 12 seconds to refill
+    assert limiter.try_acquire(600, "interactive") == pytest.approx(12.0, abs=0.1)
+    # A failed attempt takes nothing from the request bucket either
+    take(limiter, 9)
+
+
+def test_request_larger_than_the_bucket_goes_once_it_is_full(limiter):
+    assert limiter.try_acquire(5000, "interactive") == 0.0
+    assert limiter.try_acquire(1, "interactive") > 200
+
+
+def test_settle_returns_overestimated_tokens(limiter):
+    take(limiter, 1, tokens=900)
+    assert limiter.try_acquire(500, "interactive") > 0
+
+    limiter.settle(900, 100)
+
+    assert limiter.try_acquire(500, "interactive") == 0.0
+
+
+def test_workers_share_the_budget_and_the_pause(limiter):
+    other_worker = MistralRateLimiter(limiter.path, requests_per_minute=10, tokens_per_minute=1000)
+    take(limiter, 5)
+    take(other_worker, 5)
+
+    assert limiter.try_acquire(1, "interactive") > 0
+
+    other_worker.pause(30)
+    assert MistralRateLimiter(limiter.path).try_acquire(1, "interactive") == pytest.approx(30, abs=0.5)
+
+
+def test_acquire_sleeps_until_the_bucket_refilled(limiter, monkeypatch):
+    take(limiter, 10)
+    with pytest.raises(RateLimitTimeout):
+        limiter.acquire(1, "interactive", max_wait=0)
+
+    # The sleeps advance the clock the buckets refill with
+    clock = {"offset": 0.0}
+    real_time = time.time
+    sleeps = []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        clock["offset"] += seconds
+
+    monkeypatch.setattr(cl_rate_limiter.time, "time", lambda: real_time() + clock["offset"])
+    monkeypatch.setattr(cl_rate_limiter.time, "sleep", sleep)
+
+    limiter.acquire(1, "interactive", max_wait=10)
+
+    assert len(sleeps) == 1
+    assert sleeps[0] == pytest.approx(6.0, abs=0.1)
+
+
+def test_acquire_async(limiter):
+    async def main():
+        await limiter.acquire_async(1, "interactive", max_wait=0)
+        take(limiter, 9)
+        started = time.monotonic()
+        with pytest.raises(RateLimitTimeout):
+            await limiter.acquire_async(1, "interactive", max_wait=0.2)
+
+        return time.monotonic() - started
+
+    assert 0.2 <= asyncio.run(main()) < 1
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [
+        ("3", 3.0),
+        ("0.5", 0.5),
+        ("-5", 0.0),
+        ("soon", None),
+        ("Mon, 32 Foo 2024 25:00:00 GMT", None),
+        ("nan", None),
+        ("inf", None),
+        ("", None),
+        (None, None),
+    ],
+)
+def test_retry_after_seconds(value, expected):
+    assert retry_after_seconds(error(retry_after=value)) == expected
+
+
+def test_retry_after_http_dates():
+    in_a_minute = time.time() + 60
+
+    assert retry_after_seconds(error(retry_after=email.utils.formatdate(in_a_minute, usegmt=True))) == pytest.approx(
+        60, abs=2
+    )
+    # Without a zone, an HTTP date is in UTC
+    assert retry_after_seconds(error(retry_after=email.utils.formatdate(in_a_minute))) == pytest.approx(60, abs=2)
+    assert retry_after_seconds(error(retry_after=email.utils.formatdate(time.time() - 60, usegmt=True))) == 0.0
+
+
+def test_retry_after_without_a_response():
+    assert retry_after_seconds(ValueError("no response")) is None
+
+
+def test_retry_delay_pauses_all_workers_on_a_429(limiter, monkeypatch):
+    monkeypatch.setattr(cl_rate_limiter, "MISTRAL_RATE_LIMITER", limiter)
+
+    assert retry_delay(error(429, "2"), 0) == 2.0
+    assert limiter.try_acquire(1, "interactive") == pytest.approx(2.0, abs=0.1)
+
+    assert retry_delay(error(400), 0) is None
+    assert retry_delay(error(503, "1"), cl_rate_limiter.MISTRAL_MAX_RETRIES) is None
@@ -0,0 +1,254 @@
+"""Tests for the query and aggregation interpreter of the in-memory search backend"""
+
+import pytest
+
+from resources.resource_classes.cl_search_backend import InMemorySearchBackend, knn_cosine_score
+
+
+def make_backend():
+    backend = InMemorySearchBackend()
+    chunks = [
+        ("c1", "d1", "2024-01-01T10:00:00", "Provincie", "Kamerstuk", [1.0, 0.0]),
+        ("c2", "d1", "2024-01-01T10:00:00", "Provincie", "Kamerstuk", [0.8, 0.6]),
+        ("c3", "d2", "2024-01-02T09:00:00", "Gemeente", "Vergadering", [0.0, 1.0]),
+        ("c4", "d3", "2024-01-03T08:00:00", "Provincie", "Vergadering", [-1.0, 0.0]),
+        ("c5", "d4", "2024-02-01T08:00:00", "Waterschap", "Kamerstuk", [0.6, 0.8]),
+    ]
+    for chunk_id, document_id, published, publisher, type_primary, embedding in chunks:
+        backend.index(
+            "chunks",
+            chunk_id,
+            {
+                "chunk_id": chunk_id,
+                "document_id": document_id,
+                "published": published,
+                "publisher": publisher,
+                "type_primary": type_primary,
+                "content_text": f"tekst over windpark {chunk_id}",
+                "content_embedding": embedding,
+            },
+        )
+
+    return backend
+
+
+def hit_ids(response):
+    return [hit["_id"] for hit in response["hits"]["hits"]]
+
+
+def test_bool_combines_must_filter_must_not_and_should():
+    backend = make_backend()
+
+    response = backend.search(
+        "chunks",
+        {
+            "query": {
+                "bool": {
+                    "must": [{"match": {"content_text": "windpark"}}],
+                    "filter": [{"term": {"publisher.keyword": "Provincie"}}],
+                    "must_not": [{"ids": {"values": ["c4"]}}],
+                    "should": [{"term": {"chunk_id.keyword": "c2"}}],
+                }
+            }
+        },
+    )
+
+    # The should clause is optional next to must, but adds to the score
+    assert hit_ids(response) == ["c2", "c1"]
+    assert response["hits"]["hits"][0]["_score"] == 2.0
+    assert response["hits"]["total"]["value"] == 2
+
+
+def test_minimum_should_match_without_must():
+    backend = make_backend()
+
+    response = backend.search(
+        "chunks",
+        {
+            "query": {
+                "bool": {
+                    "should": [
+                        {"term": {"publisher.keyword": "Provincie"}},
+                        {"term": {"type_primary.keyword": "Vergadering"}},
+                    ],
+                    "minimum_should_match": 2,
+                }
+            }
+        },
+    )
+
+    assert hit_ids(response) == ["c4"]
+
+
+def test_terms_and_range_clauses():
+    backend = make_backend()
+
+    response = backend.search(
+        "chunks",
+        {
+            "size": 10,
+            "sort": [{"chunk_id.keyword": {"order": "asc"}}],
+            "query": {
+                "bool": {
+                    "filter": [
+                        {"terms": {"document_id.keyword": ["d1", "d2", "d4"]}},
+                        {"range": {"published": {"gte": "2024-01-01", "lt": "2024-02-01"}}},
+                    ]
+                }
+            },
+        },
+    )
+
+    assert hit_ids(response) == ["c1", "c2", "c3"]
+
+
+def test_knn_returns_the_k_nearest_with_the_engine_score():
+    backend = make_backend()
+
+    response = backend.search(
+        "chunks",
+        {"query": {"knn": {"content_embedding": {"vector": [1.0, 0.0], "k": 2}}}},
+    )
+
+    assert hit_ids(response) == ["c1", "c2"]
+    assert response["hits"]["hits"][0]["_score"] == pytest.approx(knn_cosine_score(1.0))
+    assert response["hits"]["hits"][1]["_score"] == pytest.approx(knn_cosine_score(0.8))
+
+
+def test_knn_filter_is_applied_before_the_neighbour_search():
+    backend = make_backend()
+
+    response = backend.search(
+        "chunks",
+        {
+            "query": {
+                "knn": {
+                    "content_embedding": {
+                        "vector": [1.0, 0.0],
+                        "k": 2,
+                        "filter": {"term": {"publisher.keyword": "Gemeente"}},
+                    }
+                }
+            }
+        },
+    )
+
+    assert hit_ids(response) == ["c3"]
+
+
+def test_knn_cosine_score_per_engine():
+    assert knn_cosine_score(1.0, "nmslib") == pytest.approx(1.0)
+    assert knn_cosine_score(0.0, "faiss") == pytest.approx(0.5)
+    assert knn_cosine_score(-1.0, "nmslib") == pytest.approx(1 / 3)
+    assert knn_cosine_score(0.0, "lucene") == pytest.approx(0.5)
+    assert knn_cosine_score(-1.0, "lucene") == pytest.approx(0.0)
+
+
+def test_terms_aggregation_orders_on_count_then_key():
+    backend = make_backend()
+
+    response = backend.search(
+        "chunks",
+        {"size": 0, "aggs": {"publisher": {"terms": {"field": "publisher.keyword", "size": 2}}}},
+    )
+
+    aggregation = response["aggregations"]["publisher"]
+    assert [(bucket["key"], bucket["doc_count"]) for bucket in aggregation["buckets"]] == [
+        ("Provincie", 3),
+        ("Gemeente", 1),
+    ]
+    assert aggregation["sum_other_doc_count"] == 1
+
+
+def test_filter_aggregation_with_sub_aggregations():
+    backend = make_backend()
+
+    response = backend.search(
+        "chunks",
+        {
+            "size": 0,
+            "aggs": {
+                "Overlap": {
+                    "filter": {"term": {"type_primary.keyword": "Kamerstuk"}},
+                    "aggs": {"publisher": {"terms": {"field": "publisher.keyword"}}},
+                }
+            },
+        },
+    )
+
+    overlap = response["aggregations"]["Overlap"]
+    assert overlap["doc_count"] == 3
+    assert [(bucket["key"], bucket["doc_count"]) for bucket in overlap["publisher"]["buckets"]] == [
+        ("Provincie", 2),
+        ("Waterschap", 1),
+    ]
+
+
+def test_composite_pages_through_all_days_once():
+    backend = make_backend()
+    aggregation = {
+        "composite": {
+            "size": 2,
+            "sources": [
+                {"day": {"date_histogram": {"field": "published", "calendar_interval": "day", "order": "desc"}}}
+            ],
+        },
+        "aggs": {"Documents": {"terms": {"field": "document_id.keyword"}}},
+    }
+
+    pages = []
+    after = None
+    while True:
+        if after is not None:
+            aggregation["composite"]["after"] = after
+        result = backend.search("chunks", {"size": 0, "aggs": {"days": aggregation}})["aggregations"]["days"]
+        if not result["buckets"]:
+            break
+        pages.append([(bucket["key"]["day"], bucket["doc_count"]) for bucket in result["buckets"]])
+        after = result["after_key"]
+
+    assert pages == [
+        [("2024-02-01", 1), ("2024-01-03", 1)],
+        [("2024-01-02", 1), ("2024-01-01", 2)],
+    ]
+
+
+def test_date_histogram_with_top_hits_and_max_score():
+    backend = make_backend()
+
+    response = backend.search(
+        "chunks",
+        {
+            "size": 0,
+            "query": {"knn": {"content_embedding": {"vector": [1.0, 0.0], "k": 3}}},
+            "aggs": {
+                "days": {
+                    "date_histogram": {"field": "published", "calendar_interval": "day", "order": {"_key": "desc"}},
+                    "aggs": {
+                        "best": {"top_hits": {"size": 1, "_source": {"excludes": ["content_embedding"]}}},
+                        "max_score": {"max": {"script": {"source": "_score"}}},
+                    },
+                }
+            },
+        },
+    )
+
+    buckets = response["aggregations"]["days"]["buckets"]
+    assert [bucket["key_as_string"] for bucket in buckets] == ["2024-02-01", "2024-01-01"]
+    first_day = buckets[1]
+    assert first_day["doc_count"] == 2
+    assert first_day["best"]["hits"]["hits"][0]["_id"] == "c1"
+    assert "content_embedding" not in first_day["best"]["hits"]["hits"][0]["_source"]
+    assert first_day["max_score"]["value"] == pytest.approx(knn_cosine_score(1.0))
+
+
+def test_msearch_returns_failed_items_when_asked():
+    backend = make_backend()
+    bodies = [{"query": {"ids": {"values": ["c1"]}}}, {"query": {"unknown_clause": {}}}]
+
+    responses = backend.msearch("chunks", bodies, raise_on_error=False)
+
+    assert hit_ids(responses[0]) == ["c1"]
+    assert "error" in responses[1]
+    with pytest.raises(ValueError):
+        backend.msearch("chunks", bodies)
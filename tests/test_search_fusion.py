@@ -0,0 +1,159 @@
+"""Tests for fusing the kNN and transcript branches of the timeline search"""
+
+import os
+
+os.environ.setdefault("MISTRAL_API_KEY", "test")
+
+import pytest
+
+import resources.resource_classes.cl_search as cl_search
+from resources.resource_classes.cl_search import ChunkSearchingClass
+from resources.resource_classes.cl_search_backend import InMemorySearchBackend
+
+
+def hit(chunk_id, score):
+    return {"_id": chunk_id, "_score": score, "_source": {"chunk_id": chunk_id}}
+
+
+def day(date, documents):
+    return {
+        "key_as_string": date,
+        "key": date,
+        "doc_count": sum(document["doc_count"] for document in documents),
+        "Documents": {"buckets": documents},
+    }
+
+
+def document(document_id, doc_count, hits, overlap=None):
+    bucket = {"key": document_id, "doc_count": doc_count, "Document_Chunks": {"hits": {"hits": hits}}}
+    if overlap is not None:
+        bucket["Overlap"] = {"doc_count": overlap}
+
+    return bucket
+
+
+def test_merge_timeline_buckets_counts_the_overlap_once():
+    knn = [day("2024-01-01", [document("d1", 4, [hit("a", 3.0), hit("b", 2.5), hit("c", 1.0)], overlap=2)])]
+    transcript = [day("2024-01-01", [document("d1", 3, [hit("b", 1.5), hit("e", 2.0), hit("f", 0.5)])])]
+
+    fused = ChunkSearchingClass.merge_timeline_buckets([knn, transcript])
+
+    (fused_day,) = fused
+    (fused_document,) = fused_day["Documents"]["buckets"]
+    assert fused_document["doc_count"] == 5
+    assert fused_day["doc_count"] == 5
+    # The kNN branch scored "b" with both clauses, its transcript-only score is dropped
+    assert [(item["_id"], item["_score"]) for item in fused_document["Document_Chunks"]["hits"]["hits"]] == [
+        ("a", 3.0),
+        ("b", 2.5),
+        ("e", 2.0),
+    ]
+    assert fused_document["max_score"]["value"] == 3.0
+
+
+def test_merge_timeline_buckets_orders_days_and_documents():
+    knn = [
+        day("2024-01-01", [document("d1", 1, [hit("a", 1.0)])]),
+        day("2024-01-03", [document("d3", 1, [hit("c", 1.0)])]),
+    ]
+    transcript = [day("2024-01-01", [document("d2", 2, [hit("b", 1.0), hit("x", 1.0)])])]
+
+    fused = ChunkSearchingClass.merge_timeline_buckets([knn, transcript])
+
+    assert [entry["key_as_string"] for entry in fused] == ["2024-01-03", "2024-01-01"]
+    assert [bucket["key"] for bucket in fused[1]["Documents"]["buckets"]] == ["d2", "d1"]
+
+
+def test_merge_facet_aggregations_subtracts_the_overlap():
+    def facets(counts):
+        return {
+            facet: {"buckets": [{"key": key, "doc_count": count} for key, count in counts.get(facet, {}).items()]}
+            for facet in ["type_primary", "publisher", "type_secondary"]
+        }
+
+    knn = facets({"publisher": {"Provincie": 3, "Gemeente": 1}, "type_secondary": {"Transcript": 2}})
+    knn["Overlap"] = facets({"publisher": {"Provincie": 1, "Gemeente": 1}, "type_secondary": {"Transcript": 2}})
+    transcript = facets({"publisher": {"Gemeente": 1, "Waterschap": 2}, "type_secondary": {"Transcript": 3}})
+
+    merged = ChunkSearchingClass.merge_facet_aggregations([knn, transcript])
+
+    assert merged["publisher"]["buckets"] == [
+        {"key": "Provincie", "doc_count": 2},
+        {"key": "Waterschap", "doc_count": 2},
+        {"key": "Gemeente", "doc_count": 1},
+    ]
+    assert merged["type_secondary"]["buckets"] == [{"key": "Transcript", "doc_count": 3}]
+    assert merged["type_primary"]["buckets"] == []
+
+
+@pytest.fixture
+def backend(monkeypatch):
+    backend = InMemorySearchBackend()
+    for number in range(40):
+        transcript = number % 3 == 0
+        backend.index(
+            "es_hackethon",
+            f"c{number}",
+            {
+                "chunk_id": f"c{number}",
+                "document_id": f"d{number // 4}",
+                "published": f"2024-01-{number % 5 + 1:02d}T10:00:00",
+                "publisher": ["Provincie", "Gemeente"][number % 2],
+                "type_primary": "Kamerstuk",
+                "type_secondary": "Transcript" if transcript else "Notulen",
+                "transcription": {"agenda_item": "windpark spui" if transcript and number % 2 else "begroting"},
+                "content_text": f"tekst {number}",
+                "content_embedding": [1.0, number / 10.0],
+            },
+        )
+    monkeypatch.setattr(cl_search, "get_search_backend", lambda: backend)
+    monkeypatch.setattr(cl_search, "VECTOR_BACKEND", "opensearch")
+    monkeypatch.setattr(ChunkSearchingClass, "build_knn_branch", staticmethod(
+        lambda config: {"knn": {"content_embedding": {"vector": config["embedding"], "k": 12}}}
+    ))
+
+    return backend
+
+
+def normalized(aggregations):
+    timeline = [
+        (
+            date_bucket["key_as_string"],
+            date_bucket["doc_count"],
+            [
+                (
+                    document_bucket["key"],
+                    document_bucket["doc_count"],
+                    [(item["_id"], round(item["_score"], 6)) for item in document_bucket["Document_Chunks"]["hits"]["hits"]],
+                )
+                for document_bucket in date_bucket["Documents"]["buckets"]
+            ],
+        )
+        for date_bucket in aggregations["Publicatiedatum"]["buckets"]
+    ]
+    facets = {
+        facet: [(bucket["key"], bucket["doc_count"]) for bucket in aggregations[facet]["buckets"]]
+        for facet in ["type_primary", "publisher", "type_secondary"]
+    }
+
+    return timeline, facets
+
+
+def test_search_branches_equal_the_combined_query(backend):
+    config = {"search_string": "windpark", "embedding": [1.0, 0.5]}
+    filters = []
+    combined = backend.search(
+        "es_hackethon",
+        {
+            "size": 0,
+            "query": ChunkSearchingClass.build_search_query(config, filters),
+            "aggs": {
+                "Publicatiedatum": ChunkSearchingClass.build_timeline_aggregation(),
+                **ChunkSearchingClass.build_facet_aggregations(),
+            },
+        },
+    )["aggregations"]
+
+    fused = ChunkSearchingClass().search_branches(config, filters)["aggregations"]
+
+    assert normalized(fused) == normalized(combined)
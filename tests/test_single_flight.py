@@ -0,0 +1,200 @@
+"""Tests for coalescing identical concurrent calls within and across processes"""
+
+import os
+
+os.environ.setdefault("MISTRAL_API_KEY", "test")
+
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import resources.resource_classes.cl_single_flight as cl_single_flight
+from resources.resource_classes.cl_single_flight import SingleFlight
+
+
+@pytest.fixture
+def flight(tmp_path):
+    return SingleFlight(str(tmp_path / "single_flight.db"))
+
+
+class BlockingCall:
+    """A call that counts its invocations and returns once it is released"""
+
+    def __init__(self, result=None, error=None):
+        self.calls = 0
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.result = result
+        self.error = error
+
+    def __call__(self):
+        self.calls += 1
+        self.started.set()
+        assert self.release.wait(5)
+        if self.error is not None:
+            raise self.error
+
+        return self.result
+
+
+def test_concurrent_calls_with_the_same_key_share_one_call(flight):
+    call = BlockingCall({"embedding": [1, 2]})
+    key = SingleFlight.build_key("mistral-embed", "windpark")
+
+    with ThreadPoolExecutor(4) as pool:
+        futures = [pool.submit(flight.run, key, call) for _ in range(4)]
+        assert call.started.wait(5)
+        time.sleep(0.05)
+        call.release.set()
+        results = [future.result() for future in futures]
+
+    assert call.calls == 1
+    assert results == [{"embedding": [1, 2]}] * 4
+    assert flight.shared_calls == 3
+
+
+def test_different_keys_are_not_coalesced(flight):
+    calls = []
+
+    assert flight.run(SingleFlight.build_key("a"), lambda: calls.append("a") or "a") == "a"
+    assert flight.run(SingleFlight.build_key("b"), lambda: calls.append("b") or "b") == "b"
+    assert calls == ["a", "b"]
+
+
+def test_finished_results_are_not_reused(flight):
+    key = SingleFlight.build_key("mistral-embed", "windpark")
+    calls = []
+
+    flight.run(key, lambda: calls.append(1) or len(calls))
+    second = flight.run(key, lambda: calls.append(1) or len(calls))
+
+    assert second == 2
+    assert flight.shared_calls == 0
+
+
+def test_a_failed_call_fails_the_waiters_and_releases_the_key(flight):
+    call = BlockingCall(error=RuntimeError("upstream down"))
+    key = SingleFlight.build_key("failing")
+
+    with ThreadPoolExecutor(2) as pool:
+        futures = [pool.submit(flight.run, key, call) for _ in range(2)]
+        assert call.started.wait(5)
+        time.sleep(0.05)
+        call.release.set()
+        for future in futures:
+            with pytest.raises(RuntimeError):
+                future.result()
+
+    assert call.calls == 1
+    assert flight.run(key, lambda: "recovered") == "recovered"
+
+
+def test_a_waiting_process_gets_the_published_result(flight):
+    # A second store on the same database stands in for another gunicorn worker
+    other_worker = SingleFlight(flight.path)
+    call = BlockingCall(["answer"])
+    key = SingleFlight.build_key("mistral-large", "question")
+
+    with ThreadPoolExecutor(1) as pool:
+        leader = pool.submit(flight.run, key, call)
+        assert call.started.wait(5)
+        results = []
+        waiter = threading.Thread(target=lambda: results.append(other_worker.run(key, lambda: ["own call"])))
+        waiter.start()
+        time.sleep(0.1)
+        call.release.set()
+        waiter.join(5)
+
+        assert leader.result() == ["answer"]
+
+    assert results == [["answer"]]
+    assert other_worker.shared_calls == 1
+
+
+def test_state_of_a_key():
+    now = time.time()
+    retention = cl_single_flight.SINGLE_FLIGHT_RESULT_RETENTION_SECONDS
+    timeout = cl_single_flight.SINGLE_FLIGHT_TIMEOUT_SECONDS
+
+    assert SingleFlight._state(None, now, now) == "free"
+    assert SingleFlight._state((None, None, now - 1), now, now) == "running"
+    # A claim whose process got lost
+    assert SingleFlight._state((None, None, now - timeout - 1), now, now) == "free"
+    # Finished while the caller was waiting
+    assert SingleFlight._state(("[]", now - 0.1, now - 1), now, now - 0.5) == "finished"
+    # Finished before the caller arrived
+    assert SingleFlight._state(("[]", now - 0.1, now - 1), now, now - 0.05) == "free"
+    # Finished while the caller was waiting, but longer ago than the retention
+    assert SingleFlight._state(("[]", now - retention - 1, now - 100), now, now - 100) == "free"
+
+
+def test_a_late_caller_claims_the_key_again(flight):
+    key = SingleFlight.build_key("late")
+    since = time.time()
+    assert flight._coordinate(key, since)[0] == "claimed"
+    flight._publish(key, "first")
+
+    assert flight._coordinate(key, since) == ("finished", '"first"')
+    assert flight._coordinate(key, time.time())[0] == "claimed"
+
+
+def test_async_calls_with_the_same_key_share_one_call(flight):
+    calls = []
+
+    async def call():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return {"labels": ["wind"]}
+
+    async def main():
+        key = SingleFlight.build_key("labels", "d1")
+        return await asyncio.gather(*(flight.run_async(key, call) for _ in range(5)))
+
+    assert asyncio.run(main()) == [{"labels": ["wind"]}] * 5
+    assert calls == [1]
+    assert flight.shared_calls == 4
+
+
+def test_async_caller_waits_for_another_process(flight):
+    other_worker = SingleFlight(flight.path)
+    call = BlockingCall("summary")
+    key = SingleFlight.build_key("summary", "d1")
+
+    async def own_call():
+        return "own call"
+
+    async def main():
+        waiter = asyncio.create_task(other_worker.run_async(key, own_call))
+        # The event loop keeps running while the waiter polls the database
+        for _ in range(5):
+            await asyncio.sleep(0.02)
+        call.release.set()
+
+        return await waiter
+
+    with ThreadPoolExecutor(1) as pool:
+        leader = pool.submit(flight.run, key, call)
+        assert call.started.wait(5)
+        assert asyncio.run(main()) == "summary"
+        assert leader.result() == "summary"
+
+
+def test_async_failure_releases_the_key(flight):
+    async def failing():
+        raise RuntimeError("upstream down")
+
+    async def recovered():
+        return "recovered"
+
+    async def main():
+        key = SingleFlight.build_key("failing")
+        results = await asyncio.gather(*(flight.run_async(key, failing) for _ in range(2)), return_exceptions=True)
+        return results, await flight.run_async(key, recovered)
+
+    results, after = asyncio.run(main())
+
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert after == "recovered"
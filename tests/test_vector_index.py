@@ -0,0 +1,165 @@
+"""Tests for the exact, IVF and pre-filtered search of the local vector index"""
+
+import os
+
+os.environ.setdefault("MISTRAL_API_KEY", "test")
+
+import numpy as np
+import pytest
+
+from resources.resource_classes.cl_vector_index import LocalVectorIndex
+
+
+def make_index(size=400, dimensions=16, seed=1):
+    rng = np.random.default_rng(seed)
+    vectors = rng.normal(size=(size, dimensions)).astype(np.float32)
+    return LocalVectorIndex(
+        vectors,
+        [f"c{row}" for row in range(size)],
+        [f"d{row // 4}" for row in range(size)],
+        [["Provincie", "Gemeente", "Waterschap"][row % 3] for row in range(size)],
+        [["Kamerstuk", "Vergadering"][row % 2] for row in range(size)],
+        [np.datetime64("2024-01-01") + np.timedelta64(row % 30, "D") for row in range(size)],
+    )
+
+
+def brute_force(index, query, k, mask=None):
+    query = np.asarray(query, dtype=np.float32)
+    scores = index.vectors @ (query / np.linalg.norm(query))
+    if mask is not None:
+        scores = np.where(mask, scores, -np.inf)
+    rows = np.argsort(-scores)[:k]
+
+    return [(str(index.chunk_ids[row]), float(scores[row])) for row in rows if np.isfinite(scores[row])]
+
+
+def test_exact_search_returns_the_k_most_similar_best_first():
+    index = make_index()
+    query = index.vectors[7] * 3 + 0.1
+
+    results = index.search(query, k=10, mode="exact")
+
+    expected = brute_force(index, query, 10)
+    assert [chunk_id for chunk_id, _ in results] == [chunk_id for chunk_id, _ in expected]
+    assert [score for _, score in results] == pytest.approx([score for _, score in expected], abs=1e-5)
+    assert results[0][0] == "c7"
+    assert all(a[1] >= b[1] for a, b in zip(results, results[1:]))
+
+
+def test_exact_search_over_several_blocks(monkeypatch):
+    monkeypatch.setattr("resources.resource_classes.cl_vector_index.VECTOR_INDEX_BLOCK_SIZE", 64)
+    index = make_index()
+    queries = index.vectors[[3, 150, 399]]
+
+    results = index.search(queries, k=5, mode="exact")
+
+    assert len(results) == 3
+    for query, query_results in zip(queries, results):
+        assert [chunk_id for chunk_id, _ in query_results] == [chunk_id for chunk_id, _ in brute_force(index, query, 5)]
+
+
+def test_prefilters_restrict_the_candidates_before_scoring():
+    index = make_index()
+    filters = {
+        "publisher": ["Gemeente"],
+        "type_primary": ["Kamerstuk"],
+        "published_from": "2024-01-05",
+        "published_until": "2024-01-20T00:00:00",
+    }
+    mask = index.filter_mask(filters)
+
+    results = index.search(index.vectors[0], k=8, filters=filters, mode="exact")
+
+    assert [chunk_id for chunk_id, _ in results] == [chunk_id for chunk_id, _ in brute_force(index, index.vectors[0], 8, mask)]
+    for chunk_id, _ in results:
+        row = int(chunk_id[1:])
+        assert index.publishers[row] == "Gemeente"
+        assert index.type_primary[row] == "Kamerstuk"
+        assert np.datetime64("2024-01-05") <= index.published[row] < np.datetime64("2024-01-20")
+
+
+def test_prefilter_on_documents_returns_fewer_than_k():
+    index = make_index()
+
+    results = index.search(index.vectors[0], k=10, filters={"document_id": ["d2", "d3"]})
+
+    assert sorted(chunk_id for chunk_id, _ in results) == sorted(f"c{row}" for row in range(8, 16))
+
+
+def test_filter_mask_is_none_without_filters():
+    index = make_index()
+
+    assert index.filter_mask(None) is None
+    assert index.filter_mask({}) is None
+
+
+def test_ivf_search_probing_all_partitions_equals_exact_search():
+    index = make_index()
+    index.build_partitions(n_lists=8)
+    query = index.vectors[42]
+
+    exact = index.search(query, k=10, mode="exact")
+    ivf = index.search(query, k=10, mode="ivf", nprobe=8)
+
+    assert [chunk_id for chunk_id, _ in ivf] == [chunk_id for chunk_id, _ in exact]
+
+
+def test_ivf_search_only_scores_the_probed_partitions():
+    index = make_index()
+    index.build_partitions(n_lists=8)
+    query = index.vectors[42]
+    probed = np.argmax(index.centroids @ (query / np.linalg.norm(query)))
+
+    results = index.search(query, k=500, mode="ivf", nprobe=1)
+
+    assert results[0][0] == "c42"
+    assert {chunk_id for chunk_id, _ in results} == {
+        f"c{row}" for row in np.flatnonzero(index.assignments == probed)
+    }
+
+
+def test_ivf_search_applies_the_prefilters():
+    index = make_index()
+    index.build_partitions(n_lists=8)
+    filters = {"publisher": ["Waterschap"]}
+
+    results = index.search(index.vectors[42], k=10, filters=filters, mode="ivf", nprobe=8)
+
+    mask = index.filter_mask(filters)
+    assert [chunk_id for chunk_id, _ in results] == [
+        chunk_id for chunk_id, _ in brute_force(index, index.vectors[42], 10, mask)
+    ]
+
+
+def test_ivf_without_partitions_falls_back_to_exact_search():
+    index = make_index()
+
+    assert index.search(index.vectors[5], k=3, mode="ivf") == index.search(index.vectors[5], k=3, mode="exact")
+
+
+def test_save_and_load_keep_the_partitions(tmp_path):
+    index = make_index()
+    index.build_partitions(n_lists=4)
+    path = tmp_path / "vector_index.npz"
+
+    index.save(path)
+    loaded = LocalVectorIndex.load(path)
+
+    assert np.array_equal(loaded.assignments, index.assignments)
+    assert [chunk_id for chunk_id, _ in loaded.search(index.vectors[9], k=5, mode="ivf", nprobe=2)] == [
+        chunk_id for chunk_id, _ in index.search(index.vectors[9], k=5, mode="ivf", nprobe=2)
+    ]
+
+
+def test_from_sources_skips_chunks_without_an_embedding():
+    index = LocalVectorIndex.from_sources(
+        [
+            {"chunk_id": "a", "document_id": "d1", "published": "2024-03-01T10:00:00", "content_embedding": [1, 0]},
+            {"chunk_id": "b", "document_id": "d1", "content_embedding": []},
+            {"chunk_id": "c", "document_id": "d2", "published": "bad", "content_embedding": [0, 2]},
+        ]
+    )
+
+    assert len(index) == 2
+    assert np.isnat(index.published[1])
+    assert index.search([0, 1], k=1) == [("c", pytest.approx(1.0))]